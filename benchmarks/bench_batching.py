@@ -0,0 +1,76 @@
+"""
+Compares FSM steps per second for `PostgreStateStorage` used directly and behind `BatchingStateStorage` with
+every durability level, on a run made of many cheap `continue_run=True` steps.
+
+    python -m benchmarks.bench_batching --steps 2000
+    python -m benchmarks.bench_batching --db-url postgresql://user@localhost/fsm_bench
+
+Without `--db-url` a throwaway database is started with `testing.postgresql`.
+"""
+import argparse
+import logging
+import time
+from typing import Any, Optional, cast
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from fsm import INITIAL_STATE, TERMINAL_STATE, DEFAULT, JsonParams, StateDefinition, TransitionActionResult
+from fsm.fsm import FiniteStateMachine
+from fsm.fsm_batching import BatchingStateStorage, FLUSH_PER_STEP, FLUSH_PER_RUN, FLUSH_INTERVAL
+from fsm.fsm_persistence import StateStorage
+from fsm.fsm_postgre.fsm_postgre_models import Base
+from fsm.fsm_postgre.fsm_postgre_storage import PostgreStateStorage
+
+
+def _step(params: JsonParams) -> TransitionActionResult:
+    return True, None, params
+
+
+def measure_steps_per_second(engine: sqlalchemy.engine.Engine, steps: int, durability: Optional[str]) -> float:
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    storage: StateStorage[Any] = PostgreStateStorage(sessionmaker(bind=engine), "bench")
+    if durability is not None:
+        storage = BatchingStateStorage(storage, durability)
+    fsm = FiniteStateMachine(storage, cast(StateDefinition, {
+        INITIAL_STATE: (_step, "LOOP-START", TERMINAL_STATE, True),
+        "LOOP-START": (_step, "LOOP-END", TERMINAL_STATE, True),
+        "LOOP-END": (_step, "LOOP-START", TERMINAL_STATE, True),
+        TERMINAL_STATE: (None, None, None, False)
+    }), max_state_visits={DEFAULT: steps // 2})
+    started = time.perf_counter()
+    fsm.run()
+    if isinstance(storage, BatchingStateStorage):
+        storage.close()
+    elapsed = time.perf_counter() - started
+    return steps / elapsed
+
+
+def main(db_url: Optional[str], steps: int) -> None:
+    logging.disable(logging.CRITICAL)
+    pg = None
+    if db_url is None:
+        import testing.postgresql
+        pg = testing.postgresql.Postgresql()
+        db_url = pg.url()
+    try:
+        engine = sqlalchemy.create_engine(db_url)
+        direct = measure_steps_per_second(engine, steps, None)
+        print("steps per run:            {}".format(steps))
+        print("direct writes:            {:10.1f} steps/s".format(direct))
+        for durability in (FLUSH_PER_STEP, FLUSH_INTERVAL, FLUSH_PER_RUN):
+            batched = measure_steps_per_second(engine, steps, durability)
+            print("batched, flush per {:8s}{:10.1f} steps/s  {:6.2f}x".format(
+                durability + ':', batched, batched / direct))
+    finally:
+        if pg is not None:
+            pg.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url', default=None, help='SQLAlchemy URL of a scratch database (tables are dropped)')
+    parser.add_argument('--steps', type=int, default=2000, help='number of transitions in the benchmarked run')
+    args = parser.parse_args()
+    main(args.db_url, args.steps)
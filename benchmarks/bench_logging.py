@@ -0,0 +1,60 @@
+"""
+Measures the logging overhead of an FSM step at different log levels, on a run made of many cheap
+`continue_run=True` steps over `MemoryStateStorage`, so the storage costs next to nothing.
+Log records are written to a null stream, only formatting and handler dispatch are measured.
+
+    python -m benchmarks.bench_logging --steps 20000
+"""
+import argparse
+import io
+import logging
+import time
+from typing import cast
+
+from fsm import INITIAL_STATE, TERMINAL_STATE, DEFAULT, JsonParams, StateDefinition, TransitionActionResult
+from fsm.fsm import FiniteStateMachine
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+
+
+class _NullStream(io.TextIOBase):
+    def write(self, s: str) -> int:
+        return len(s)
+
+
+def _step(params: JsonParams) -> TransitionActionResult:
+    return True, None, params
+
+
+def measure_us_per_step(steps: int, level: int, quiet: bool) -> float:
+    fsm = FiniteStateMachine(MemoryStateStorage(), cast(StateDefinition, {
+        INITIAL_STATE: (_step, "LOOP-START", TERMINAL_STATE, True),
+        "LOOP-START": (_step, "LOOP-END", TERMINAL_STATE, True),
+        "LOOP-END": (_step, "LOOP-START", TERMINAL_STATE, True),
+        TERMINAL_STATE: (None, None, None, False)
+    }), max_state_visits={DEFAULT: steps // 2}, quiet=quiet)
+    run_id = fsm.start_runs([{"payload": list(range(50))}])[0]
+    logging.getLogger().setLevel(level)
+    started = time.perf_counter()
+    fsm.run(run_id)
+    elapsed = time.perf_counter() - started
+    return elapsed / steps * 1e6
+
+
+def main(steps: int) -> None:
+    handler = logging.StreamHandler(_NullStream())
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    print("steps per run:            {}".format(steps))
+    print("logging disabled:         {:8.2f} us/step".format(measure_us_per_step(steps, logging.CRITICAL + 1, False)))
+    print("WARNING, verbose:         {:8.2f} us/step".format(measure_us_per_step(steps, logging.WARNING, False)))
+    print("INFO, quiet:              {:8.2f} us/step".format(measure_us_per_step(steps, logging.INFO, True)))
+    print("INFO, verbose:            {:8.2f} us/step".format(measure_us_per_step(steps, logging.INFO, False)))
+    print("DEBUG, verbose:           {:8.2f} us/step".format(measure_us_per_step(steps, logging.DEBUG, False)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, default=20000, help='number of transitions in the benchmarked run')
+    args = parser.parse_args()
+    main(args.steps)
@@ -0,0 +1,96 @@
+"""
+Measures `find_state` and `get_last_state` latency of `PostgreStateStorage` on a large `state_entry` table,
+first without secondary indexes and then after `create_indexes()`.
+
+    python -m benchmarks.bench_postgre_lookup --rows 1000000
+    python -m benchmarks.bench_postgre_lookup --db-url postgresql://user@localhost/fsm_bench
+
+Without `--db-url` a throwaway database is started with `testing.postgresql`.
+"""
+import argparse
+import random
+import time
+from typing import Any, Callable, List, Optional
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from fsm.fsm_postgre.fsm_postgre_migrations import create_indexes, FSM_TABLES
+from fsm.fsm_postgre.fsm_postgre_models import Base
+from fsm.fsm_postgre.fsm_postgre_storage import PostgreStateStorage
+
+TENANT_ID = "bench"
+STATES_PER_RUN = 10
+
+
+def seed(engine: sqlalchemy.engine.Engine, rows: int) -> None:
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table in FSM_TABLES:
+            for index in table.indexes:
+                connection.exec_driver_sql("DROP INDEX {}".format(index.name))
+        connection.exec_driver_sql(
+            "INSERT INTO state_entry (tenant_id, run_id, name, start_time, end_time, params, visit_count, errors, "
+            "yielded) SELECT %(tenant_id)s, 'run-' || (g / %(states)s), 'STATE-' || (g %% %(states)s), now(), now(), "
+            "'{}', 1, '[]', false FROM generate_series(0, %(rows)s - 1) AS g",
+            {'tenant_id': TENANT_ID, 'states': STATES_PER_RUN, 'rows': rows})
+        connection.exec_driver_sql("ANALYZE state_entry")
+
+
+def percentiles(samples: List[float]) -> str:
+    samples = sorted(samples)
+
+    def pick(p: float) -> float:
+        return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+    return "p50 {:8.3f} ms  p95 {:8.3f} ms  p99 {:8.3f} ms".format(pick(0.5), pick(0.95), pick(0.99))
+
+
+def measure(lookup: Callable[[int], Any], lookups: int) -> List[float]:
+    samples = []
+    for i in range(lookups):
+        started = time.perf_counter()
+        lookup(i)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def report(title: str, storage: PostgreStateStorage, runs: int, lookups: int) -> None:
+    run_ids = ["run-{}".format(random.randrange(runs)) for _ in range(lookups)]
+    state_names = ["STATE-{}".format(random.randrange(STATES_PER_RUN)) for _ in range(lookups)]
+    find = measure(lambda i: storage.find_state(state_names[i], run_ids[i]), lookups)
+    last = measure(lambda i: storage.get_last_state(run_ids[i]), lookups)
+    print(title)
+    print("  find_state:     " + percentiles(find))
+    print("  get_last_state: " + percentiles(last))
+
+
+def main(db_url: Optional[str], rows: int, lookups: int) -> None:
+    pg = None
+    if db_url is None:
+        import testing.postgresql
+        pg = testing.postgresql.Postgresql()
+        db_url = pg.url()
+    try:
+        engine = sqlalchemy.create_engine(db_url)
+        seed(engine, rows)
+        storage = PostgreStateStorage(sessionmaker(bind=engine), TENANT_ID)
+        runs = max(1, rows // STATES_PER_RUN)
+        report("{} rows, primary key only:".format(rows), storage, runs, lookups)
+        create_indexes(engine)
+        with engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE state_entry")
+        report("{} rows, after create_indexes():".format(rows), storage, runs, lookups)
+    finally:
+        if pg is not None:
+            pg.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url', default=None, help='SQLAlchemy URL of a scratch database (tables are dropped)')
+    parser.add_argument('--rows', type=int, default=1000000, help='number of seeded state_entry rows')
+    parser.add_argument('--lookups', type=int, default=200, help='number of timed lookups of each kind')
+    args = parser.parse_args()
+    main(args.db_url, args.rows, args.lookups)
@@ -0,0 +1,68 @@
+"""
+Compares FSM steps per second for `PostgreStateStorage` with and without `single_round_trip`.
+
+    python -m benchmarks.bench_postgre_step_commit --steps 2000
+    python -m benchmarks.bench_postgre_step_commit --db-url postgresql://user@localhost/fsm_bench
+
+Without `--db-url` a throwaway database is started with `testing.postgresql`.
+"""
+import argparse
+import logging
+import time
+from typing import Optional, cast
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from fsm import INITIAL_STATE, TERMINAL_STATE, DEFAULT, JsonParams, StateDefinition, TransitionActionResult
+from fsm.fsm import FiniteStateMachine
+from fsm.fsm_postgre.fsm_postgre_models import Base
+from fsm.fsm_postgre.fsm_postgre_storage import PostgreStateStorage
+
+
+def _step(params: JsonParams) -> TransitionActionResult:
+    return True, None, params
+
+
+def measure_steps_per_second(engine: sqlalchemy.engine.Engine, steps: int, single_round_trip: bool) -> float:
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    storage = PostgreStateStorage(sessionmaker(bind=engine), "bench", single_round_trip=single_round_trip)
+    fsm = FiniteStateMachine(storage, cast(StateDefinition, {
+        INITIAL_STATE: (_step, "LOOP-START", TERMINAL_STATE, True),
+        "LOOP-START": (_step, "LOOP-END", TERMINAL_STATE, True),
+        "LOOP-END": (_step, "LOOP-START", TERMINAL_STATE, True),
+        TERMINAL_STATE: (None, None, None, False)
+    }), max_state_visits={DEFAULT: steps // 2})
+    started = time.perf_counter()
+    fsm.run()
+    elapsed = time.perf_counter() - started
+    return steps / elapsed
+
+
+def main(db_url: Optional[str], steps: int) -> None:
+    logging.disable(logging.CRITICAL)
+    pg = None
+    if db_url is None:
+        import testing.postgresql
+        pg = testing.postgresql.Postgresql()
+        db_url = pg.url()
+    try:
+        engine = sqlalchemy.create_engine(db_url)
+        before = measure_steps_per_second(engine, steps, single_round_trip=False)
+        after = measure_steps_per_second(engine, steps, single_round_trip=True)
+        print("steps per run:            {}".format(steps))
+        print("find + merge per step:    {:10.1f} steps/s".format(before))
+        print("single round trip:        {:10.1f} steps/s".format(after))
+        print("speedup:                  {:10.2f}x".format(after / before))
+    finally:
+        if pg is not None:
+            pg.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url', default=None, help='SQLAlchemy URL of a scratch database (tables are dropped)')
+    parser.add_argument('--steps', type=int, default=2000, help='number of transitions in the benchmarked run')
+    args = parser.parse_args()
+    main(args.db_url, args.steps)
@@ -0,0 +1,273 @@
+"""
+Runs standard pipeline shapes against every storage backend and reports steps per second, step latency
+percentiles, storage calls per step and database round trips per step.
+
+Shapes:
+    linear      one run through a chain of `--steps` states
+    retry       one run retrying an always failing state until `max_state_visits` terminates it
+    yield       one run whose every state yields, advanced with a `run` call per step
+    concurrent  `--steps / 10` runs of a 10 state chain started in bulk and advanced by an `FsmExecutor`
+
+Backends:
+    memory      `MemoryStateStorage`
+    mongo       `MongoStateStorage` on mongomock, or on a real server with `--mongo-url`
+    postgres    `PostgreStateStorage` on `--db-url`, or on a throwaway `testing.postgresql` database
+
+    python -m benchmarks.bench_suite --steps 1000 --save-baseline baseline.json
+    python -m benchmarks.bench_suite --backends memory,postgres --baseline baseline.json --tolerance 0.2
+
+With `--baseline` the exit code is 1 if any result is slower than the baseline by more than the tolerance or
+needs more round trips per step, so regressions of the FSM step or of a storage fail a CI job.
+Round trips are counted as SQL statements for postgres and commands for a real mongo server, they are not
+known for mongomock and memory.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager, ExitStack
+from typing import Optional, List, Dict, Callable, Iterator, Any, NamedTuple, Tuple, cast
+
+from fsm import INITIAL_STATE, TERMINAL_STATE, DEFAULT, StateDefinition, JsonParams, TransitionActionResult
+from fsm.fsm import FiniteStateMachine
+from fsm.fsm_executor import FsmExecutor
+from fsm.fsm_instrumentation import HistogramCollector
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+from fsm.fsm_persistence import StateStorage, StateEntryT
+
+SHAPES = ('linear', 'retry', 'yield', 'concurrent')
+BACKENDS = ('memory', 'mongo', 'postgres')
+CONCURRENT_RUN_STEPS = 10
+
+
+class BenchResult(NamedTuple):
+    steps: int
+    steps_per_second: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    storage_calls_per_step: float
+    round_trips_per_step: Optional[float]
+
+
+# a backend yields a factory of empty storages and a function returning the round trips made so far
+Backend = Iterator[Tuple[Callable[[], StateStorage[Any]], Callable[[], Optional[int]]]]
+
+
+def _succeed(params: JsonParams) -> TransitionActionResult:
+    return True, None, params
+
+
+def _fail(params: JsonParams) -> TransitionActionResult:
+    return False, "failed", params
+
+
+def _chain(length: int, continue_run: bool = True) -> StateDefinition:
+    names = [INITIAL_STATE] + ["STEP-{}".format(i) for i in range(1, length)] + [TERMINAL_STATE]
+    definition: StateDefinition = {name: (_succeed, next_name, TERMINAL_STATE, continue_run)
+                                   for name, next_name in zip(names, names[1:])}
+    return cast(StateDefinition, dict(definition, **{TERMINAL_STATE: (None, None, None, False)}))
+
+
+def _run_shape(shape: str, storage: StateStorage[Any], steps: int, collector: HistogramCollector) -> None:
+    if shape == 'linear':
+        FiniteStateMachine(storage, _chain(steps), instrumentation=collector).run()
+    elif shape == 'retry':
+        FiniteStateMachine(storage, cast(StateDefinition, {
+            INITIAL_STATE: (_succeed, "FLAKY", TERMINAL_STATE, True),
+            "FLAKY": (_fail, TERMINAL_STATE, "FLAKY", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }), {DEFAULT: steps}, instrumentation=collector).run()
+    elif shape == 'yield':
+        fsm = FiniteStateMachine(storage, _chain(steps, continue_run=False), instrumentation=collector)
+        run_id = fsm.start_runs([{}])[0]
+        while not cast(StateEntryT[Any], storage.get_last_state(run_id)).is_terminal():
+            fsm.run(run_id)
+    elif shape == 'concurrent':
+        executor = FsmExecutor(storage, _chain(CONCURRENT_RUN_STEPS), workers=8, instrumentation=collector)
+        executor.run_many(executor.fsm.start_runs([{} for _ in range(max(1, steps // CONCURRENT_RUN_STEPS))]))
+    else:
+        raise ValueError("Unknown shape [{}].".format(shape))
+
+
+def measure(shape: str, new_storage: Callable[[], StateStorage[Any]], round_trips: Callable[[], Optional[int]],
+            steps: int) -> BenchResult:
+    storage = new_storage()
+    collector = HistogramCollector()
+    round_trips_before = round_trips()
+    started = time.perf_counter()
+    _run_shape(shape, storage, steps, collector)
+    elapsed = time.perf_counter() - started
+    round_trips_after = round_trips()
+    summary = collector.summary()
+    transitions = int(sum(stats['count'] for stats in summary['action'].values()))
+    storage_calls = sum(stats['count'] for method, stats in summary['storage'].items()
+                        if method not in ('step', 'run_scope'))
+    step_stats = summary['step']['']
+    return BenchResult(
+        steps=transitions,
+        steps_per_second=transitions / elapsed,
+        p50_ms=step_stats['p50'] * 1000,
+        p95_ms=step_stats['p95'] * 1000,
+        p99_ms=step_stats['p99'] * 1000,
+        storage_calls_per_step=storage_calls / transitions,
+        round_trips_per_step=(round_trips_after - round_trips_before) / transitions
+        if round_trips_before is not None and round_trips_after is not None else None)
+
+
+@contextmanager
+def memory_backend(args: argparse.Namespace) -> Backend:
+    yield MemoryStateStorage, lambda: None
+
+
+@contextmanager
+def mongo_backend(args: argparse.Namespace) -> Backend:
+    from mongoengine import connect, disconnect
+    from mongoengine.connection import get_connection, get_db
+    from fsm.fsm_mongo.fsm_mongo_storage import MongoStateStorage
+    commands = {'count': 0}
+    if args.mongo_url is None:
+        import mongomock
+        connect('fsm_bench', mongo_client_class=mongomock.MongoClient)
+        count: Callable[[], Optional[int]] = lambda: None
+    else:
+        from pymongo import monitoring
+
+        class CommandCounter(monitoring.CommandListener):
+            def started(self, event: monitoring.CommandStartedEvent) -> None:
+                commands['count'] += 1
+
+            def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+                pass
+
+            def failed(self, event: monitoring.CommandFailedEvent) -> None:
+                pass
+
+        connect(host=args.mongo_url, event_listeners=[CommandCounter()])
+        count = lambda: commands['count']
+
+    def new_storage() -> StateStorage[Any]:
+        get_connection().drop_database(get_db().name)
+        return MongoStateStorage()
+
+    try:
+        yield new_storage, count
+    finally:
+        disconnect()
+
+
+@contextmanager
+def postgres_backend(args: argparse.Namespace) -> Backend:
+    import sqlalchemy
+    from sqlalchemy import event
+    from sqlalchemy.orm import sessionmaker
+    from fsm.fsm_postgre.fsm_postgre_models import Base
+    from fsm.fsm_postgre.fsm_postgre_storage import PostgreStateStorage
+    pg = None
+    db_url = args.db_url
+    if db_url is None:
+        import testing.postgresql
+        pg = testing.postgresql.Postgresql()
+        db_url = pg.url()
+    statements = {'count': 0}
+    engine = sqlalchemy.create_engine(db_url)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(*args: Any) -> None:
+        statements['count'] += 1
+
+    def new_storage() -> StateStorage[Any]:
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        return PostgreStateStorage(sessionmaker(bind=engine), "bench")
+
+    try:
+        yield new_storage, lambda: statements['count']
+    finally:
+        engine.dispose()
+        if pg is not None:
+            pg.stop()
+
+
+BACKEND_FACTORIES: Dict[str, Callable[[argparse.Namespace], Any]] = {
+    'memory': memory_backend,
+    'mongo': mongo_backend,
+    'postgres': postgres_backend,
+}
+
+
+def run_suite(args: argparse.Namespace) -> Dict[str, BenchResult]:
+    results: Dict[str, BenchResult] = {}
+    for backend in args.backends:
+        with ExitStack() as stack:
+            try:
+                new_storage, round_trips = stack.enter_context(BACKEND_FACTORIES[backend](args))
+            except ImportError as e:
+                print("{:10s} skipped, missing dependency: {}".format(backend, e))
+                continue
+            for shape in args.shapes:
+                results['{}/{}'.format(backend, shape)] = measure(shape, new_storage, round_trips, args.steps)
+    return results
+
+
+def print_results(results: Dict[str, BenchResult], baseline: Dict[str, Dict[str, Any]]) -> None:
+    print("{:22s}{:>8s}{:>12s}{:>9s}{:>9s}{:>9s}{:>10s}{:>10s}{:>10s}".format(
+        'backend/shape', 'steps', 'steps/s', 'p50 ms', 'p95 ms', 'p99 ms', 'calls/st', 'rt/step', 'vs base'))
+    for key, result in results.items():
+        base = baseline.get(key)
+        print("{:22s}{:8d}{:12.1f}{:9.3f}{:9.3f}{:9.3f}{:10.2f}{:>10s}{:>10s}".format(
+            key, result.steps, result.steps_per_second, result.p50_ms, result.p95_ms, result.p99_ms,
+            result.storage_calls_per_step,
+            '{:.2f}'.format(result.round_trips_per_step) if result.round_trips_per_step is not None else '-',
+            '{:.2f}x'.format(result.steps_per_second / base['steps_per_second']) if base else '-'))
+
+
+def find_regressions(results: Dict[str, BenchResult], baseline: Dict[str, Dict[str, Any]],
+                     tolerance: float) -> List[str]:
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result.steps_per_second < base['steps_per_second'] * (1 - tolerance):
+            regressions.append("{}: {:.1f} steps/s, baseline {:.1f}".format(
+                key, result.steps_per_second, base['steps_per_second']))
+        if result.round_trips_per_step is not None and base.get('round_trips_per_step') is not None \
+                and result.round_trips_per_step > base['round_trips_per_step'] + 1e-9:
+            regressions.append("{}: {:.2f} round trips per step, baseline {:.2f}".format(
+                key, result.round_trips_per_step, base['round_trips_per_step']))
+    return regressions
+
+
+def main(args: argparse.Namespace) -> int:
+    logging.disable(logging.CRITICAL)
+    baseline: Dict[str, Dict[str, Any]] = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = run_suite(args)
+    print_results(results, baseline)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({key: result._asdict() for key, result in results.items()}, f, indent=2, sort_keys=True)
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, default=1000, help='number of transitions per benchmarked shape')
+    parser.add_argument('--shapes', type=lambda s: s.split(','), default=list(SHAPES),
+                        help='comma separated shapes, default: {}'.format(','.join(SHAPES)))
+    parser.add_argument('--backends', type=lambda s: s.split(','), default=list(BACKENDS),
+                        help='comma separated backends, default: {}'.format(','.join(BACKENDS)))
+    parser.add_argument('--db-url', default=None, help='SQLAlchemy URL of a scratch database (tables are dropped)')
+    parser.add_argument('--mongo-url', default=None, help='URL of a scratch mongo database (it is dropped)')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--save-baseline', default=None, help='write the results as JSON to this file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative steps/s drop against the baseline, default: 0.2')
+    sys.exit(main(parser.parse_args()))
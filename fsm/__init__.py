@@ -10,6 +10,9 @@ JsonParams = Dict[str, Any]
 
 TransitionActionResult = Tuple[bool, Optional[str], JsonParams]
 
+# same with a delay in seconds, the run is parked until then before it enters the next state
+DelayedTransitionActionResult = Tuple[bool, Optional[str], JsonParams, Optional[float]]
+
 TransitionAction = Callable[[JsonParams], TransitionActionResult]
 
 StateDefinition = Dict[str, Tuple[Optional[TransitionAction], str, str, bool]]
@@ -1,13 +1,22 @@
-from functools import wraps
+import logging
+import threading
+from functools import wraps, partial
 
 from copy import copy
-from datetime import datetime
+from datetime import datetime, timedelta
+from time import perf_counter_ns
 from inspect import isfunction
-from typing import Dict, Tuple, Callable, Any, Optional, TypeVar, Union, cast, Generic
+from typing import Dict, Tuple, Callable, Any, Optional, TypeVar, Union, cast, Generic, List
 
 from fsm.logging_conf.logging import get_child_logger, add_dynamic_fields_to_logger
-from fsm import DEFAULT, StateDefinition
-from fsm.fsm_persistence import StateStorage, RunId
+from fsm import DEFAULT, TERMINAL_STATE, StateDefinition, TransitionAction
+from fsm.fsm_backoff import BackoffPolicy
+from fsm.fsm_definition import CompiledDefinition, compile_definition, StateTransition
+from fsm.fsm_execution import ExecutionPolicy, InlineExecution
+from fsm.fsm_memo import StepMemo, params_hash, encode_result, decode_result
+from fsm.fsm_instrumentation import FsmInstrumentation, InstrumentedStateStorage
+from fsm.fsm_persistence import StateStorage, StateEntryT, RunId
+from fsm.fsm_submachine import SubMachine, PendingSubRuns
 
 
 FsmTransitionResult = Tuple[bool, Optional[str], Optional[Dict[str, Any]]]
@@ -16,6 +25,8 @@ FsmParams = Dict[str, Any]
 
 FsmAction = Callable[[FsmParams], FsmTransitionResult]
 
+_INLINE = InlineExecution()
+
 S = TypeVar('S')
 U = Optional[Callable[[], 'U']]
 
@@ -30,104 +41,373 @@ def trampoline(f: Callable[..., Union[Callable[..., S], S]]) -> Callable[..., S]
     return g
 
 
+class _RunStateCache(Generic[RunId]):
+    """
+    Entries of the run advanced by one `FiniteStateMachine.run` call. Filled on first lookup and kept up to date
+    by the storage state listener, the FSM itself is the only writer of a run while it advances it.
+    """
+    __slots__ = ('run_id', 'states', 'last_state')
+
+    def __init__(self, run_id: Optional[RunId]) -> None:
+        self.run_id: Optional[RunId] = run_id
+        # state name -> entry, None if the run has no such entry yet
+        self.states: Dict[str, Optional[StateEntryT[RunId]]] = {}
+        self.last_state: Optional[StateEntryT[RunId]] = None
+
+    def on_state_written(self, run_id: RunId, state: Optional[StateEntryT[RunId]]) -> None:
+        if run_id != self.run_id:
+            return
+        if state is None:
+            self.states.clear()
+            self.last_state = None
+        else:
+            self.states[state.name] = state
+
+
 class FiniteStateMachine(Generic[RunId]):
+    """
+    :param state_transitions: FSM definition, a dict or a definition compiled with `compile_definition`.
+    A dict is compiled without validation, so missing states only raise `KeyError` once a run gets there.
+    :param max_state_visits: maximum visits per state name with a `DEFAULT` for all other states,
+    ignored for a compiled definition which has its own.
+    :param quiet: instead of a dozen messages per step log a single INFO record per transition or termination,
+    warnings and action exceptions are still logged.
+    :param instrumentation: hooks timing steps, actions and storage calls, e.g. a `HistogramCollector`.
+    The storage is then wrapped in an `InstrumentedStateStorage`.
+    :param retry_backoff: backoff policy per state name, optionally with a `DEFAULT`. A run whose action fails in
+    such a state is parked until the backoff delay passes instead of retrying in the same `run` call, it's woken
+    by a `DueRunPoller` or the first `run` call after the delay. Ignored for a compiled definition.
+    An action can also park the run itself by returning a delay in seconds as the fourth element of its result.
+    :param execution_policies: execution policy per state name, optionally with a `DEFAULT`, e.g. a
+    `ProcessExecution` for CPU bound actions. Actions of other states are called inline. Ignored for a compiled
+    definition.
+    :param state_timeouts: seconds per state name, optionally with a `DEFAULT`, after which a running action
+    is abandoned and the transition fails with a `TimeoutError` like any failed action, so `max_state_visits`
+    retries apply. Ignored for a compiled definition.
+    :param memoize: `StepMemo` per state name, optionally with a `DEFAULT`. Results of these states' actions are
+    recorded in the storage, so a step repeated after a crash returns the recorded result instead of running
+    the action again. Needs a storage implementing `save_step_result`. Ignored for a compiled definition.
+    """
     def __init__(self, state_storage: StateStorage[RunId],
-                 state_transitions: StateDefinition,
+                 state_transitions: Union[StateDefinition, CompiledDefinition],
                  max_state_visits: Dict[str, int] = {DEFAULT: 1},
-                 log_extra: Dict[str, Any] = {}) -> None:
-        self.store: StateStorage[RunId] = state_storage
-        self.state_transitions = state_transitions
-        self.max_visits = copy(max_state_visits)
-        self.max_visits[DEFAULT] = self.max_visits.get(DEFAULT, 1)
+                 log_extra: Dict[str, Any] = {},
+                 quiet: bool = False,
+                 instrumentation: Optional[FsmInstrumentation] = None,
+                 retry_backoff: Dict[str, BackoffPolicy] = {},
+                 execution_policies: Dict[str, ExecutionPolicy] = {},
+                 state_timeouts: Dict[str, float] = {},
+                 memoize: Dict[str, StepMemo] = {}) -> None:
+        self.quiet = quiet
+        self.instrumentation = instrumentation
+        self.store: StateStorage[RunId] = state_storage if instrumentation is None \
+            else InstrumentedStateStorage(state_storage, instrumentation)
+        self.definition = compile_definition(state_transitions, max_state_visits, validate=False,
+                                             retry_backoff=retry_backoff, execution_policies=execution_policies,
+                                             state_timeouts=state_timeouts, memoize=memoize)
+        self.state_transitions = self.definition.source
+        self.max_visits = copy(self.definition.max_visits)
         self.pipeline_str = {k: (v[1:]) for k, v in self.state_transitions.items()}
-        self.run_id: Optional[RunId] = None
+        self._local = threading.local()
         self.logger = get_child_logger("", "fsm", log_extra)
         add_dynamic_fields_to_logger(self.logger, {'run_id': self._get_run_id})
 
+    @property
+    def run_id(self) -> Optional[RunId]:
+        """ID of the run advanced by the calling thread, each thread can drive its own run."""
+        return cast(Optional[RunId], getattr(self._local, 'run_id', None))
+
+    @run_id.setter
+    def run_id(self, run_id: Optional[RunId]) -> None:
+        self._local.run_id = run_id
+
     def _get_run_id(self) -> str:
         return str(self.run_id)
 
     def run(self, run_id: Optional[RunId] = None) -> None:
         self.logger.debug("Run function called.")
         self.run_id = run_id
-        trampoline(self._advance_to_next)(self.run_id)
+        run_cache: _RunStateCache[RunId] = _RunStateCache(run_id)
+        self._local.run_cache = run_cache
+        self.store.add_state_listener(run_cache.on_state_written)
+        try:
+            with self.store.run_scope():
+                trampoline(self._advance_to_next)(self.run_id)
+        finally:
+            self.store.remove_state_listener(run_cache.on_state_written)
+            self._local.run_cache = None
+
+    def start_runs(self, params_list: List[FsmParams]) -> List[RunId]:
+        """
+        Starts a run per params dict without advancing it, initial states are written in bulk.
+        Advance the runs later with `run` or `FsmExecutor.run_many`.
+        :return: IDs of the started runs in the order of `params_list`.
+        """
+        run_ids = self.store.start_runs(params_list)
+        self.logger.info("Started %s runs.", len(run_ids))
+        return run_ids
+
+    def _run_cache(self, run_id: RunId) -> Optional[_RunStateCache[RunId]]:
+        run_cache = getattr(self._local, 'run_cache', None)
+        if run_cache is None:
+            return None
+        if run_cache.run_id != run_id:
+            # first step of a new run started without a run ID
+            run_cache.run_id = run_id
+            run_cache.states.clear()
+            run_cache.last_state = None
+        return cast(_RunStateCache[RunId], run_cache)
+
+    def _get_last_state(self, run_id: Optional[RunId]) -> Optional[StateEntryT[RunId]]:
+        if run_id is not None:
+            run_cache = self._run_cache(run_id)
+            if run_cache is not None and run_cache.last_state is not None:
+                return run_cache.last_state
+        return self.store.get_last_state(run_id)
+
+    def _find_state(self, state_name: str, run_id: RunId) -> Optional[StateEntryT[RunId]]:
+        run_cache = self._run_cache(run_id)
+        if run_cache is None:
+            return self.store.find_state(state_name, run_id)
+        if state_name not in run_cache.states:
+            run_cache.states[state_name] = self.store.find_state(state_name, run_id)
+        return run_cache.states[state_name]
+
+    def _set_current_state(self, state_name: str, run_id: RunId, err: Optional[str], params: FsmParams,
+                           start_time: datetime, end_time: datetime) -> None:
+        run_cache = self._run_cache(run_id)
+        if run_cache is None or state_name not in run_cache.states:
+            self.store.set_current_state(state_name, run_id, err, params, start_time, end_time)
+            return
+        self.store.set_next_state(run_cache.states[state_name], state_name, run_id, err, params, start_time, end_time)
+        # the listener has put the written entry into the cache unless the storage dropped it
+        run_cache.last_state = run_cache.states.get(state_name)
 
     def _advance_to_next(self, current_run_id: Optional[RunId] = None) -> U:
-        self.logger.info("Started FSM execution. Trying to advance to the next state of pipeline.")
-        self.logger.debug("PIPELINE: {}.".format(self.pipeline_str))
-        last_state = self.store.get_last_state(current_run_id)
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return self._advance_step(current_run_id)
+        instrumentation.on_step_start(current_run_id)
+        started = perf_counter_ns()
+        try:
+            return self._advance_step(current_run_id)
+        finally:
+            instrumentation.on_step_done(self.run_id, perf_counter_ns() - started)
+
+    def _advance_step(self, current_run_id: Optional[RunId]) -> U:
+        logger = self.logger
+        verbose = not self.quiet and logger.isEnabledFor(logging.INFO)
+        debug = verbose and logger.isEnabledFor(logging.DEBUG)
+        if verbose:
+            logger.info("Started FSM execution. Trying to advance to the next state of pipeline.")
+        if debug:
+            logger.debug("PIPELINE: %s.", self.pipeline_str)
+        # reads before the action and writes after it are separate storage steps, so no session or connection
+        # is held while the action runs
+        with self.store.step():
+            entered = self._enter_step(current_run_id, verbose, debug)
+        if entered is None:
+            return None
+        current_state, state = entered
+        start_time = datetime.utcnow()
+        if debug:
+            logger.debug("Entering transition from %s to %s with params %s.",
+                         current_state.name, state.success, current_state.params)
+        action_started = perf_counter_ns()
+        result = self._call_action(state, current_state)
+        while isinstance(result, PendingSubRuns) and not result.delay_seconds:
+            # child runs were just started, they're advanced within this step instead of entering the state again
+            with self.store.step():
+                self._keep_sub_run_params(current_state, result)
+            result = self._call_action(state, current_state)
+        with self.store.step():
+            if isinstance(result, PendingSubRuns):
+                return self._wait_for_sub_runs(current_state, result, verbose)
+            return self._leave_step(current_state, state, result, start_time, action_started, verbose, debug)
+
+    def _enter_step(self, current_run_id: Optional[RunId], verbose: bool,
+                    debug: bool) -> Optional[Tuple[StateEntryT[RunId], StateTransition]]:
+        """Current state of the run and its transition, None if there is nothing to run now."""
+        logger = self.logger
+        last_state = self._get_last_state(current_run_id)
         if not last_state or (last_state.is_terminal() and current_run_id is None):
             current_state = self.store.new_initial_state()
-            self.logger.debug("Starting a new run with run ID [{}].".format(current_state.run_id))
+            if debug:
+                logger.debug("Starting a new run with run ID [%s].", current_state.run_id)
             self.store.save_state(current_state)
         else:
             current_state = last_state
         self.run_id = current_state.run_id
-        self.logger.info("Current state is: [{}] for run ID [{}].".format(current_state.name, current_state.run_id))
-        transition, success_state, failure_state, continue_run = self.state_transitions[current_state.name]
-        if not transition:
-            self.logger.info("No transition step defined. Nothing else to do, terminating.")
+        if verbose:
+            logger.info("Current state is: [%s] for run ID [%s].", current_state.name, current_state.run_id)
+        state = self.definition[current_state.name]
+        if not state.action:
+            if verbose:
+                logger.info("No transition step defined. Nothing else to do, terminating.")
             return None
-        else:
-            self.logger.info("We have next state to advance to, checking if we need to yield execution.")
-            if continue_run:
-                self.logger.info("Execution can continue without yielding.")
-            else:
-                if current_state.yielded:
-                    self.store.yield_state(current_state, False)
-                    self.logger.info("Resuming execution of the yielded state.")
-                else:
-                    self.store.yield_state(current_state, True)
-                    self.logger.info("Yielding execution of the next state until next run.")
-                    return None
-            self.logger.info("Checking if next state has been visited before.")
-            if self._max_visits_exceeded(success_state, current_state.run_id):
+        if verbose:
+            logger.info("We have next state to advance to, checking if we need to yield execution.")
+        if current_state.yielded:
+            due_at = getattr(current_state, 'due_at', None)
+            if due_at is not None and due_at > datetime.utcnow():
+                if verbose:
+                    logger.info("Run is parked until %s, nothing to do yet.", due_at)
                 return None
-            else:
-                start_time = datetime.utcnow()
-                self.logger.debug("Entering transition from {} to {} with "
-                                  "params {}.".format(current_state.name, success_state, current_state.params))
-                is_successful, err, params = self.with_state_transition_result(transition)(current_state.params)
-                self.logger.debug("Transition from {} to {} finished with new "
-                                  "params {}.".format(current_state.name, success_state, params))
-                end_time = datetime.utcnow()
-                if not is_successful and self._max_visits_exceeded(failure_state, current_state.run_id):
-                    return None
-                next_state = success_state if is_successful else failure_state
-                self.store.set_current_state(next_state, current_state.run_id, err, params, start_time, end_time)
-                return lambda: self._advance_to_next(current_state.run_id)
-
-    def _max_visits_exceeded(self, state_name: str, run_id: RunId) -> bool:
-        next_state = self.store.find_state(state_name, run_id)
-        success_visit_limit = self.max_visits.get(state_name, self.max_visits[DEFAULT])
+            self.store.yield_state(current_state, False)
+            if verbose:
+                logger.info("Resuming execution of the yielded state.")
+        elif state.continue_run:
+            if verbose:
+                logger.info("Execution can continue without yielding.")
+        else:
+            self.store.yield_state(current_state, True)
+            if verbose:
+                logger.info("Yielding execution of the next state until next run.")
+            return None
+        if verbose:
+            logger.info("Checking if next state has been visited before.")
+        if self._max_visits_exceeded(state.success, state.success_id, current_state.run_id, current_state.name,
+                                     verbose):
+            return None
+        return current_state, state
+
+    def _leave_step(self, current_state: StateEntryT[RunId], state: StateTransition, result: Tuple[Any, ...],
+                    start_time: datetime, action_started: int, verbose: bool, debug: bool) -> U:
+        """Writes the transition the action's result leads to."""
+        is_successful, err, params = result[0], result[1], result[2]
+        if self.instrumentation is not None:
+            self.instrumentation.on_action_done(current_state.run_id, current_state.name, is_successful,
+                                                perf_counter_ns() - action_started)
+        if debug:
+            self.logger.debug("Transition from %s to %s finished with new params %s.",
+                              current_state.name, state.success, params)
+        end_time = datetime.utcnow()
+        if not is_successful and self._max_visits_exceeded(state.failure, state.failure_id, current_state.run_id,
+                                                           current_state.name, verbose):
+            return None
+        next_state = state.success if is_successful else state.failure
+        self._set_current_state(next_state, current_state.run_id, err, params, start_time, end_time)
+        if self.quiet:
+            self._log_transition(current_state.run_id, current_state.name, next_state,
+                                 'success' if is_successful else 'failure', start_time, end_time)
+        delay = self._delay_seconds(state, result, next_state, current_state.run_id)
+        if delay:
+            due_at = end_time + timedelta(seconds=delay)
+            # the entry of the next state has just been saved
+            next_entry = cast(StateEntryT[RunId], self._get_last_state(current_state.run_id))
+            self.store.yield_state(next_entry, True, due_at)
+            if verbose:
+                self.logger.info("Parking the run until %s before entering [%s].", due_at, next_state)
+            return None
+        return lambda: self._advance_to_next(current_state.run_id)
+
+    def _call_action(self, state: StateTransition, current_state: StateEntryT[RunId]) -> Tuple[Any, ...]:
+        if isinstance(state.action, SubMachine):
+            # child runs are recorded by the sub-machine, neither memoized nor moved to another executor
+            advance = partial(state.action.advance, current_state.run_id)
+            return self.with_state_transition_result(cast(FsmAction, advance))(current_state.params)
+        transition = cast(FsmAction, state.action)
+        if state.execution is not None or state.timeout_seconds is not None:
+            transition = partial((state.execution or _INLINE).call, cast(TransitionAction, transition),
+                                 timeout_seconds=state.timeout_seconds)
+        memo = state.memo
+        if memo is None:
+            return self.with_state_transition_result(transition)(current_state.params)
+        run_id, visit_count = current_state.run_id, current_state.visit_count
+        params_digest = params_hash(current_state.params)
+        record = self.store.find_step_result(run_id, state.name, visit_count, params_digest)
+        if record is None and memo.pure:
+            record = memo.get(state.name, params_digest)
+        if record is not None:
+            self.logger.debug("Reusing the recorded result of [%s] instead of running its action.", state.name)
+            return decode_result(record)
+        result = self.with_state_transition_result(transition)(current_state.params)
+        record = encode_result(result)
+        self.store.save_step_result(run_id, state.name, visit_count, params_digest, record)
+        if memo.pure and result[0]:
+            memo.put(state.name, params_digest, record)
+        return result
+
+    def _keep_sub_run_params(self, current_state: StateEntryT[RunId], pending: PendingSubRuns) -> None:
+        """Keeps params linking child runs with the current state."""
+        current_state.params = pending.params
+        self.store.save_state(current_state)
+
+    def _wait_for_sub_runs(self, current_state: StateEntryT[RunId], pending: PendingSubRuns, verbose: bool) -> U:
+        """Parks the run until its child runs are checked again."""
+        self._keep_sub_run_params(current_state, pending)
+        due_at = datetime.utcnow() + timedelta(seconds=pending.delay_seconds)
+        self.store.yield_state(current_state, True, due_at)
+        if verbose:
+            self.logger.info("Sub-machine runs of [%s] haven't finished, parking the run until %s.",
+                             current_state.name, due_at)
+        return None
+
+    def _delay_seconds(self, state: StateTransition, result: Tuple[Any, ...], next_state: str,
+                       run_id: RunId) -> Optional[float]:
+        """Delay returned by the action, or the backoff of a failed one, None to enter the next state right away."""
+        if next_state == TERMINAL_STATE:
+            return None
+        if len(result) > 3 and result[3] is not None:
+            return cast(float, result[3])
+        if result[0] or state.backoff is None:
+            return None
+        next_entry = self._get_last_state(run_id)
+        return state.backoff.delay_seconds(len(next_entry.errors) if next_entry is not None else 1)
+
+    def _log_transition(self, run_id: RunId, from_state: str, to_state: str, outcome: str,
+                        start_time: Optional[datetime] = None, end_time: Optional[datetime] = None) -> None:
+        """The single record per transition of quiet mode, fields are kept in `record.args` for structured handlers."""
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        self.logger.info("Transition [%(from_state)s] -> [%(to_state)s] of run [%(run_id)s]: %(outcome)s, "
+                         "action took %(action_ms).3f ms.",
+                         {'run_id': run_id,
+                          'from_state': from_state,
+                          'to_state': to_state,
+                          'outcome': outcome,
+                          'action_ms': (end_time - start_time).total_seconds() * 1000
+                          if start_time is not None and end_time is not None else 0.0})
+
+    def _max_visits_exceeded(self, state_name: str, state_id: Optional[int], run_id: RunId,
+                             current_state_name: Optional[str] = None, verbose: bool = True) -> bool:
+        next_state = self._find_state(state_name, run_id)
+        success_visit_limit = self.definition.visit_limit(state_name, state_id)
         if next_state and next_state.visit_count >= success_visit_limit:
-            self.logger.warning("Maximum attempts for state [{}] reached. Terminating.".format(state_name))
+            self.logger.warning("Maximum attempts for state [%s] reached. Terminating.", state_name)
             self.store.terminate(next_state.run_id)
-            self.logger.debug("Successfully saved terminal state for run ID [{}].".format(run_id))
+            if self.quiet:
+                self._log_transition(run_id, current_state_name or state_name, TERMINAL_STATE, 'terminated')
+            else:
+                self.logger.debug("Successfully saved terminal state for run ID [%s].", run_id)
             return True
         else:
-            if next_state:
-                visits = next_state.visit_count + 1
-            else:
-                visits = 1
-            self.logger.info("Visited state [{}] {} out of max {} times.".format(state_name, visits,
-                                                                                 success_visit_limit))
+            if verbose:
+                self.logger.info("Visited state [%s] %s out of max %s times.", state_name,
+                                 next_state.visit_count + 1 if next_state else 1, success_visit_limit)
             return False
 
     def with_state_transition_result(self, func: FsmAction) -> Callable[..., FsmTransitionResult]:
         @wraps(func)
         def wrapper(*args: Any) -> FsmTransitionResult:
             try:
-                result = func(*args)
-                if isinstance(result, bool):  # True == success, False == failed, no way to pass params down the chain
-                    return result, None, {}
-                elif isinstance(result, tuple):  # format: (success?, str error or None, params as dict, {} or None)
-                    return result
-                else:
-                    # returns value directly, which has to be a dictionary or None,
-                    # otherwise we wouldn't know what to do with it.
-                    return True, None, result if result else {}
+                return to_transition_result(func(*args))
             except Exception as e:
                 self.logger.exception(e)
-                return False, "class: [{}], doc: [{}], msg: [{}]".format(e.__class__, e.__doc__, str(e)), {}
+                return exception_to_transition_result(e)
         return wrapper
+
+
+def to_transition_result(result: Any) -> FsmTransitionResult:
+    if isinstance(result, bool):  # True == success, False == failed, no way to pass params down the chain
+        return result, None, {}
+    elif isinstance(result, tuple):  # format: (success?, str error or None, params as dict, {} or None)
+        return cast(FsmTransitionResult, result)
+    else:
+        # returns value directly, which has to be a dictionary or None,
+        # otherwise we wouldn't know what to do with it.
+        return True, None, result if result else {}
+
+
+def exception_to_transition_result(e: BaseException) -> FsmTransitionResult:
+    return False, "class: [{}], doc: [{}], msg: [{}]".format(e.__class__, e.__doc__, str(e)), {}
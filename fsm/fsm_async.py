@@ -0,0 +1,350 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor
+from contextvars import ContextVar
+from copy import copy
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
+from typing import Dict, Any, Optional, Tuple, Iterable, Callable, Generic, List, TypeVar, Union, cast, \
+    AsyncIterator, Set, Sequence
+
+from fsm import DEFAULT, TERMINAL_STATE, StateDefinition, JsonParams, TransitionAction
+from fsm.fsm_backoff import BackoffPolicy
+from fsm.fsm_definition import CompiledDefinition, compile_definition, StateTransition
+from fsm.fsm import FsmTransitionResult, to_transition_result, exception_to_transition_result
+from fsm.fsm_execution import ExecutionPolicy, timeout_error, call_abandonable_async
+from fsm.fsm_executor import ExecutorReport
+from fsm.fsm_memo import StepMemo, params_hash, encode_result, decode_result
+from fsm.fsm_parallel import Parallel
+from fsm.fsm_persistence import AsyncStateStorage, StateStorage, StateEntryT, RunId
+from fsm.fsm_submachine import SubMachine, PendingSubRuns
+from fsm.logging_conf.logging import get_child_logger, add_dynamic_fields_to_logger
+
+T = TypeVar('T')
+
+_current_run_id: ContextVar[Optional[Any]] = ContextVar('fsm_current_run_id', default=None)
+
+
+class AsyncFiniteStateMachine(Generic[RunId]):
+    """
+    Asyncio counterpart of `FiniteStateMachine` with the same definition format and semantics.
+    Coroutine transition actions are awaited, regular functions are run in `action_executor` (default asyncio
+    executor if None) so they don't block the event loop, branches of a `Parallel` action run concurrently on
+    the loop. States with an execution policy run their action with it instead. Coroutine actions running longer
+    than the timeout of their state are cancelled. Functions of states with a timeout run on daemon threads of
+    their own instead of `action_executor`, and are abandoned when it passes. Each run keeps its context in its
+    own task, so one instance can drive thousands of runs on a single event loop. A `SubMachine` advances its
+    child runs in `action_executor` too, their storage is synchronous.
+    """
+    def __init__(self, state_storage: AsyncStateStorage[RunId],
+                 state_transitions: Union[StateDefinition, CompiledDefinition],
+                 max_state_visits: Dict[str, int] = {DEFAULT: 1},
+                 log_extra: Dict[str, Any] = {},
+                 action_executor: Optional[Executor] = None,
+                 retry_backoff: Dict[str, BackoffPolicy] = {},
+                 execution_policies: Dict[str, ExecutionPolicy] = {},
+                 state_timeouts: Dict[str, float] = {},
+                 memoize: Dict[str, StepMemo] = {}) -> None:
+        self.store: AsyncStateStorage[RunId] = state_storage
+        self.definition = compile_definition(state_transitions, max_state_visits, validate=False,
+                                             retry_backoff=retry_backoff, execution_policies=execution_policies,
+                                             state_timeouts=state_timeouts, memoize=memoize)
+        self.state_transitions = self.definition.source
+        self.max_visits = copy(self.definition.max_visits)
+        self.pipeline_str = {k: (v[1:]) for k, v in self.state_transitions.items()}
+        self.action_executor = action_executor
+        self.logger = get_child_logger("", "fsm_async", log_extra)
+        add_dynamic_fields_to_logger(self.logger, {'run_id': lambda: str(_current_run_id.get())})
+
+    async def run(self, run_id: Optional[RunId] = None) -> None:
+        self.logger.debug("Run function called.")
+        _current_run_id.set(run_id)
+        can_continue = True
+        while can_continue:
+            can_continue, run_id = await self._advance_step(run_id)
+
+    async def start_runs(self, params_list: List[JsonParams]) -> List[RunId]:
+        """Starts a run per params dict without advancing it, see `FiniteStateMachine.start_runs`."""
+        run_ids = await self.store.start_runs(params_list)
+        self.logger.info("Started %s runs.", len(run_ids))
+        return run_ids
+
+    async def run_many(self, run_ids: Iterable[Optional[RunId]], concurrency: int = 100) -> ExecutorReport:
+        """
+        Runs every run until it yields or terminates with at most `concurrency` runs in progress at once.
+        A run that raises is logged and counted as failed, it doesn't stop other runs.
+        """
+        in_flight = asyncio.Semaphore(concurrency)
+        failed = 0
+
+        async def run_one(run_id: Optional[RunId]) -> None:
+            nonlocal failed
+            try:
+                await self.run(run_id)
+            except Exception as e:
+                failed += 1
+                self.logger.error("Run failed with: {}".format(e))
+            finally:
+                in_flight.release()
+
+        started = time.perf_counter()
+        tasks: Set[asyncio.Future[None]] = set()
+        runs = 0
+        for run_id in run_ids:
+            # a slot is taken before the task is created, so run IDs are consumed as runs finish
+            await in_flight.acquire()
+            task = asyncio.ensure_future(run_one(run_id))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            runs += 1
+        await asyncio.gather(*tasks)
+        report = ExecutorReport(runs, failed, time.perf_counter() - started)
+        self.logger.info("Advanced {} runs ({} failed) in {:.3f}s, {:.1f} runs/s.".format(
+            report.runs, report.failed, report.elapsed_seconds, report.runs_per_second))
+        return report
+
+    async def _advance_step(self, current_run_id: Optional[RunId]) -> Tuple[bool, Optional[RunId]]:
+        self.logger.info("Started FSM execution. Trying to advance to the next state of pipeline.")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("PIPELINE: %s.", self.pipeline_str)
+        # reads before the action and writes after it are separate storage steps, so no session or connection
+        # is held while the action runs
+        async with self.store.step():
+            current_state, state = await self._enter_step(current_run_id)
+        if state is None:
+            return False, current_state.run_id
+        start_time = datetime.utcnow()
+        result = await self._memoized_call(state, current_state)
+        while isinstance(result, PendingSubRuns) and not result.delay_seconds:
+            # child runs were just started, they're advanced within this step instead of entering the state again
+            async with self.store.step():
+                current_state.params = result.params
+                await self.store.save_state(current_state)
+            result = await self._memoized_call(state, current_state)
+        async with self.store.step():
+            return await self._leave_step(current_state, state, result, start_time)
+
+    async def _enter_step(self, current_run_id: Optional[RunId]) -> Tuple[StateEntryT[RunId],
+                                                                          Optional[StateTransition]]:
+        """Current state of the run and its transition, None instead of the transition if there is nothing to run."""
+        last_state = await self.store.get_last_state(current_run_id)
+        if not last_state or (last_state.is_terminal() and current_run_id is None):
+            current_state = await self.store.new_initial_state()
+            self.logger.debug("Starting a new run with run ID [%s].", current_state.run_id)
+            await self.store.save_state(current_state)
+        else:
+            current_state = last_state
+        _current_run_id.set(current_state.run_id)
+        self.logger.info("Current state is: [%s] for run ID [%s].", current_state.name, current_state.run_id)
+        state = self.definition[current_state.name]
+        if not state.action:
+            self.logger.info("No transition step defined. Nothing else to do, terminating.")
+            return current_state, None
+        if current_state.yielded:
+            due_at = getattr(current_state, 'due_at', None)
+            if due_at is not None and due_at > datetime.utcnow():
+                self.logger.info("Run is parked until %s, nothing to do yet.", due_at)
+                return current_state, None
+            await self.store.yield_state(current_state, False)
+            self.logger.info("Resuming execution of the yielded state.")
+        elif not state.continue_run:
+            await self.store.yield_state(current_state, True)
+            self.logger.info("Yielding execution of the next state until next run.")
+            return current_state, None
+        if await self._max_visits_exceeded(state.success, state.success_id, current_state.run_id):
+            return current_state, None
+        return current_state, state
+
+    async def _leave_step(self, current_state: StateEntryT[RunId], state: StateTransition, result: Tuple[Any, ...],
+                          start_time: datetime) -> Tuple[bool, Optional[RunId]]:
+        """Writes the transition the action's result leads to."""
+        if isinstance(result, PendingSubRuns):
+            current_state.params = result.params
+            await self.store.save_state(current_state)
+            due_at = datetime.utcnow() + timedelta(seconds=result.delay_seconds)
+            await self.store.yield_state(current_state, True, due_at)
+            self.logger.info("Sub-machine runs of [%s] haven't finished, parking the run until %s.",
+                             current_state.name, due_at)
+            return False, current_state.run_id
+        is_successful, err, params = result[0], result[1], result[2]
+        end_time = datetime.utcnow()
+        if not is_successful and await self._max_visits_exceeded(state.failure, state.failure_id,
+                                                                 current_state.run_id):
+            return False, current_state.run_id
+        next_state = state.success if is_successful else state.failure
+        await self.store.set_current_state(next_state, current_state.run_id, err, params, start_time, end_time)
+        if next_state != TERMINAL_STATE:
+            delay = result[3] if len(result) > 3 else None
+            next_entry = None
+            if delay is None and not is_successful and state.backoff is not None:
+                next_entry = await self.store.get_last_state(current_state.run_id)
+                delay = state.backoff.delay_seconds(len(next_entry.errors) if next_entry is not None else 1)
+            if delay:
+                due_at = end_time + timedelta(seconds=delay)
+                if next_entry is None:
+                    next_entry = await self.store.get_last_state(current_state.run_id)
+                await self.store.yield_state(cast(StateEntryT[RunId], next_entry), True, due_at)
+                self.logger.info("Parking the run until %s before entering [%s].", due_at, next_state)
+                return False, current_state.run_id
+        return True, current_state.run_id
+
+    async def _memoized_call(self, state: StateTransition, current_state: StateEntryT[RunId]) -> Tuple[Any, ...]:
+        if isinstance(state.action, SubMachine):
+            # child runs go to a synchronous storage, they're advanced off the event loop
+            advance = partial(state.action.advance, current_state.run_id)
+            return await self._call_action(advance, current_state.params)
+        action = cast(TransitionAction, state.action)
+        memo = state.memo
+        if memo is None:
+            return await self._call_action(action, current_state.params, state.execution, state.timeout_seconds)
+        run_id, visit_count = current_state.run_id, current_state.visit_count
+        params_digest = params_hash(current_state.params)
+        record = await self.store.find_step_result(run_id, state.name, visit_count, params_digest)
+        if record is None and memo.pure:
+            record = memo.get(state.name, params_digest)
+        if record is not None:
+            self.logger.debug("Reusing the recorded result of [%s] instead of running its action.", state.name)
+            return decode_result(record)
+        result = await self._call_action(action, current_state.params, state.execution, state.timeout_seconds)
+        record = encode_result(result)
+        await self.store.save_step_result(run_id, state.name, visit_count, params_digest, record)
+        if memo.pure and result[0]:
+            memo.put(state.name, params_digest, record)
+        return result
+
+    async def _call_action(self, action: Callable[[JsonParams], Any], params: JsonParams,
+                           execution: Optional[ExecutionPolicy] = None,
+                           timeout_seconds: Optional[float] = None) -> FsmTransitionResult:
+        try:
+            if execution is not None:
+                result = await execution.call_async(action, params, timeout_seconds)
+            elif timeout_seconds is not None and not asyncio.iscoroutinefunction(action) \
+                    and not isinstance(action, Parallel):
+                # a function can't be interrupted, it's abandoned on a daemon thread instead of pinning an executor
+                result = await call_abandonable_async(action, params, timeout_seconds)
+            else:
+                if asyncio.iscoroutinefunction(action):
+                    pending = action(params)
+                elif isinstance(action, Parallel):
+                    pending = action.run_async(params)
+                else:
+                    pending = asyncio.get_running_loop().run_in_executor(self.action_executor, action, params)
+                try:
+                    result = await asyncio.wait_for(pending, timeout_seconds)
+                except asyncio.TimeoutError:
+                    if timeout_seconds is None:
+                        raise
+                    raise timeout_error(action, timeout_seconds)
+            return to_transition_result(result)
+        except Exception as e:
+            self.logger.exception(e)
+            return exception_to_transition_result(e)
+
+    async def _max_visits_exceeded(self, state_name: str, state_id: Optional[int], run_id: RunId) -> bool:
+        next_state = await self.store.find_state(state_name, run_id)
+        visit_limit = self.definition.visit_limit(state_name, state_id)
+        if next_state and next_state.visit_count >= visit_limit:
+            self.logger.warning("Maximum attempts for state [%s] reached. Terminating.", state_name)
+            await self.store.terminate(next_state.run_id)
+            return True
+        self.logger.info("Visited state [%s] %s out of max %s times.",
+                         state_name, next_state.visit_count + 1 if next_state else 1, visit_limit)
+        return False
+
+
+class OffloadedStateStorage(AsyncStateStorage[RunId]):
+    """
+    Adapts a synchronous `StateStorage` to `AsyncStateStorage` by running each call in `executor`
+    (default asyncio executor if None). Calls of one step may land on different threads, so the wrapped storage's
+    own step scope is not used and each call commits on its own.
+    """
+    def __init__(self, storage: StateStorage[RunId], executor: Optional[Executor] = None) -> None:
+        self.storage: StateStorage[RunId] = storage
+        self.executor = executor
+
+    async def _offload(self, func: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    async def get_last_state(self, run_id: Optional[RunId] = None) -> Optional[StateEntryT[RunId]]:
+        return await self._offload(self.storage.get_last_state, run_id)
+
+    async def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntryT[RunId]:
+        return await self._offload(self.storage.new_initial_state, params)
+
+    async def start_runs(self, params_list: List[JsonParams]) -> List[RunId]:
+        return cast(List[RunId], await self._offload(self.storage.start_runs, params_list))
+
+    async def save_state(self, state: StateEntryT[RunId]) -> None:
+        await self._offload(self.storage.save_state, state)
+
+    async def yield_state(self, state: StateEntryT[RunId], is_yielded: bool,
+                          due_at: Optional[datetime] = None) -> None:
+        # storages predating due times take two arguments
+        args = (state, is_yielded) if due_at is None else (state, is_yielded, due_at)
+        await self._offload(self.storage.yield_state, *args)
+
+    async def find_state(self, state_name: str, run_id: RunId) -> Optional[StateEntryT[RunId]]:
+        return await self._offload(self.storage.find_state, state_name, run_id)
+
+    async def terminate(self, run_id: RunId) -> None:
+        await self._offload(self.storage.terminate, run_id)
+
+    async def set_current_state(self, state_name: str, run_id: RunId, err: Optional[str], params: JsonParams,
+                                start_time: datetime, end_time: datetime) -> None:
+        await self._offload(self.storage.set_current_state, state_name, run_id, err, params, start_time, end_time)
+
+    async def get_active_runs(self, limit: Optional[int] = None) -> List[RunId]:
+        return cast(List[RunId], await self._offload(self.storage.get_active_runs, limit))
+
+    async def get_db_history(self) -> List[StateEntryT[RunId]]:
+        return await self._offload(self.storage.get_db_history)
+
+    async def iter_history(self, run_id: Optional[RunId] = None, since: Optional[datetime] = None,
+                           until: Optional[datetime] = None,
+                           batch_size: int = 1000) -> AsyncIterator[StateEntryT[RunId]]:
+        history = self.storage.iter_history(run_id, since, until, batch_size)
+        while True:
+            batch = await self._offload(lambda: list(islice(history, batch_size)))
+            for state in batch:
+                yield state
+            if len(batch) < batch_size:
+                return
+
+    async def iter_yielded_runs(self, batch_size: int = 1000) -> AsyncIterator[RunId]:
+        run_ids = self.storage.iter_yielded_runs(batch_size)
+        while True:
+            batch = await self._offload(lambda: list(islice(run_ids, batch_size)))
+            for run_id in batch:
+                yield run_id
+            if len(batch) < batch_size:
+                return
+
+    async def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[RunId, datetime]]:
+        return await self._offload(self.storage.get_due_runs, until, limit)
+
+    async def set_last_state(self, state: StateEntryT[RunId]) -> None:
+        await self._offload(self.storage.set_last_state, state)
+
+    async def archive_runs(self, finished_before: datetime, stale_before: Optional[datetime] = None,
+                           limit: int = 1000) -> int:
+        return await self._offload(self.storage.archive_runs, finished_before, stale_before, limit)
+
+    async def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                         run_ids: Optional[Sequence[RunId]] = None) -> List[RunId]:
+        return await self._offload(self.storage.claim_runs, owner, limit, lease_seconds, run_ids)
+
+    async def renew_lease(self, run_id: RunId, owner: str, lease_seconds: float) -> bool:
+        return await self._offload(self.storage.renew_lease, run_id, owner, lease_seconds)
+
+    async def release_run(self, run_id: RunId, owner: str) -> None:
+        await self._offload(self.storage.release_run, run_id, owner)
+
+    async def find_step_result(self, run_id: RunId, state_name: str, visit_count: int,
+                               params_digest: str) -> Optional[JsonParams]:
+        return await self._offload(self.storage.find_step_result, run_id, state_name, visit_count, params_digest)
+
+    async def save_step_result(self, run_id: RunId, state_name: str, visit_count: int, params_digest: str,
+                               result: JsonParams) -> None:
+        await self._offload(self.storage.save_step_result, run_id, state_name, visit_count, params_digest, result)
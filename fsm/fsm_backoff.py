@@ -0,0 +1,46 @@
+import random
+from typing import Optional
+
+
+class BackoffPolicy(object):
+    """
+    Delay before a run retries after a failed transition, given per state to `FiniteStateMachine` as
+    `retry_backoff`. The run is parked until the delay passes instead of being retried in the same `run` call.
+    """
+
+    def delay_seconds(self, attempt: int) -> float:
+        """
+        :param attempt: number of failures recorded on the state the run moves to, 1 for the first one.
+        :return: seconds to wait before the run is resumed, 0 resumes it right away.
+        """
+        raise NotImplementedError
+
+
+class ExponentialBackoff(BackoffPolicy):
+    """
+    Delay growing as `base_seconds * factor ** (attempt - 1)` up to `max_seconds`, with a random part so runs
+    failing together don't all retry at the same moment.
+    :param jitter: fraction of the delay that is random, 0 for none, 1 for a delay anywhere between 0 and
+    the exponential one.
+    :param rng: random number generator, for reproducible delays in tests.
+    """
+    def __init__(self, base_seconds: float = 1.0, factor: float = 2.0, max_seconds: float = 300.0,
+                 jitter: float = 0.5, rng: Optional[random.Random] = None) -> None:
+        if not 0 <= jitter <= 1:
+            raise ValueError("Jitter has to be between 0 and 1, got [{}].".format(jitter))
+        self.base_seconds = base_seconds
+        self.factor = factor
+        self.max_seconds = max_seconds
+        self.jitter = jitter
+        self.rng = rng if rng is not None else random.Random()
+
+    def delay_seconds(self, attempt: int) -> float:
+        try:
+            delay = min(self.max_seconds, self.base_seconds * self.factor ** max(0, attempt - 1))
+        except OverflowError:
+            delay = self.max_seconds
+        return delay * (1 - self.jitter * self.rng.random())
+
+    def __repr__(self) -> str:
+        return "<ExponentialBackoff(base_seconds={}, factor={}, max_seconds={}, jitter={})>".format(
+            self.base_seconds, self.factor, self.max_seconds, self.jitter)
@@ -0,0 +1,319 @@
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional, List, Dict, Iterator, Generic, Tuple, Sequence
+
+from fsm import TERMINAL_STATE, JsonParams
+from fsm.fsm_persistence import StateStorage, StateEntryT, RunId
+
+logger = logging.getLogger(__name__)
+
+FLUSH_PER_STEP = 'step'
+FLUSH_PER_RUN = 'run'
+FLUSH_INTERVAL = 'interval'
+
+
+class _RunCache(Generic[RunId]):
+    __slots__ = ('states', 'last_state', 'last_state_loaded')
+
+    def __init__(self) -> None:
+        # state name -> entry, None if the storage is known not to have it
+        self.states: Dict[str, Optional[StateEntryT[RunId]]] = {}
+        self.last_state: Optional[StateEntryT[RunId]] = None
+        self.last_state_loaded = False
+
+
+class BatchingStateStorage(StateStorage[RunId]):
+    """
+    Write-behind cache in front of another `StateStorage`. Reads of a run are served from memory after the first
+    lookup, writes are kept in memory and flushed to the wrapped storage in bulk with `save_states` and
+    `set_last_states`.
+    Cached runs are assumed to be advanced only through this instance: changes made to them by other processes
+    are not seen until the run is evicted from the cache.
+    Entries returned by this storage are the cached ones, change them only through storage calls.
+    :param storage: wrapped storage the writes are flushed to.
+    :param durability: when writes are flushed. `FLUSH_PER_STEP` flushes at the end of every FSM step,
+    `FLUSH_PER_RUN` when `FiniteStateMachine.run` yields or stops, `FLUSH_INTERVAL` every `interval_ms` from
+    a background thread. Unflushed writes are lost if the process dies.
+    :param interval_ms: flush period for `FLUSH_INTERVAL`.
+    :param max_batch: writes are flushed as soon as this many entries and pointers are pending, whatever
+    the durability.
+    :param max_cached_runs: least recently used runs without pending writes are evicted above this number.
+    """
+    def __init__(self, storage: StateStorage[RunId],
+                 durability: str = FLUSH_PER_RUN,
+                 interval_ms: int = 100,
+                 max_batch: int = 1000,
+                 max_cached_runs: int = 10000) -> None:
+        if durability not in (FLUSH_PER_STEP, FLUSH_PER_RUN, FLUSH_INTERVAL):
+            raise ValueError("Unknown durability [{}].".format(durability))
+        self.storage: StateStorage[RunId] = storage
+        self.durability = durability
+        self.interval_ms = interval_ms
+        self.max_batch = max_batch
+        self.max_cached_runs = max_cached_runs
+        self._runs: 'OrderedDict[RunId, _RunCache[RunId]]' = OrderedDict()
+        self._dirty_states: Dict[Tuple[RunId, str], StateEntryT[RunId]] = {}
+        self._dirty_last_states: Dict[RunId, StateEntryT[RunId]] = {}
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._closed = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+        if durability == FLUSH_INTERVAL:
+            self._flush_thread = threading.Thread(target=self._flush_periodically, name='fsm-batching-flush',
+                                                  daemon=True)
+            self._flush_thread.start()
+        super().__init__()
+
+    def close(self) -> None:
+        """Stops the background flush thread and flushes pending writes."""
+        self._closed.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+            self._flush_thread = None
+        self.flush()
+
+    def flush(self) -> None:
+        """Writes all pending entries and last state pointers to the wrapped storage in one step."""
+        with self._lock:
+            if not self._dirty_states and not self._dirty_last_states:
+                return
+            states = list(self._dirty_states.values())
+            last_states = list(self._dirty_last_states.values())
+            with self.storage.step():
+                # entries first, new ones get the IDs last state pointers refer to
+                self.storage.save_states(states)
+                self.storage.set_last_states(last_states)
+            self._dirty_states.clear()
+            self._dirty_last_states.clear()
+            self._evict()
+            logger.debug("Flushed {} states and {} last state pointers.".format(len(states), len(last_states)))
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.interval_ms / 1000):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception("Periodic flush failed, writes are kept for the next one: {}".format(e))
+
+    @contextmanager
+    def step(self) -> Iterator[None]:
+        depth = getattr(self._local, 'step_depth', 0)
+        self._local.step_depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.step_depth = depth
+        if depth == 0 and self.durability == FLUSH_PER_STEP:
+            self.flush()
+
+    @contextmanager
+    def run_scope(self) -> Iterator[None]:
+        depth = getattr(self._local, 'run_depth', 0)
+        self._local.run_depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.run_depth = depth
+        if depth == 0 and self.durability == FLUSH_PER_RUN:
+            self.flush()
+
+    def _run_cache(self, run_id: RunId) -> _RunCache[RunId]:
+        run_cache = self._runs.get(run_id)
+        if run_cache is None:
+            run_cache = self._runs[run_id] = _RunCache()
+        else:
+            self._runs.move_to_end(run_id)
+        return run_cache
+
+    def _evict(self) -> None:
+        if len(self._runs) <= self.max_cached_runs:
+            return
+        dirty_runs = set(self._dirty_last_states).union(run_id for run_id, _ in self._dirty_states)
+        for run_id in list(self._runs):
+            if len(self._runs) <= self.max_cached_runs:
+                break
+            if run_id not in dirty_runs:
+                del self._runs[run_id]
+
+    def _pending_writes(self) -> int:
+        return len(self._dirty_states) + len(self._dirty_last_states)
+
+    def _written(self) -> None:
+        if self._pending_writes() >= self.max_batch:
+            self.flush()
+        else:
+            self._evict()
+
+    def get_last_state(self, run_id: Optional[RunId] = None) -> Optional[StateEntryT[RunId]]:
+        with self._lock:
+            if run_id is None:
+                # the most recently updated run is only known to the wrapped storage
+                self.flush()
+                last_state = self.storage.get_last_state()
+                if last_state is None:
+                    return None
+                run_cache = self._run_cache(last_state.run_id)
+                if not run_cache.last_state_loaded:
+                    self._cache_last_state(run_cache, last_state)
+                return run_cache.last_state
+            run_cache = self._run_cache(run_id)
+            if not run_cache.last_state_loaded:
+                self._cache_last_state(run_cache, self.storage.get_last_state(run_id))
+            return run_cache.last_state
+
+    def _cache_last_state(self, run_cache: _RunCache[RunId], last_state: Optional[StateEntryT[RunId]]) -> None:
+        if last_state is not None:
+            # keep a single object per entry, so updates through either reference are flushed
+            cached_state = run_cache.states.get(last_state.name)
+            if cached_state is not None:
+                last_state = cached_state
+            else:
+                run_cache.states[last_state.name] = last_state
+        run_cache.last_state = last_state
+        run_cache.last_state_loaded = True
+
+    def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntryT[RunId]:
+        return self.storage.new_initial_state(params)
+
+    def start_runs(self, params_list: List[JsonParams]) -> List[RunId]:
+        # new runs have nothing cached, the wrapped storage writes them in bulk already
+        return self.storage.start_runs(params_list)
+
+    def save_state(self, state: StateEntryT[RunId]) -> None:
+        with self._lock:
+            run_cache = self._run_cache(state.run_id)
+            run_cache.states[state.name] = state
+            run_cache.last_state = state
+            run_cache.last_state_loaded = True
+            self._dirty_states[(state.run_id, state.name)] = state
+            self._dirty_last_states[state.run_id] = state
+            self._written()
+
+    def yield_state(self, state: StateEntryT[RunId], is_yielded: bool, due_at: Optional[datetime] = None) -> None:
+        state.yielded = is_yielded
+        state.due_at = due_at if is_yielded else None
+        with self._lock:
+            self._run_cache(state.run_id).states[state.name] = state
+            self._dirty_states[(state.run_id, state.name)] = state
+            self._written()
+
+    def find_state(self, state_name: str, run_id: RunId) -> Optional[StateEntryT[RunId]]:
+        with self._lock:
+            run_cache = self._run_cache(run_id)
+            if state_name not in run_cache.states:
+                run_cache.states[state_name] = self.storage.find_state(state_name, run_id)
+            return run_cache.states[state_name]
+
+    def terminate(self, run_id: RunId) -> None:
+        with self._lock:
+            state = self.storage.build_terminal_state(run_id)
+            existing_state = self.find_state(TERMINAL_STATE, run_id)
+            if existing_state is not None:
+                state.id = existing_state.id  # type: ignore
+            self.save_state(state)
+
+    def set_current_state(self, state_name: str, run_id: RunId, err: Optional[str], params: JsonParams,
+                          start_time: datetime, end_time: datetime) -> None:
+        with self._lock:
+            existing_state = self.find_state(state_name, run_id)
+            self.save_state(self.storage.build_next_state(existing_state, state_name, run_id, err, params,
+                                                          start_time, end_time))
+
+    def get_active_runs(self, limit: Optional[int] = None) -> List[RunId]:
+        with self._lock:
+            self.flush()
+            return self.storage.get_active_runs(limit)
+
+    def get_db_history(self) -> List[StateEntryT[RunId]]:
+        with self._lock:
+            self.flush()
+            return self.storage.get_db_history()
+
+    def iter_history(self, run_id: Optional[RunId] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_size: int = 1000) -> Iterator[StateEntryT[RunId]]:
+        with self._lock:
+            self.flush()
+        return self.storage.iter_history(run_id, since, until, batch_size)
+
+    def iter_yielded_runs(self, batch_size: int = 1000) -> Iterator[RunId]:
+        with self._lock:
+            self.flush()
+        return self.storage.iter_yielded_runs(batch_size)
+
+    def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[RunId, datetime]]:
+        with self._lock:
+            self.flush()
+            return self.storage.get_due_runs(until, limit)
+
+    def set_last_state(self, state: StateEntryT[RunId]) -> None:
+        with self._lock:
+            run_cache = self._run_cache(state.run_id)
+            run_cache.last_state = state
+            run_cache.last_state_loaded = True
+            self._dirty_last_states[state.run_id] = state
+            self._written()
+
+    def save_states(self, states: List[StateEntryT[RunId]]) -> None:
+        with self._lock:
+            for state in states:
+                run_cache = self._run_cache(state.run_id)
+                run_cache.states[state.name] = state
+                self._dirty_states[(state.run_id, state.name)] = state
+            self._written()
+
+    def set_last_states(self, states: List[StateEntryT[RunId]]) -> None:
+        with self._lock:
+            for state in states:
+                self.set_last_state(state)
+
+    def archive_runs(self, finished_before: datetime, stale_before: Optional[datetime] = None,
+                     limit: int = 1000) -> int:
+        archived_run_ids: List[RunId] = []
+
+        def on_state_written(run_id: RunId, state: Optional[StateEntryT[RunId]]) -> None:
+            if state is None:
+                archived_run_ids.append(run_id)
+
+        with self._lock:
+            self.flush()
+            self.storage.add_state_listener(on_state_written)
+            try:
+                archived = self.storage.archive_runs(finished_before, stale_before, limit)
+            finally:
+                self.storage.remove_state_listener(on_state_written)
+            for run_id in archived_run_ids:
+                self._runs.pop(run_id, None)
+            self._runs_archived(archived_run_ids)
+            return archived
+
+    def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                   run_ids: Optional[Sequence[RunId]] = None) -> List[RunId]:
+        with self._lock:
+            self.flush()
+            claimed_run_ids = self.storage.claim_runs(owner, limit, lease_seconds, run_ids)
+            # cached entries may be stale, another worker could have advanced the runs since they were cached
+            for run_id in claimed_run_ids:
+                self._runs.pop(run_id, None)
+            self._runs_claimed(claimed_run_ids)
+            return claimed_run_ids
+
+    def renew_lease(self, run_id: RunId, owner: str, lease_seconds: float) -> bool:
+        return self.storage.renew_lease(run_id, owner, lease_seconds)
+
+    def release_run(self, run_id: RunId, owner: str) -> None:
+        # writes of the run have to be visible before another worker can claim it
+        with self._lock:
+            self.flush()
+        self.storage.release_run(run_id, owner)
+
+    def find_step_result(self, run_id: RunId, state_name: str, visit_count: int,
+                         params_digest: str) -> Optional[JsonParams]:
+        return self.storage.find_step_result(run_id, state_name, visit_count, params_digest)
+
+    def save_step_result(self, run_id: RunId, state_name: str, visit_count: int, params_digest: str,
+                         result: JsonParams) -> None:
+        # written through, the result has to outlive a crash before the next flush
+        self.storage.save_step_result(run_id, state_name, visit_count, params_digest, result)
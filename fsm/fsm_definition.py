@@ -0,0 +1,169 @@
+import logging
+import sys
+from collections import deque
+from typing import Dict, Optional, Tuple, List, Union, Mapping
+
+from fsm import INITIAL_STATE, TERMINAL_STATE, DEFAULT, StateDefinition, TransitionAction
+from fsm.fsm_backoff import BackoffPolicy
+from fsm.fsm_execution import ExecutionPolicy
+from fsm.fsm_memo import StepMemo
+
+logger = logging.getLogger(__name__)
+
+
+class DefinitionError(ValueError):
+    """Raised by `compile_definition` for a definition that can't be run."""
+    pass
+
+
+class StateTransition(object):
+    """
+    One compiled state of a definition. States are referred to by their integer `id`, `success_id` and
+    `failure_id` are None for targets missing from the definition. `backoff` delays the retry after a failed
+    action, None retries right away. `execution` runs the action, None calls it inline. An action running longer
+    than `timeout_seconds` fails the transition, None waits for it. `memo` records results of the action, None
+    runs it on every step.
+    """
+    __slots__ = ('id', 'name', 'action', 'success', 'failure', 'success_id', 'failure_id', 'continue_run',
+                 'max_visits', 'backoff', 'execution', 'timeout_seconds', 'memo')
+
+    def __init__(self, state_id: int, name: str, action: Optional[TransitionAction], success: str, failure: str,
+                 success_id: Optional[int], failure_id: Optional[int], continue_run: bool, max_visits: int,
+                 backoff: Optional[BackoffPolicy] = None, execution: Optional[ExecutionPolicy] = None,
+                 timeout_seconds: Optional[float] = None, memo: Optional[StepMemo] = None) -> None:
+        self.id = state_id
+        self.name = name
+        self.action = action
+        self.success = success
+        self.failure = failure
+        self.success_id = success_id
+        self.failure_id = failure_id
+        self.continue_run = continue_run
+        self.max_visits = max_visits
+        self.backoff = backoff
+        self.execution = execution
+        self.timeout_seconds = timeout_seconds
+        self.memo = memo
+
+    def __setattr__(self, key: str, value: object) -> None:
+        if hasattr(self, key):
+            raise AttributeError("Compiled state [{}] is immutable.".format(self.name))
+        object.__setattr__(self, key, value)
+
+    def __repr__(self) -> str:
+        return "<StateTransition(id={}, name='{}', success='{}', failure='{}', continue_run={})>".format(
+            self.id, self.name, self.success, self.failure, self.continue_run)
+
+
+class CompiledDefinition(object):
+    """
+    Immutable transition table built from a `StateDefinition` by `compile_definition`.
+    States are stored in a tuple indexed by their integer ID, names are interned and mapped to IDs once.
+    """
+    __slots__ = ('states', 'ids', 'max_visits', 'unreachable_states', 'source')
+    states: Tuple[StateTransition, ...]
+    ids: Dict[str, int]
+    max_visits: Dict[str, int]
+    unreachable_states: Tuple[str, ...]
+    source: StateDefinition
+
+    def __init__(self, states: Tuple[StateTransition, ...], max_visits: Dict[str, int],
+                 unreachable_states: Tuple[str, ...], source: StateDefinition) -> None:
+        object.__setattr__(self, 'states', states)
+        object.__setattr__(self, 'ids', {state.name: state.id for state in states})
+        object.__setattr__(self, 'max_visits', max_visits)
+        object.__setattr__(self, 'unreachable_states', unreachable_states)
+        object.__setattr__(self, 'source', source)
+
+    def __setattr__(self, key: str, value: object) -> None:
+        raise AttributeError("Compiled definition is immutable.")
+
+    def __getitem__(self, state_name: str) -> StateTransition:
+        """Compiled state by name, raises `KeyError` for a state missing from the definition like a dict would."""
+        return self.states[self.ids[state_name]]
+
+    def __contains__(self, state_name: object) -> bool:
+        return state_name in self.ids
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def visit_limit(self, state_name: str, state_id: Optional[int] = None) -> int:
+        """
+        Maximum visits of a state, also for states missing from the definition.
+        :param state_id: ID of the state if the caller has it, e.g. a `success_id`, skips looking the name up.
+        """
+        if state_id is None:
+            state_id = self.ids.get(state_name)
+        if state_id is not None:
+            return self.states[state_id].max_visits
+        return self.max_visits.get(state_name, self.max_visits[DEFAULT])
+
+
+def compile_definition(state_transitions: Union[StateDefinition, CompiledDefinition],
+                       max_state_visits: Mapping[str, int] = {DEFAULT: 1},
+                       validate: bool = True,
+                       retry_backoff: Mapping[str, BackoffPolicy] = {},
+                       execution_policies: Mapping[str, ExecutionPolicy] = {},
+                       state_timeouts: Mapping[str, float] = {},
+                       memoize: Mapping[str, StepMemo] = {}) -> CompiledDefinition:
+    """
+    Compiles a definition into a `CompiledDefinition`. An already compiled definition is returned as is,
+    with the visit limits, policies and timeouts it was compiled with.
+    :param state_transitions: FSM definition, same as for `FiniteStateMachine`.
+    :param max_state_visits: same as for `FiniteStateMachine`, resolved per state at compile time.
+    :param validate: raise `DefinitionError` if the initial state or a success/failure target is missing.
+    Without it missing states surface at runtime as `KeyError` once a run gets there.
+    States unreachable from the initial state are logged and listed in `unreachable_states` either way.
+    :param retry_backoff: same as for `FiniteStateMachine`, resolved per state at compile time.
+    :param execution_policies: same as for `FiniteStateMachine`, resolved per state at compile time.
+    :param state_timeouts: same as for `FiniteStateMachine`, resolved per state at compile time.
+    :param memoize: same as for `FiniteStateMachine`, resolved per state at compile time.
+    """
+    if isinstance(state_transitions, CompiledDefinition):
+        return state_transitions
+    max_visits = dict(max_state_visits)
+    max_visits[DEFAULT] = max_visits.get(DEFAULT, 1)
+    names = [sys.intern(name) for name in state_transitions]
+    ids = {name: state_id for state_id, name in enumerate(names)}
+    states = []
+    missing: List[str] = []
+    for state_id, name in enumerate(names):
+        action, success, failure, continue_run = state_transitions[name]
+        if action is not None:
+            missing.extend("[{}] -> [{}]".format(name, target) for target in (success, failure)
+                           if target is not None and target not in ids)
+        states.append(StateTransition(state_id, name, action,
+                                      sys.intern(success) if success is not None else success,
+                                      sys.intern(failure) if failure is not None else failure,
+                                      ids.get(success) if success is not None else None,
+                                      ids.get(failure) if failure is not None else None,
+                                      continue_run, max_visits.get(name, max_visits[DEFAULT]),
+                                      retry_backoff.get(name, retry_backoff.get(DEFAULT)),
+                                      execution_policies.get(name, execution_policies.get(DEFAULT)),
+                                      state_timeouts.get(name, state_timeouts.get(DEFAULT)),
+                                      memoize.get(name, memoize.get(DEFAULT))))
+    if validate:
+        if INITIAL_STATE not in ids:
+            raise DefinitionError("Definition has no [{}].".format(INITIAL_STATE))
+        if missing:
+            raise DefinitionError("Transitions to states missing from the definition: {}.".format(", ".join(missing)))
+    unreachable_states = _find_unreachable_states(states, ids.get(INITIAL_STATE))
+    if unreachable_states:
+        logger.warning("States unreachable from [{}]: {}.".format(INITIAL_STATE, ", ".join(unreachable_states)))
+    return CompiledDefinition(tuple(states), max_visits, unreachable_states, state_transitions)
+
+
+def _find_unreachable_states(states: List[StateTransition], initial_id: Optional[int]) -> Tuple[str, ...]:
+    reachable = set()
+    pending = deque([initial_id] if initial_id is not None else [])
+    while pending:
+        state_id = pending.popleft()
+        if state_id in reachable:
+            continue
+        reachable.add(state_id)
+        state = states[state_id]
+        if state.action is not None:
+            pending.extend(target for target in (state.success_id, state.failure_id) if target is not None)
+    # runs enter the terminal state when they run out of visits, even without transitions to it
+    return tuple(state.name for state in states if state.id not in reachable and state.name != TERMINAL_STATE)
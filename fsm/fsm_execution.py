@@ -0,0 +1,265 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Optional, Tuple, Callable
+
+from fsm import JsonParams, TransitionAction
+
+
+def timeout_error(action: Callable[..., Any], timeout_seconds: Optional[float]) -> TimeoutError:
+    """Error a transition fails with when its action doesn't finish within the timeout of the state."""
+    return TimeoutError("Action [{}] didn't finish in {} seconds.".format(getattr(action, '__name__', action),
+                                                                          timeout_seconds))
+
+
+class ExecutionPolicy(object):
+    """
+    Where the transition action of a state runs, given per state to `FiniteStateMachine` as `execution_policies`.
+    Exceptions raised by the action or by the policy, e.g. a `TimeoutError`, are mapped to a failed transition
+    the same way as exceptions of an action called inline.
+    """
+
+    def call(self, action: TransitionAction, params: JsonParams, timeout_seconds: Optional[float] = None) -> Any:
+        """
+        Runs the action with the params and returns its raw result.
+        :param timeout_seconds: timeout of the state, overrides the timeout of the policy.
+        """
+        raise NotImplementedError
+
+    async def call_async(self, action: TransitionAction, params: JsonParams,
+                         timeout_seconds: Optional[float] = None) -> Any:
+        """Same as `call` for `AsyncFiniteStateMachine`."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Shuts down workers of the policy, a closed policy starts new ones when it's used again."""
+        pass
+
+
+def start_abandonable(action: TransitionAction, params: JsonParams,
+                      slots: Optional[threading.Semaphore] = None) -> Tuple[Future[Any], Callable[[], None]]:
+    """
+    Starts the action on a daemon thread of its own, so it can be abandoned if it doesn't finish in time and
+    doesn't keep the interpreter from exiting.
+    :param slots: semaphore the caller acquired for the action, released once.
+    :return: future of the action's result, and the function releasing the slot, called when the action finishes
+    or by the caller abandoning it, whichever is first.
+    """
+    future: Future[Any] = Future()
+    released = threading.Event()
+    release_lock = threading.Lock()
+
+    def release() -> None:
+        with release_lock:
+            if released.is_set():
+                return
+            released.set()
+        if slots is not None:
+            slots.release()
+
+    def run() -> None:
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(action(params))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            release()
+
+    threading.Thread(target=run, name='fsm-action', daemon=True).start()
+    return future, release
+
+
+def call_abandonable(action: TransitionAction, params: JsonParams, timeout_seconds: Optional[float],
+                     slots: Optional[threading.Semaphore] = None) -> Any:
+    """
+    Runs the action with `start_abandonable` and waits for it, raises `timeout_error` once it's abandoned.
+    :param slots: semaphore bounding concurrent actions, an abandoned action no longer takes one of its slots.
+    """
+    if slots is not None:
+        slots.acquire()
+    future, release = start_abandonable(action, params, slots)
+    try:
+        return future.result(timeout_seconds)
+    except FutureTimeoutError:
+        release()
+        raise timeout_error(action, timeout_seconds)
+
+
+async def call_abandonable_async(action: TransitionAction, params: JsonParams, timeout_seconds: Optional[float],
+                                 slots: Optional[threading.Semaphore] = None) -> Any:
+    """Same as `call_abandonable` without blocking the event loop, no executor thread waits for the action."""
+    if slots is not None and not slots.acquire(blocking=False):
+        await asyncio.get_running_loop().run_in_executor(None, slots.acquire)
+    future, release = start_abandonable(action, params, slots)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout_seconds)
+    except asyncio.TimeoutError:
+        release()
+        raise timeout_error(action, timeout_seconds)
+
+
+class InlineExecution(ExecutionPolicy):
+    """
+    Runs the action in the thread advancing the run, same as without a policy. Under `AsyncFiniteStateMachine`
+    regular functions then run on the event loop, use it for cheap actions only.
+    A function can't be interrupted, so with a timeout it's run on a daemon thread of its own instead and
+    abandoned if it doesn't finish in time. Coroutines are cancelled.
+    """
+
+    def call(self, action: TransitionAction, params: JsonParams, timeout_seconds: Optional[float] = None) -> Any:
+        if timeout_seconds is None:
+            return action(params)
+        return call_abandonable(action, params, timeout_seconds)
+
+    async def call_async(self, action: TransitionAction, params: JsonParams,
+                         timeout_seconds: Optional[float] = None) -> Any:
+        if not asyncio.iscoroutinefunction(action):
+            if timeout_seconds is None:
+                return action(params)
+            return await call_abandonable_async(action, params, timeout_seconds)
+        try:
+            return await asyncio.wait_for(action(params), timeout_seconds)
+        except asyncio.TimeoutError:
+            raise timeout_error(action, timeout_seconds)
+
+    def __repr__(self) -> str:
+        return "<InlineExecution()>"
+
+
+class _PoolExecution(ExecutionPolicy):
+    def __init__(self, max_workers: int, timeout_seconds: Optional[float],
+                 max_tasks_per_worker: Optional[int]) -> None:
+        self.max_workers = max_workers
+        self.timeout_seconds = timeout_seconds
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self._lock = threading.Lock()
+        self._pool: Optional[Executor] = None
+        self._submitted = 0
+
+    def _new_pool(self) -> Executor:
+        raise NotImplementedError
+
+    def submit(self, action: TransitionAction, params: JsonParams) -> Future[Any]:
+        """Submits the action to the pool, the pool is replaced once it ran `max_tasks_per_worker` per worker."""
+        return self._submit(action, params)[1]
+
+    def _submit(self, action: TransitionAction, params: JsonParams) -> Tuple[Executor, Future[Any]]:
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._new_pool()
+                self._submitted = 0
+            pool = self._pool
+            future = pool.submit(action, params)
+            self._submitted += 1
+            if self.max_tasks_per_worker is not None \
+                    and self._submitted >= self.max_tasks_per_worker * self.max_workers:
+                # tasks already submitted still finish, workers exit after them
+                self._pool = None
+                pool.shutdown(wait=False)
+        return pool, future
+
+    def call(self, action: TransitionAction, params: JsonParams, timeout_seconds: Optional[float] = None) -> Any:
+        timeout_seconds = timeout_seconds if timeout_seconds is not None else self.timeout_seconds
+        pool, future = self._submit(action, params)
+        try:
+            return future.result(timeout_seconds)
+        except FutureTimeoutError:
+            self._timed_out(pool, future)
+            raise timeout_error(action, timeout_seconds)
+
+    async def call_async(self, action: TransitionAction, params: JsonParams,
+                         timeout_seconds: Optional[float] = None) -> Any:
+        timeout_seconds = timeout_seconds if timeout_seconds is not None else self.timeout_seconds
+        pool, future = self._submit(action, params)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout_seconds)
+        except asyncio.TimeoutError:
+            self._timed_out(pool, future)
+            raise timeout_error(action, timeout_seconds)
+
+    def _timed_out(self, pool: Executor, future: Future[Any]) -> None:
+        future.cancel()
+
+    def close(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+class ThreadExecution(_PoolExecution):
+    """
+    Runs the action on a thread pool shared by all runs of the state, e.g. to bound the concurrency of calls to
+    a rate limited service. A thread can't be interrupted, so actions with a timeout of the policy or of their
+    state run on daemon threads of their own instead, at most `max_workers` at a time. An action that times out
+    fails the transition and is abandoned, it no longer takes one of the `max_workers` slots.
+    :param max_workers: number of threads.
+    :param timeout_seconds: the transition fails with a `TimeoutError` if the action takes longer, None waits.
+    :param max_tasks_per_worker: the pool is replaced by a new one after this many actions per thread,
+    None keeps it.
+    """
+    def __init__(self, max_workers: int = 4, timeout_seconds: Optional[float] = None,
+                 max_tasks_per_worker: Optional[int] = None) -> None:
+        super().__init__(max_workers, timeout_seconds, max_tasks_per_worker)
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def call(self, action: TransitionAction, params: JsonParams, timeout_seconds: Optional[float] = None) -> Any:
+        timeout_seconds = timeout_seconds if timeout_seconds is not None else self.timeout_seconds
+        if timeout_seconds is None:
+            return super().call(action, params)
+        return call_abandonable(action, params, timeout_seconds, self._slots)
+
+    async def call_async(self, action: TransitionAction, params: JsonParams,
+                         timeout_seconds: Optional[float] = None) -> Any:
+        timeout_seconds = timeout_seconds if timeout_seconds is not None else self.timeout_seconds
+        if timeout_seconds is None:
+            return await super().call_async(action, params)
+        return await call_abandonable_async(action, params, timeout_seconds, self._slots)
+
+    def _new_pool(self) -> Executor:
+        return ThreadPoolExecutor(self.max_workers, thread_name_prefix='fsm-action')
+
+    def __repr__(self) -> str:
+        return "<ThreadExecution(max_workers={}, timeout_seconds={})>".format(self.max_workers, self.timeout_seconds)
+
+
+class ProcessExecution(_PoolExecution):
+    """
+    Runs the action on a process pool, so CPU bound actions don't hold the GIL of the process advancing runs.
+    The action and params are pickled to a worker and the result is pickled back, actions have to be module
+    level functions and params and results picklable. A timed out action fails the transition and the workers of
+    its pool are terminated, the pool is replaced by a new one. Other actions running in that pool at the time
+    fail with `BrokenProcessPool` and are retried like any failed action.
+    :param max_workers: number of processes, defaults to the number of CPUs.
+    :param timeout_seconds: the transition fails with a `TimeoutError` if the action takes longer, None waits.
+    :param max_tasks_per_worker: the pool is replaced by a new one after this many actions per process, so
+    workers leaking memory are recycled. None keeps it.
+    :param mp_context: multiprocessing context of the workers, e.g. `multiprocessing.get_context('spawn')`.
+    """
+    def __init__(self, max_workers: Optional[int] = None, timeout_seconds: Optional[float] = None,
+                 max_tasks_per_worker: Optional[int] = None, mp_context: Optional[Any] = None) -> None:
+        super().__init__(max_workers or os.cpu_count() or 1, timeout_seconds, max_tasks_per_worker)
+        self.mp_context = mp_context
+
+    def _new_pool(self) -> Executor:
+        return ProcessPoolExecutor(self.max_workers, mp_context=self.mp_context)
+
+    def _timed_out(self, pool: Executor, future: Future[Any]) -> None:
+        if future.cancel():
+            return
+        # the action is running and can't be interrupted, so is the process running it
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        processes = list((getattr(pool, '_processes', None) or {}).values())
+        pool.shutdown(wait=False)
+        for process in processes:
+            process.terminate()
+
+    def __repr__(self) -> str:
+        return "<ProcessExecution(max_workers={}, timeout_seconds={})>".format(self.max_workers,
+                                                                              self.timeout_seconds)
@@ -0,0 +1,139 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, Optional, Iterable, NamedTuple, Generic, Union, Callable, Set, Sequence
+
+from fsm import DEFAULT, StateDefinition
+from fsm.fsm import FiniteStateMachine
+from fsm.fsm_definition import CompiledDefinition
+from fsm.fsm_instrumentation import FsmInstrumentation
+from fsm.fsm_persistence import StateStorage, RunId
+from fsm.logging_conf.logging import get_child_logger
+
+
+class ExecutorReport(NamedTuple):
+    runs: int
+    failed: int
+    elapsed_seconds: float
+
+    @property
+    def runs_per_second(self) -> float:
+        return self.runs / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+
+class FsmExecutor(Generic[RunId]):
+    """
+    Advances many runs of a single FSM definition concurrently on a thread pool. Every thread keeps its own run
+    context, the definition and storage are shared.
+    Pass IDs of existing runs: concurrent `None` run IDs would all race for the most recently updated run.
+    :param state_storage: storage shared by all runs, it has to be safe to use from several threads.
+    :param state_transitions: FSM definition, same as for `FiniteStateMachine`.
+    :param max_state_visits: same as for `FiniteStateMachine`.
+    :param workers: number of threads advancing runs.
+    :param max_in_flight: maximum number of runs submitted to the pool at once, defaults to twice the workers.
+    This keeps memory bounded when `run_many` is given a long or lazy sequence of run IDs.
+    :param quiet: same as for `FiniteStateMachine`.
+    :param instrumentation: same as for `FiniteStateMachine`, called from all worker threads.
+    :param owner: name this executor leases runs under in `run_claimed`, unique per executor by default.
+    """
+    def __init__(self, state_storage: StateStorage[RunId],
+                 state_transitions: Union[StateDefinition, CompiledDefinition],
+                 max_state_visits: Dict[str, int] = {DEFAULT: 1},
+                 workers: int = 8,
+                 max_in_flight: Optional[int] = None,
+                 log_extra: Dict[str, Any] = {},
+                 quiet: bool = False,
+                 instrumentation: Optional[FsmInstrumentation] = None,
+                 owner: Optional[str] = None) -> None:
+        self.fsm: FiniteStateMachine[RunId] = FiniteStateMachine(state_storage, state_transitions,
+                                                                 max_state_visits, log_extra, quiet,
+                                                                 instrumentation)
+        self.workers = workers
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 2 * workers
+        self.owner = owner if owner is not None else "{}:{}:{}".format(socket.gethostname(), os.getpid(),
+                                                                       uuid.uuid4().hex[:8])
+        self.logger = get_child_logger("", "fsm_executor", log_extra)
+
+    def run_many(self, run_ids: Iterable[Optional[RunId]]) -> ExecutorReport:
+        """
+        Runs every run until it yields or terminates, same as `FiniteStateMachine.run`. A run that raises is
+        logged and counted as failed, it doesn't stop other runs.
+        :return: aggregate counts and throughput of this call.
+        """
+        return self._advance(run_ids, self.fsm.run)
+
+    def run_claimed(self, limit: Optional[int] = None, lease_seconds: float = 300,
+                    run_ids: Optional[Sequence[RunId]] = None) -> ExecutorReport:
+        """
+        Claims up to `limit` runs with `StateStorage.claim_runs` and advances them like `run_many`. Each run is
+        released as soon as it yields or stops, leases of runs still in progress are renewed every third of
+        `lease_seconds`. Executors of any number of processes can call this in a loop on a shared storage,
+        a run is advanced by one of them at a time.
+        :param limit: maximum number of claimed runs, defaults to `max_in_flight`, or to all `run_ids`.
+        :param lease_seconds: see `StateStorage.claim_runs`.
+        :param run_ids: claim and advance only these runs, runs leased by another worker are skipped.
+        :return: aggregate counts and throughput of this call, no runs if nothing was claimed.
+        """
+        store = self.fsm.store
+        if limit is None:
+            limit = len(run_ids) if run_ids is not None else self.max_in_flight
+        claimed_run_ids = store.claim_runs(self.owner, limit, lease_seconds, run_ids)
+        if not claimed_run_ids:
+            return ExecutorReport(0, 0, 0.0)
+        leased_lock = threading.Lock()
+        leased: Set[RunId] = set(claimed_run_ids)
+        done = threading.Event()
+
+        def renew_leases() -> None:
+            while not done.wait(lease_seconds / 3):
+                with leased_lock:
+                    held = list(leased)
+                for run_id in held:
+                    try:
+                        if not store.renew_lease(run_id, self.owner, lease_seconds):
+                            self.logger.warning("Lease of run [{}] was lost, another worker may advance it "
+                                                "concurrently.".format(run_id))
+                    except Exception as e:
+                        self.logger.error("Renewing lease of run [{}] failed with: {}".format(run_id, e))
+
+        def run_and_release(run_id: RunId) -> None:
+            try:
+                self.fsm.run(run_id)
+            finally:
+                with leased_lock:
+                    leased.discard(run_id)
+                store.release_run(run_id, self.owner)
+
+        renewer = threading.Thread(target=renew_leases, name='fsm-lease-renewer', daemon=True)
+        renewer.start()
+        try:
+            return self._advance(claimed_run_ids, run_and_release)
+        finally:
+            done.set()
+            renewer.join()
+
+    def _advance(self, run_ids: Iterable[Optional[RunId]], run: Callable[[Any], Any]) -> ExecutorReport:
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        counts_lock = threading.Lock()
+        counts = {'runs': 0, 'failed': 0}
+
+        def on_done(future: Future[Any]) -> None:
+            with counts_lock:
+                counts['runs'] += 1
+                if future.exception() is not None:
+                    counts['failed'] += 1
+                    self.logger.error("Run failed with: {}".format(future.exception()))
+            in_flight.release()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='fsm-executor') as pool:
+            for run_id in run_ids:
+                in_flight.acquire()
+                pool.submit(run, run_id).add_done_callback(on_done)
+        report = ExecutorReport(counts['runs'], counts['failed'], time.perf_counter() - started)
+        self.logger.info("Advanced {} runs ({} failed) in {:.3f}s, {:.1f} runs/s.".format(
+            report.runs, report.failed, report.elapsed_seconds, report.runs_per_second))
+        return report
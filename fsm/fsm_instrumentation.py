@@ -0,0 +1,325 @@
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter_ns
+from typing import Optional, List, Dict, Iterator, Callable, TypeVar, Any, ContextManager, Tuple, \
+    Sequence
+
+from fsm import JsonParams
+from fsm.fsm_persistence import StateStorage, StateEntryT, RunId, StateListener
+
+T = TypeVar('T')
+
+PERCENTILES = (0.5, 0.95, 0.99)
+
+# upper bounds of histogram buckets in nanoseconds, doubling from 1 us to ~137 s
+_BUCKET_BOUNDS_NS = tuple(1000 * 2 ** i for i in range(28))
+
+
+class FsmInstrumentation(object):
+    """
+    Hooks called by `FiniteStateMachine` given as its `instrumentation`. Durations are in nanoseconds measured
+    with `time.perf_counter_ns`. Hooks are called from every thread advancing runs and must not raise.
+    All hooks do nothing by default, override the ones you need.
+    """
+
+    def on_step_start(self, run_id: Optional[RunId]) -> None:
+        """A step of a run begins, `run_id` is None when the step starts a new run."""
+        pass
+
+    def on_step_done(self, run_id: Optional[RunId], duration_ns: int) -> None:
+        """A step ended, the duration includes the action, all storage calls and the commit."""
+        pass
+
+    def on_action_done(self, run_id: RunId, state_name: str, succeeded: bool, duration_ns: int) -> None:
+        """The transition action of state `state_name` returned or raised."""
+        pass
+
+    def on_storage_call(self, method: str, duration_ns: int) -> None:
+        """A storage call made by the FSM returned. Scopes are reported as `step` and `run_scope`, their duration
+        is the time spent entering and leaving the scope, e.g. committing, not the time spent inside it."""
+        pass
+
+
+class _Histogram(object):
+    __slots__ = ('buckets', 'count', 'sum_ns', 'min_ns', 'max_ns')
+
+    def __init__(self) -> None:
+        # one counter per bound plus the overflow bucket
+        self.buckets = [0] * (len(_BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.sum_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+
+    def observe(self, duration_ns: int) -> None:
+        self.buckets[bisect_left(_BUCKET_BOUNDS_NS, duration_ns)] += 1
+        if self.count == 0 or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+        self.count += 1
+        self.sum_ns += duration_ns
+
+    def percentile_ns(self, q: float) -> float:
+        """Estimated by linear interpolation inside the bucket of the percentile, within observed min and max."""
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.buckets):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = max(_BUCKET_BOUNDS_NS[i - 1] if i > 0 else 0, self.min_ns)
+                upper = min(_BUCKET_BOUNDS_NS[i] if i < len(_BUCKET_BOUNDS_NS) else self.max_ns, self.max_ns)
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return float(self.max_ns)
+
+
+class HistogramCollector(FsmInstrumentation):
+    """
+    In-process latency histograms of FSM steps, of actions per state and of storage calls per method.
+    Compare `action` and `storage` percentiles to tell whether time goes to the actions or to the database.
+    Memory is bounded by the number of states and storage methods, not by the number of steps.
+    """
+    KINDS = ('step', 'action', 'storage')
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Dict[str, _Histogram]] = {kind: {} for kind in self.KINDS}
+
+    def _observe(self, kind: str, key: str, duration_ns: int) -> None:
+        with self._lock:
+            histogram = self._histograms[kind].get(key)
+            if histogram is None:
+                histogram = self._histograms[kind][key] = _Histogram()
+            histogram.observe(duration_ns)
+
+    def on_step_done(self, run_id: Optional[RunId], duration_ns: int) -> None:
+        self._observe('step', '', duration_ns)
+
+    def on_action_done(self, run_id: RunId, state_name: str, succeeded: bool, duration_ns: int) -> None:
+        self._observe('action', state_name, duration_ns)
+
+    def on_storage_call(self, method: str, duration_ns: int) -> None:
+        self._observe('storage', method, duration_ns)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms = {kind: {} for kind in self.KINDS}
+
+    def percentile(self, kind: str, key: str, q: float) -> Optional[float]:
+        """
+        Estimated percentile in seconds, None if nothing was observed.
+        :param kind: `step`, `action` or `storage`.
+        :param key: state name for `action`, storage method for `storage`, empty for `step`.
+        :param q: between 0 and 1, e.g. 0.95.
+        """
+        with self._lock:
+            histogram = self._histograms[kind].get(key)
+            if histogram is None or histogram.count == 0:
+                return None
+            return histogram.percentile_ns(q) / 1e9
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """Count, total and p50/p95/p99 in seconds per kind and key, e.g. `summary()['action']['NEXT']['p95']`."""
+        with self._lock:
+            result: Dict[str, Dict[str, Dict[str, float]]] = {}
+            for kind, histograms in self._histograms.items():
+                result[kind] = {}
+                for key, histogram in histograms.items():
+                    stats = {'count': float(histogram.count), 'sum': histogram.sum_ns / 1e9}
+                    for q in PERCENTILES:
+                        stats['p{}'.format(int(q * 100))] = histogram.percentile_ns(q) / 1e9
+                    result[kind][key] = stats
+            return result
+
+    def to_prometheus(self, prefix: str = 'fsm') -> str:
+        """Histograms in the Prometheus text exposition format, serve it from a `/metrics` endpoint."""
+        families = (('step', 'step_duration_seconds', None, 'Duration of FSM steps.'),
+                    ('action', 'action_duration_seconds', 'state', 'Duration of transition actions per state.'),
+                    ('storage', 'storage_call_duration_seconds', 'method', 'Duration of storage calls per method.'))
+        lines: List[str] = []
+        with self._lock:
+            for kind, name, label, description in families:
+                metric = '{}_{}'.format(prefix, name)
+                lines.append('# HELP {} {}'.format(metric, description))
+                lines.append('# TYPE {} histogram'.format(metric))
+                for key, histogram in sorted(self._histograms[kind].items()):
+                    labels = '{}="{}"'.format(label, _escape_label(key)) if label else ''
+                    cumulative = 0
+                    for bound, bucket_count in zip(_BUCKET_BOUNDS_NS, histogram.buckets):
+                        cumulative += bucket_count
+                        lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                            metric, labels + ',' if labels else '', _format_seconds(bound), cumulative))
+                    lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(metric, labels + ',' if labels else '',
+                                                                       histogram.count))
+                    suffix = '{{{}}}'.format(labels) if labels else ''
+                    lines.append('{}_sum{} {}'.format(metric, suffix, _format_seconds(histogram.sum_ns)))
+                    lines.append('{}_count{} {}'.format(metric, suffix, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_seconds(duration_ns: int) -> str:
+    return repr(duration_ns / 1e9)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class InstrumentedStateStorage(StateStorage[RunId]):
+    """
+    Reports the duration of every call to the wrapped storage with `FsmInstrumentation.on_storage_call`.
+    `FiniteStateMachine` wraps its storage in this when given an `instrumentation`. State listeners are
+    registered on the wrapped storage, which is the one notifying them.
+    """
+    def __init__(self, storage: StateStorage[RunId], instrumentation: FsmInstrumentation) -> None:
+        super().__init__()
+        self.storage: StateStorage[RunId] = storage
+        self.instrumentation = instrumentation
+
+    def _timed(self, method: str, func: Callable[..., T], *args: Any) -> T:
+        started = perf_counter_ns()
+        try:
+            return func(*args)
+        finally:
+            self.instrumentation.on_storage_call(method, perf_counter_ns() - started)
+
+    def _timed_pages(self, method: str, func: Callable[..., Iterator[T]], batch_size: int, *args: Any) -> Iterator[T]:
+        """Yields items of a paged iterator, time spent fetching each page of `batch_size` items is one call."""
+        started = perf_counter_ns()
+        items = func(*args, batch_size)
+        elapsed, fetched = perf_counter_ns() - started, 0
+        while True:
+            started = perf_counter_ns()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.instrumentation.on_storage_call(method, elapsed + perf_counter_ns() - started)
+                return
+            elapsed, fetched = elapsed + perf_counter_ns() - started, fetched + 1
+            if fetched == batch_size:
+                self.instrumentation.on_storage_call(method, elapsed)
+                elapsed, fetched = 0, 0
+            yield item
+
+    @contextmanager
+    def _timed_scope(self, method: str, scope: ContextManager[None]) -> Iterator[None]:
+        started = perf_counter_ns()
+        with scope:
+            entered = perf_counter_ns()
+            try:
+                yield
+            finally:
+                left = perf_counter_ns()
+        self.instrumentation.on_storage_call(method, entered - started + perf_counter_ns() - left)
+
+    def add_state_listener(self, listener: StateListener[RunId]) -> None:
+        self.storage.add_state_listener(listener)
+
+    def remove_state_listener(self, listener: StateListener[RunId]) -> None:
+        self.storage.remove_state_listener(listener)
+
+    def invalidate(self, run_id: RunId) -> None:
+        self.storage.invalidate(run_id)
+
+    @contextmanager
+    def step(self) -> Iterator[None]:
+        with self._timed_scope('step', self.storage.step()):
+            yield
+
+    @contextmanager
+    def run_scope(self) -> Iterator[None]:
+        with self._timed_scope('run_scope', self.storage.run_scope()):
+            yield
+
+    def get_last_state(self, run_id: Optional[RunId] = None) -> Optional[StateEntryT[RunId]]:
+        return self._timed('get_last_state', self.storage.get_last_state, run_id)
+
+    def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntryT[RunId]:
+        return self._timed('new_initial_state', self.storage.new_initial_state, params)
+
+    def start_runs(self, params_list: List[JsonParams]) -> List[RunId]:
+        return self._timed('start_runs', self.storage.start_runs, params_list)
+
+    def save_state(self, state: StateEntryT[RunId]) -> None:
+        self._timed('save_state', self.storage.save_state, state)
+
+    def yield_state(self, state: StateEntryT[RunId], is_yielded: bool, due_at: Optional[datetime] = None) -> None:
+        # storages predating due times take two arguments
+        args = (state, is_yielded) if due_at is None else (state, is_yielded, due_at)
+        self._timed('yield_state', self.storage.yield_state, *args)
+
+    def find_state(self, state_name: str, run_id: RunId) -> Optional[StateEntryT[RunId]]:
+        return self._timed('find_state', self.storage.find_state, state_name, run_id)
+
+    def terminate(self, run_id: RunId) -> None:
+        self._timed('terminate', self.storage.terminate, run_id)
+
+    def set_current_state(self, state_name: str, run_id: RunId, err: Optional[str], params: JsonParams,
+                          start_time: datetime, end_time: datetime) -> None:
+        self._timed('set_current_state', self.storage.set_current_state, state_name, run_id, err, params,
+                    start_time, end_time)
+
+    def set_next_state(self, existing_state: Optional[StateEntryT[RunId]], state_name: str, run_id: RunId,
+                       err: Optional[str], params: JsonParams,
+                       start_time: datetime, end_time: datetime) -> None:
+        self._timed('set_next_state', self.storage.set_next_state, existing_state, state_name, run_id, err, params,
+                    start_time, end_time)
+
+    def build_next_state(self, existing_state: Optional[StateEntryT[RunId]], state_name: str, run_id: RunId,
+                         err: Optional[str], params: JsonParams,
+                         start_time: datetime, end_time: datetime) -> StateEntryT[RunId]:
+        return self.storage.build_next_state(existing_state, state_name, run_id, err, params, start_time, end_time)
+
+    def build_terminal_state(self, run_id: RunId) -> StateEntryT[RunId]:
+        return self.storage.build_terminal_state(run_id)
+
+    def save_states(self, states: List[StateEntryT[RunId]]) -> None:
+        self._timed('save_states', self.storage.save_states, states)
+
+    def set_last_states(self, states: List[StateEntryT[RunId]]) -> None:
+        self._timed('set_last_states', self.storage.set_last_states, states)
+
+    def get_active_runs(self, limit: Optional[int] = None) -> List[RunId]:
+        return self._timed('get_active_runs', self.storage.get_active_runs, limit)
+
+    def get_db_history(self) -> List[StateEntryT[RunId]]:
+        return self._timed('get_db_history', self.storage.get_db_history)
+
+    def iter_history(self, run_id: Optional[RunId] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_size: int = 1000) -> Iterator[StateEntryT[RunId]]:
+        return self._timed_pages('iter_history', self.storage.iter_history, batch_size, run_id, since, until)
+
+    def iter_yielded_runs(self, batch_size: int = 1000) -> Iterator[RunId]:
+        return self._timed_pages('iter_yielded_runs', self.storage.iter_yielded_runs, batch_size)
+
+    def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[RunId, datetime]]:
+        return self._timed('get_due_runs', self.storage.get_due_runs, until, limit)
+
+    def set_last_state(self, state: StateEntryT[RunId]) -> None:
+        self._timed('set_last_state', self.storage.set_last_state, state)
+
+    def archive_runs(self, finished_before: datetime, stale_before: Optional[datetime] = None,
+                     limit: int = 1000) -> int:
+        return self._timed('archive_runs', self.storage.archive_runs, finished_before, stale_before, limit)
+
+    def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                   run_ids: Optional[Sequence[RunId]] = None) -> List[RunId]:
+        return self._timed('claim_runs', self.storage.claim_runs, owner, limit, lease_seconds, run_ids)
+
+    def renew_lease(self, run_id: RunId, owner: str, lease_seconds: float) -> bool:
+        return self._timed('renew_lease', self.storage.renew_lease, run_id, owner, lease_seconds)
+
+    def release_run(self, run_id: RunId, owner: str) -> None:
+        self._timed('release_run', self.storage.release_run, run_id, owner)
+
+    def find_step_result(self, run_id: RunId, state_name: str, visit_count: int,
+                         params_digest: str) -> Optional[JsonParams]:
+        return self._timed('find_step_result', self.storage.find_step_result, run_id, state_name, visit_count,
+                           params_digest)
+
+    def save_step_result(self, run_id: RunId, state_name: str, visit_count: int, params_digest: str,
+                         result: JsonParams) -> None:
+        self._timed('save_step_result', self.storage.save_step_result, run_id, state_name, visit_count,
+                    params_digest, result)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from typing import Optional, Tuple, Any
+
+from fsm import JsonParams
+
+
+def params_hash(params: JsonParams) -> str:
+    """Digest of params independent of key order, part of the key results of a step are recorded under."""
+    encoded = json.dumps(params, sort_keys=True, separators=(',', ':'), default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def encode_result(result: Tuple[Any, ...]) -> JsonParams:
+    """
+    Transition result as the JSON document stored by `StateStorage.save_step_result`. Params are copied, the
+    result's own params become the next state's params and later actions may change them in place.
+    """
+    return {'success': bool(result[0]),
+            'error': result[1],
+            'params': deepcopy(result[2]) if result[2] is not None else {},
+            'delay': result[3] if len(result) > 3 else None}
+
+
+def decode_result(record: JsonParams) -> Tuple[Any, ...]:
+    """Transition result of a document stored by `StateStorage.save_step_result`, with a copy of its params."""
+    params = deepcopy(record['params'])
+    if record.get('delay') is not None:
+        return record['success'], record['error'], params, record['delay']
+    return record['success'], record['error'], params
+
+
+class StepMemo(object):
+    """
+    Memoizes results of a state's action, given per state to `FiniteStateMachine` as `memoize`.
+    Every result is recorded in the storage under (run, state, visit, params hash) before the transition is
+    written, so a step repeated after a crash, or by a worker whose lease expired, reuses it instead of running
+    the action again.
+    States marked `pure` also reuse successful results of other runs with the same params, from a cache in
+    process memory evicting the least recently used results beyond `max_size` and results older than
+    `ttl_seconds`. Mark a state pure only if its action is deterministic and has no side effects that matter.
+    :param pure: share successful results between runs.
+    :param max_size: maximum number of results kept in memory for a pure state.
+    :param ttl_seconds: results of a pure state are evicted this long after they were recorded, None keeps them
+    until they are evicted by size.
+    """
+    def __init__(self, pure: bool = False, max_size: int = 1024, ttl_seconds: Optional[float] = None) -> None:
+        self.pure = pure
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # (state name, params hash) -> (expiry on the monotonic clock or None, recorded result)
+        self._cache: 'OrderedDict[Tuple[str, str], Tuple[Optional[float], JsonParams]]' = OrderedDict()
+
+    def get(self, state_name: str, params_digest: str) -> Optional[JsonParams]:
+        """Copy of the result recorded for the params by any run, None if it's unknown or expired."""
+        key = (state_name, params_digest)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is None:
+                return None
+            expires_at, record = cached
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+        return deepcopy(record)
+
+    def put(self, state_name: str, params_digest: str, record: JsonParams) -> None:
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+        record = deepcopy(record)
+        with self._lock:
+            self._cache[(state_name, params_digest)] = (expires_at, record)
+            self._cache.move_to_end((state_name, params_digest))
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def __repr__(self) -> str:
+        return "<StepMemo(pure={}, max_size={}, ttl_seconds={})>".format(self.pure, self.max_size, self.ttl_seconds)
@@ -0,0 +1,57 @@
+from datetime import datetime
+from typing import Optional, List, Dict, Any
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, JsonParams
+from fsm.fsm_persistence import StateEntryT
+
+
+class StateError(Dict[str, Any]):
+    def __init__(self, error: str, visit_idx: int) -> None:
+        dict.__init__(self, error=error, visit_idx=visit_idx)
+
+
+class StateEntry(StateEntryT[str]):
+    __slots__ = ('id', 'name', 'run_id', 'start_time', 'end_time', 'params', 'visit_count', 'errors', 'yielded',
+                 'due_at')
+
+    def __init__(self, name: str, run_id: str, start_time: datetime, end_time: Optional[datetime],
+                 params: Optional[JsonParams] = None, visit_count: int = 1, errors: Optional[List[StateError]] = None,
+                 yielded: bool = False, id: Optional[int] = None, due_at: Optional[datetime] = None) -> None:
+        self.id = id
+        self.name = name
+        self.run_id = run_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.params = params if params is not None else {}
+        self.visit_count = visit_count
+        self.errors = errors if errors is not None else []
+        self.yielded = yielded
+        self.due_at = due_at
+
+    def __repr__(self) -> str:
+        return "<StateEntry(id='%s', name='%s', run_id='%s')>" % (self.id, self.name, self.run_id)
+
+    def is_initial(self) -> bool:
+        return self.name == INITIAL_STATE
+
+    def is_terminal(self) -> bool:
+        return self.name == TERMINAL_STATE
+
+    def copy(self) -> 'StateEntry':
+        return StateEntry(self.name, self.run_id, self.start_time, self.end_time, dict(self.params),
+                          self.visit_count, list(self.errors), self.yielded, self.id, self.due_at)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'id': self.id, 'name': self.name, 'run_id': self.run_id,
+                'start_time': self.start_time.isoformat(),
+                'end_time': self.end_time.isoformat() if self.end_time else None,
+                'params': self.params, 'visit_count': self.visit_count, 'errors': self.errors,
+                'yielded': self.yielded, 'due_at': self.due_at.isoformat() if self.due_at else None}
+
+    @staticmethod
+    def from_dict(d: Dict[str, Any]) -> 'StateEntry':
+        return StateEntry(d['name'], d['run_id'], datetime.fromisoformat(d['start_time']),
+                          datetime.fromisoformat(d['end_time']) if d['end_time'] else None, d['params'],
+                          d['visit_count'], [StateError(e['error'], e['visit_idx']) for e in d['errors']],
+                          d['yielded'], d['id'],
+                          datetime.fromisoformat(d['due_at']) if d.get('due_at') else None)
@@ -0,0 +1,297 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Tuple, Any, IO, Iterator, Sequence, cast
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, JsonParams
+from fsm.fsm_persistence import StateStorage, StateEntryT, _history_matches
+from fsm.fsm_memory.fsm_memory_models import StateEntry, StateError
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStateStorage(StateStorage[str]):
+    """
+    Keeps FSM states in process memory, indexed by (run_id, name). Returned states are copies, changing them
+    doesn't change the storage until they are saved.
+    Without `wal_path` everything is lost when the process exits. With it every write is appended to a write-ahead
+    log, and the log is compacted into a snapshot at `wal_path + '.snapshot'` every `snapshot_every` records.
+    A new storage created with the same `wal_path` recovers the snapshot and replays the log.
+    :param wal_path: write-ahead log file, None keeps states in memory only.
+    :param snapshot_every: number of log records after which the log is compacted into a snapshot.
+    :param fsync: fsync the log after every record. Without it records survive a process crash but may be lost
+    if the whole machine goes down.
+    """
+    def __init__(self, wal_path: Optional[str] = None, snapshot_every: int = 10000, fsync: bool = False) -> None:
+        self._states: Dict[Tuple[str, str], StateEntry] = {}
+        self._states_by_id: Dict[int, StateEntry] = {}
+        # run_id -> id of the last state, ordered from least to most recently updated run
+        self._last_states: 'OrderedDict[str, int]' = OrderedDict()
+        self._next_id = 1
+        # run_id -> (owner, expiry) of leased runs, not written to the log: leases don't survive a restart
+        self._leases: Dict[str, Tuple[str, datetime]] = {}
+        # (run_id, state name, visit count, params hash) -> recorded action result
+        self._step_results: Dict[Tuple[str, str, int, str], JsonParams] = {}
+        self._lock = threading.RLock()
+        self.wal_path = wal_path
+        self.snapshot_path = wal_path + '.snapshot' if wal_path else None
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self._wal: Optional[IO[str]] = None
+        self._wal_records = 0
+        if wal_path:
+            self._recover()
+            self._wal = open(wal_path, 'a', encoding='utf-8')
+            if self._wal_records:
+                # start from a clean log, this also drops a torn record left by a crash
+                self.snapshot()
+        super().__init__()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+
+    def get_last_state(self, run_id: Optional[str] = None) -> Optional[StateEntry]:
+        with self._lock:
+            if run_id is not None:
+                last_state_id = self._last_states.get(run_id)
+            else:
+                last_state_id = next(reversed(self._last_states.values()), None)
+            return self._states_by_id[last_state_id].copy() if last_state_id is not None else None
+
+    def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntry:
+        return StateEntry(name=INITIAL_STATE, run_id=str(uuid.uuid4()), start_time=datetime.utcnow(),
+                          end_time=datetime.utcnow(), params=params)
+
+    def start_runs(self, params_list: List[JsonParams]) -> List[str]:
+        with self._lock:
+            return super().start_runs(params_list)
+
+    def save_state(self, state: StateEntryT[str]) -> None:
+        with self._lock:
+            self._put_state(state)
+            self.set_last_state(state)
+
+    def yield_state(self, state: StateEntryT[str], is_yielded: bool, due_at: Optional[datetime] = None) -> None:
+        state.yielded = is_yielded
+        state.due_at = due_at if is_yielded else None
+        with self._lock:
+            self._put_state(state)
+
+    def find_state(self, state_name: str, run_id: str) -> Optional[StateEntry]:
+        with self._lock:
+            state = self._states.get((run_id, state_name))
+            return state.copy() if state is not None else None
+
+    def terminate(self, run_id: str) -> None:
+        self.save_state(self.build_terminal_state(run_id))
+
+    def set_current_state(self, state_name: str, run_id: str, err: Optional[str], params: JsonParams,
+                          start_time: datetime, end_time: datetime) -> None:
+        with self._lock:
+            self.set_next_state(self.find_state(state_name, run_id), state_name, run_id, err, params,
+                                start_time, end_time)
+
+    def set_next_state(self, existing_state: Optional[StateEntryT[str]], state_name: str, run_id: str,
+                       err: Optional[str], params: JsonParams, start_time: datetime, end_time: datetime) -> None:
+        self.save_state(self.build_next_state(existing_state, state_name, run_id, err, params, start_time, end_time))
+
+    def build_next_state(self, existing_state: Optional[StateEntryT[str]], state_name: str, run_id: str,
+                         err: Optional[str], params: JsonParams,
+                         start_time: datetime, end_time: datetime) -> StateEntryT[str]:
+        if existing_state is None:
+            return StateEntry(name=state_name, run_id=run_id, start_time=start_time, end_time=end_time,
+                              params=params, errors=[StateError(error=err, visit_idx=1)] if err else [])
+        if err:
+            existing_state.errors.append(StateError(error=err, visit_idx=existing_state.visit_count + 1))
+        existing_state.params = params
+        existing_state.start_time = start_time
+        cast(StateEntry, existing_state).end_time = end_time
+        existing_state.visit_count += 1
+        return existing_state
+
+    def build_terminal_state(self, run_id: str) -> StateEntry:
+        return StateEntry(name=TERMINAL_STATE, run_id=run_id, start_time=datetime.utcnow(),
+                          end_time=datetime.utcnow(),
+                          errors=[StateError(error="Max retry count reached", visit_idx=1)])
+
+    def save_states(self, states: List[StateEntryT[str]]) -> None:
+        with self._lock:
+            for state in states:
+                self._put_state(state)
+
+    def set_last_states(self, states: List[StateEntryT[str]]) -> None:
+        with self._lock:
+            for state in states:
+                self.set_last_state(state)
+
+    def get_active_runs(self, limit: Optional[int] = None) -> List[str]:
+        with self._lock:
+            active_runs = [run_id for run_id, state_id in self._last_states.items()
+                           if not self._states_by_id[state_id].is_terminal()]
+        return active_runs[:limit] if limit is not None else active_runs
+
+    def get_db_history(self) -> List[StateEntryT[str]]:
+        with self._lock:
+            return [state.copy() for state in self._states_by_id.values()]
+
+    def iter_history(self, run_id: Optional[str] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_size: int = 1000) -> Iterator[StateEntry]:
+        with self._lock:
+            state_ids = list(self._states_by_id)
+        for start in range(0, len(state_ids), batch_size):
+            # the lock is held for a batch at a time, writers aren't blocked for the whole export
+            with self._lock:
+                batch = [state.copy() for state in map(self._states_by_id.get, state_ids[start:start + batch_size])
+                         if state is not None and _history_matches(state, run_id, since, until)]
+            yield from batch
+
+    def iter_yielded_runs(self, batch_size: int = 1000) -> Iterator[str]:
+        with self._lock:
+            return iter([run_id for run_id, state_id in self._last_states.items()
+                         if self._states_by_id[state_id].yielded and self._states_by_id[state_id].due_at is None])
+
+    def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[str, datetime]]:
+        with self._lock:
+            due_runs = [(run_id, state.due_at) for run_id, state in
+                        ((run_id, self._states_by_id[state_id]) for run_id, state_id in self._last_states.items())
+                        if state.yielded and state.due_at is not None and state.due_at <= until]
+        return sorted(due_runs, key=lambda due_run: due_run[1])[:limit]
+
+    def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                   run_ids: Optional[Sequence[str]] = None) -> List[str]:
+        now = datetime.utcnow()
+        with self._lock:
+            candidates = self._last_states if run_ids is None else \
+                [run_id for run_id in run_ids if run_id in self._last_states]
+            claimed_run_ids: List[str] = []
+            for run_id in candidates:
+                if len(claimed_run_ids) >= limit:
+                    break
+                lease = self._leases.get(run_id)
+                last_state = self._states_by_id[self._last_states[run_id]]
+                due = run_ids is not None or not last_state.yielded or \
+                    (last_state.due_at is not None and last_state.due_at <= now)
+                if (lease is None or lease[1] < now) and not last_state.is_terminal() and due:
+                    claimed_run_ids.append(run_id)
+            for run_id in claimed_run_ids:
+                self._leases[run_id] = (owner, now + timedelta(seconds=lease_seconds))
+            return claimed_run_ids
+
+    def renew_lease(self, run_id: str, owner: str, lease_seconds: float) -> bool:
+        with self._lock:
+            lease = self._leases.get(run_id)
+            if lease is None or lease[0] != owner:
+                return False
+            self._leases[run_id] = (owner, datetime.utcnow() + timedelta(seconds=lease_seconds))
+            return True
+
+    def release_run(self, run_id: str, owner: str) -> None:
+        with self._lock:
+            lease = self._leases.get(run_id)
+            if lease is not None and lease[0] == owner:
+                del self._leases[run_id]
+
+    def find_step_result(self, run_id: str, state_name: str, visit_count: int,
+                         params_digest: str) -> Optional[JsonParams]:
+        with self._lock:
+            return self._step_results.get((run_id, state_name, visit_count, params_digest))
+
+    def save_step_result(self, run_id: str, state_name: str, visit_count: int, params_digest: str,
+                         result: JsonParams) -> None:
+        with self._lock:
+            key = (run_id, state_name, visit_count, params_digest)
+            if key not in self._step_results:
+                self._step_results[key] = result
+                self._log({'op': 'result', 'key': list(key), 'result': result})
+
+    def set_last_state(self, state: StateEntryT[str]) -> None:
+        # entries of this storage, saved before they become the last state, so they have an ID
+        state_id = cast(int, cast(StateEntry, state).id)
+        with self._lock:
+            self._last_states[state.run_id] = state_id
+            self._last_states.move_to_end(state.run_id)
+            self._log({'op': 'last', 'run_id': state.run_id, 'id': state_id})
+
+    def _put_state(self, state: StateEntryT[str]) -> None:
+        entry = cast(StateEntry, state)
+        existing_state = self._states.get((entry.run_id, entry.name))
+        if existing_state is not None:
+            entry.id = existing_state.id
+        elif entry.id is None:
+            entry.id = self._next_id
+        state_id = cast(int, entry.id)
+        self._next_id = max(self._next_id, state_id + 1)
+        stored_state = entry.copy()
+        self._states[(entry.run_id, entry.name)] = stored_state
+        self._states_by_id[state_id] = stored_state
+        self._log({'op': 'put', 'state': stored_state.to_dict()})
+        self._state_written(state.run_id, state)
+
+    def _log(self, record: Dict[str, Any]) -> None:
+        if self._wal is None:
+            return
+        self._wal.write(json.dumps(record) + '\n')
+        self._wal.flush()
+        if self.fsync:
+            os.fsync(self._wal.fileno())
+        self._wal_records += 1
+        if self._wal_records >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Writes all states into the snapshot file and truncates the write-ahead log."""
+        if self.snapshot_path is None or self.wal_path is None:
+            return
+        with self._lock:
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as snapshot:
+                json.dump({'states': [state.to_dict() for state in self._states_by_id.values()],
+                           'last_states': list(self._last_states.items()),
+                           'step_results': [[list(key), result] for key, result in self._step_results.items()]},
+                          snapshot)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            if self._wal is not None:
+                self._wal.close()
+            self._wal = open(self.wal_path, 'w', encoding='utf-8')
+            self._wal_records = 0
+            logger.debug('Compacted write-ahead log into [{}].'.format(self.snapshot_path))
+
+    def _recover(self) -> None:
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding='utf-8') as snapshot:
+                data = json.load(snapshot)
+            for state_dict in data['states']:
+                self._restore_state(StateEntry.from_dict(state_dict))
+            self._last_states = OrderedDict((run_id, state_id) for run_id, state_id in data['last_states'])
+            self._step_results = {tuple(key): result for key, result in data.get('step_results', [])}
+        if self.wal_path and os.path.exists(self.wal_path):
+            with open(self.wal_path, encoding='utf-8') as wal:
+                for line in wal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning('Skipping torn write-ahead log record, the process likely crashed mid-write.')
+                        break
+                    if record['op'] == 'put':
+                        self._restore_state(StateEntry.from_dict(record['state']))
+                    elif record['op'] == 'result':
+                        self._step_results[tuple(record['key'])] = record['result']
+                    else:
+                        self._last_states[record['run_id']] = record['id']
+                        self._last_states.move_to_end(record['run_id'])
+                    self._wal_records += 1
+
+    def _restore_state(self, state: StateEntry) -> None:
+        state_id = cast(int, state.id)
+        self._states[(state.run_id, state.name)] = state
+        self._states_by_id[state_id] = state
+        self._next_id = max(self._next_id, state_id + 1)
@@ -0,0 +1,14 @@
+from concurrent.futures import Executor
+from typing import Any, Optional
+
+from fsm.fsm_async import OffloadedStateStorage
+from fsm.fsm_mongo.fsm_mongo_storage import MongoStateStorage
+
+
+class AsyncMongoStateStorage(OffloadedStateStorage[Any]):
+    """
+    `MongoStateStorage` for `AsyncFiniteStateMachine`. mongoengine is synchronous, so every call is run in
+    `executor` (default asyncio executor if None).
+    """
+    def __init__(self, executor: Optional[Executor] = None) -> None:
+        super().__init__(MongoStateStorage(), executor)
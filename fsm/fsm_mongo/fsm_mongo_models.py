@@ -4,6 +4,10 @@ from mongoengine import EmbeddedDocument, StringField, IntField, Document, DateT
 
 from fsm import TERMINAL_STATE, INITIAL_STATE
 
+# collections `MongoStateStorage.archive_runs` moves documents of archived runs to, with an `archived_at` field
+ARCHIVE_ENTRY_COLLECTION = 'fsm_log_archive'
+ARCHIVE_STATUS_COLLECTION = 'fsm_status_archive'
+
 
 class StateError(EmbeddedDocument):
     error = StringField(required=True)
@@ -11,8 +15,11 @@ class StateError(EmbeddedDocument):
 
 
 class StateEntry(Document):
-    meta = {'collection': 'fsm_log'}  # ,
-    # 'indexes': ['modelInfo.version']}
+    meta = {'collection': 'fsm_log',
+            # iter_yielded_runs, only the few parked entries are indexed
+            'indexes': [{'fields': ['yielded', '_id'], 'partialFilterExpression': {'yielded': True}},
+                        # get_due_runs, the field is only stored while a run is parked until a due time
+                        {'fields': ['due_at'], 'sparse': True}]}
 
     name = StringField(required=True)
     start_time = DateTimeField(required=True)
@@ -22,6 +29,7 @@ class StateEntry(Document):
     visit_count = IntField(required=True, default=1)
     errors = EmbeddedDocumentListField(StateError, default=[])
     yielded = BooleanField(required=True, default=False)
+    due_at = DateTimeField(required=False)
 
     def is_initial(self) -> bool:
         return self.name == INITIAL_STATE
@@ -31,8 +39,31 @@ class StateEntry(Document):
 
 
 class StateStatus(Document):
-    meta = {'collection': 'fsm_status'}
+    meta = {'collection': 'fsm_status',
+            'indexes': [{'fields': ['run_id'], 'unique': True},
+                        '-update_time',
+                        # get_active_runs and claim_runs, partial filters can't use `$ne` so active runs are flagged
+                        {'fields': ['update_time'], 'partialFilterExpression': {'active': True}}]}
 
+    run_id = ObjectIdField(required=True)
     last_state_id = ObjectIdField(required=True)
     update_time = DateTimeField(required=True)
     ref_state_name = StringField(required=True)
+    # True until the run reaches the terminal state, then unset
+    active = BooleanField(required=False)
+    # worker holding the run, see `MongoStateStorage.claim_runs`
+    lease_owner = StringField(required=False)
+    lease_expires_at = DateTimeField(required=False)
+
+
+class StepResult(Document):
+    """Action results recorded by `MongoStateStorage.save_step_result`, deleted with their runs by `archive_runs`."""
+    meta = {'collection': 'fsm_step_result',
+            'indexes': [{'fields': ['run_id', 'state_name', 'visit_count', 'params_hash'], 'unique': True}]}
+
+    run_id = ObjectIdField(required=True)
+    state_name = StringField(required=True)
+    visit_count = IntField(required=True)
+    params_hash = StringField(required=True)
+    result = DictField(required=True)
+    create_time = DateTimeField(required=True)
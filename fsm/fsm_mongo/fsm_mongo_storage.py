@@ -1,71 +1,341 @@
-from datetime import datetime
-from typing import Optional, List
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Optional, List, Iterator, Tuple, Sequence, Dict, Any, cast
 
 from bson import ObjectId
+from mongoengine import Q
+from pymongo import ReplaceOne, UpdateOne, ASCENDING
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 
-from fsm import TERMINAL_STATE, INITIAL_STATE
-from fsm.fsm_persistence import StateStorage
+from fsm import TERMINAL_STATE, INITIAL_STATE, JsonParams
+from fsm.fsm_persistence import StateStorage, StateEntryT
 
-from fsm.fsm_mongo.fsm_mongo_models import StateEntry, StateStatus, StateError
+from fsm.fsm_mongo.fsm_mongo_models import StateEntry, StateStatus, StateError, StepResult, \
+    ARCHIVE_ENTRY_COLLECTION, ARCHIVE_STATUS_COLLECTION
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _archive_documents(collection: Collection[Dict[str, Any]], documents: List[Dict[str, Any]],
+                       archived_at: datetime) -> None:
+    """Inserts documents keeping their `_id`, ones already archived by an interrupted earlier call are skipped."""
+    for document in documents:
+        document['archived_at'] = archived_at
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+            raise
+
+
+def _status_update(state: StateEntry, update_time: datetime) -> Dict[str, Any]:
+    """Update pointing the status of the state's run at it, flagged `active` until the run is terminated."""
+    update: Dict[str, Any] = {'$set': {'last_state_id': state.id, 'update_time': update_time,
+                                       'ref_state_name': state.name}}
+    if state.is_terminal():
+        update['$unset'] = {'active': ''}
+    else:
+        update['$set']['active'] = True
+    return update
+
+
+def migrate_active_flag() -> None:
+    """
+    Flags statuses of active runs written by older versions, `get_active_runs` and `claim_runs` only see flagged
+    runs. Statuses that are already flagged are left as they are, so it's safe to run more than once.
+    """
+    StateStatus._get_collection().update_many({'ref_state_name': {'$ne': TERMINAL_STATE}, 'active': None},
+                                              {'$set': {'active': True}})
 
 
 class MongoStateStorage(StateStorage):
+    """
+    Stores FSM states in MongoDB through mongoengine.
+    Mongoengine has no client session support, so a step scope can't be made transactional. Instead status pointer
+    writes made within a step are coalesced and written once when the step exits.
+    :param archive_ttl_seconds: if set, documents moved to the archive collections by `archive_runs` are deleted
+    by a Mongo TTL index this long after they were archived.
+    """
+
+    def __init__(self, archive_ttl_seconds: Optional[int] = None) -> None:
+        self._local = threading.local()
+        self.archive_ttl_seconds = archive_ttl_seconds
+        self._archive_indexes_created = False
+        super().__init__()
 
-    def get_last_state(self, run_id: Optional[str]) -> Optional[StateEntry]:
-        last_state = StateStatus.objects().first()
+    @contextmanager
+    def step(self) -> Iterator[None]:
+        if getattr(self._local, 'in_step', False):
+            yield
+            return
+        self._local.in_step = True
+        self._local.pending_last_state = None
+        try:
+            yield
+        finally:
+            pending_last_state = self._local.pending_last_state
+            self._local.in_step = False
+            self._local.pending_last_state = None
+            if pending_last_state is not None:
+                self._write_last_state(pending_last_state)
+
+    def get_last_state(self, run_id: Optional[ObjectId] = None) -> Optional[StateEntry]:
+        pending_last_state: Optional[StateEntry] = getattr(self._local, 'pending_last_state', None)
+        if pending_last_state is not None and (run_id is None or pending_last_state.run_id == run_id):
+            return pending_last_state
+        if run_id is not None:
+            last_state = StateStatus.objects(run_id=run_id).first()
+        else:
+            last_state = StateStatus.objects().order_by('-update_time').first()
         if last_state:
             return StateEntry.objects(id=last_state.last_state_id).first()
         else:
             return None
 
-    def new_initial_state(self, params=None):
+    def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntry:
         return StateEntry(name=INITIAL_STATE, start_time=datetime.utcnow(),
                           end_time=datetime.utcnow(), params=params)
 
+    def start_runs(self, params_list: List[JsonParams]) -> List[ObjectId]:
+        if not params_list:
+            return []
+        now = datetime.utcnow()
+        states = [StateEntry(id=ObjectId(), name=INITIAL_STATE, start_time=now, end_time=now,
+                             params=params if params is not None else {}) for params in params_list]
+        StateEntry._get_collection().insert_many([state.to_mongo() for state in states], ordered=False)
+        StateStatus._get_collection().insert_many(
+            [StateStatus(run_id=state.run_id, last_state_id=state.id, update_time=now,
+                         ref_state_name=state.name, active=True).to_mongo() for state in states], ordered=False)
+        return [state.run_id for state in states]
+
     def _upsert_state(self, state: StateEntry) -> None:
         state = StateEntry.objects(name=state.name, run_id=state.run_id).modify(
             upsert=True, new=True, set__start_time=state.start_time, set__end_time=state.end_time,
             set__params=state.params, set__visit_count=state.visit_count, set__errors=state.errors,
             set__yielded=state.yielded)
+        self._state_written(state.run_id, state)
         self.set_last_state(state)
 
     def find_state(self, state_name: str, run_id: ObjectId) -> StateEntry:
         return StateEntry.objects(run_id=run_id, name=state_name).first()
 
-    def yield_state(self, state: StateEntry, is_yielded: bool) -> None:
+    def yield_state(self, state: StateEntry, is_yielded: bool, due_at: Optional[datetime] = None) -> None:
         state.yielded = is_yielded
+        state.due_at = due_at if is_yielded else None
         state.save()
+        self._state_written(state.run_id, state)
 
     def save_state(self, state: StateEntry) -> None:
         state.save()
+        self._state_written(state.run_id, state)
         self.set_last_state(state)
 
-    def terminate(self, run_id) -> None:
-        state = StateEntry(name=TERMINAL_STATE, start_time=datetime.utcnow(),
-                           end_time=datetime.utcnow(),
-                           errors=[StateError(error="Max retry count reached", visitIdx=1)], run_id=run_id)
-        self._upsert_state(state)
+    def terminate(self, run_id: ObjectId) -> None:
+        self._upsert_state(self.build_terminal_state(run_id))
+
+    def set_current_state(self, state_name: str, run_id: ObjectId, err: Optional[str], params: JsonParams,
+                          start_time: datetime, end_time: datetime) -> None:
+        # TODO: rewrite as a single upsert or update?
+        self.set_next_state(self.find_state(state_name, run_id), state_name, run_id, err, params, start_time,
+                            end_time)
 
-    def set_current_state(self, state_name, run_id, err: Optional[str], params, start_time, end_time) -> None:
-        existing_state = self.find_state(state_name, run_id) # TODO: rewrite as a single upsert or update?
+    def set_next_state(self, existing_state: Optional[StateEntryT[Any]], state_name: str, run_id: ObjectId,
+                       err: Optional[str], params: JsonParams, start_time: datetime, end_time: datetime) -> None:
+        state = self.build_next_state(existing_state, state_name, run_id, err, params, start_time, end_time)
         if existing_state:
-            if err:
-                existing_state.errors.append(StateError(error=err, visitIdx=existing_state.visit_count + 1))
-            existing_state.params = params
-            existing_state.start_time = start_time
-            existing_state.end_time = end_time
-            existing_state.visit_count += 1
-            self.save_state(existing_state)
+            self.save_state(state)
         else:
-            state = StateEntry(name=state_name, start_time=start_time, end_time=end_time,
-                               errors=[StateError(error=err, visitIdx=1)] if err else [],
-                               params=params, run_id=run_id,
-                               visit_count=1)
             self._upsert_state(state)
 
+    def build_next_state(self, existing_state: Optional[StateEntryT[Any]], state_name: str, run_id: ObjectId,
+                         err: Optional[str], params: JsonParams,
+                         start_time: datetime, end_time: datetime) -> StateEntry:
+        if existing_state is None:
+            return StateEntry(name=state_name, start_time=start_time, end_time=end_time,
+                              errors=[StateError(error=err, visitIdx=1)] if err else [],
+                              params=params, run_id=run_id,
+                              visit_count=1)
+        state = cast(StateEntry, existing_state)
+        if err:
+            state.errors.append(StateError(error=err, visitIdx=state.visit_count + 1))
+        state.params = params
+        state.start_time = start_time
+        state.end_time = end_time
+        state.visit_count += 1
+        return state
+
+    def build_terminal_state(self, run_id: ObjectId) -> StateEntry:
+        return StateEntry(name=TERMINAL_STATE, start_time=datetime.utcnow(),
+                          end_time=datetime.utcnow(),
+                          errors=[StateError(error="Max retry count reached", visitIdx=1)], run_id=run_id)
+
+    def save_states(self, states: List[StateEntryT[Any]]) -> None:
+        if not states:
+            return
+        entries = cast(List[StateEntry], states)
+        for state in entries:
+            if state.id is None:
+                state.id = ObjectId()
+        StateEntry._get_collection().bulk_write(
+            [ReplaceOne({'_id': state.id}, state.to_mongo(), upsert=True) for state in entries], ordered=False)
+        for state in states:
+            self._state_written(state.run_id, state)
+
+    def set_last_states(self, states: List[StateEntryT[Any]]) -> None:
+        if not states:
+            return
+        update_time = datetime.utcnow()
+        StateStatus._get_collection().bulk_write(
+            [UpdateOne({'run_id': state.run_id}, _status_update(state, update_time), upsert=True)
+             for state in cast(List[StateEntry], states)], ordered=False)
+
+    def get_active_runs(self, limit: Optional[int] = None) -> List[ObjectId]:
+        active_runs = StateStatus.objects(active=True).order_by('update_time').only('run_id')
+        if limit is not None:
+            active_runs = active_runs.limit(limit)
+        return [status.run_id for status in active_runs]
+
     def get_db_history(self) -> List[StateEntry]:
         return list(StateEntry.objects.order_by("_id"))
 
+    def iter_history(self, run_id: Optional[ObjectId] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_size: int = 1000) -> Iterator[StateEntry]:
+        filters: Dict[str, Any] = {}
+        if run_id is not None:
+            filters['run_id'] = run_id
+        if since is not None:
+            filters['start_time__gte'] = since
+        if until is not None:
+            filters['start_time__lt'] = until
+        last_id = None
+        while True:
+            # keyset pagination on _id, unlike a long lived cursor it can't time out in the middle of an export
+            page = StateEntry.objects(**filters) if last_id is None else StateEntry.objects(id__gt=last_id, **filters)
+            batch = list(page.order_by("_id").limit(batch_size))
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1].id
+
+    def iter_yielded_runs(self, batch_size: int = 1000) -> Iterator[ObjectId]:
+        last_id = None
+        while True:
+            page = StateEntry.objects(yielded=True, due_at=None) if last_id is None else \
+                StateEntry.objects(yielded=True, due_at=None, id__gt=last_id)
+            batch = list(page.order_by("_id").limit(batch_size).only('id', 'run_id').as_pymongo())
+            # a yielded entry that isn't the last state of its run anymore doesn't park the run
+            last_state_ids = {status['last_state_id'] for status in StateStatus._get_collection().find(
+                {'run_id': {'$in': [entry['run_id'] for entry in batch]}}, {'last_state_id': True})}
+            yield from [entry['run_id'] for entry in batch if entry['_id'] in last_state_ids]
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1]['_id']
+
+    def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[ObjectId, datetime]]:
+        entries = list(StateEntry.objects(due_at__lte=until).order_by('due_at').limit(limit).
+                       only('id', 'run_id', 'due_at').as_pymongo())
+        last_state_ids = {status['last_state_id'] for status in StateStatus._get_collection().find(
+            {'run_id': {'$in': [entry['run_id'] for entry in entries]}}, {'last_state_id': True})}
+        return [(entry['run_id'], entry['due_at']) for entry in entries if entry['_id'] in last_state_ids]
+
     def set_last_state(self, state: StateEntry) -> None:
-        StateStatus.objects().modify(upsert=True, new=True, set__last_state_id=state.id,
-                                     set__update_time=datetime.utcnow(), set__ref_state_name=state.name)
+        if getattr(self._local, 'in_step', False):
+            self._local.pending_last_state = state
+        else:
+            self._write_last_state(state)
+
+    def archive_runs(self, finished_before: datetime, stale_before: Optional[datetime] = None,
+                     limit: int = 1000) -> int:
+        # mongoengine has no transactions: documents are copied before they are deleted, so an interrupted call
+        # leaves runs in both places and the next call finishes moving them. Only copied documents are deleted,
+        # an entry written in between stays in the hot collection.
+        due = Q(ref_state_name=TERMINAL_STATE, update_time__lt=finished_before)
+        if stale_before is not None:
+            # a leased run may be in the middle of a step
+            not_leased = Q(lease_expires_at=None) | Q(lease_expires_at__lt=datetime.utcnow())
+            due = due | (Q(update_time__lt=stale_before) & not_leased)
+        statuses = list(StateStatus.objects(due).order_by('update_time').limit(limit).as_pymongo())
+        if not statuses:
+            return 0
+        database = StateEntry._get_db()
+        self._create_archive_indexes()
+        run_ids = [status['run_id'] for status in statuses]
+        archived_at = datetime.utcnow()
+        entries = list(StateEntry.objects(run_id__in=run_ids).as_pymongo())
+        if entries:
+            _archive_documents(database[ARCHIVE_ENTRY_COLLECTION], entries, archived_at)
+            StateEntry._get_collection().delete_many({'_id': {'$in': [entry['_id'] for entry in entries]}})
+        _archive_documents(database[ARCHIVE_STATUS_COLLECTION], statuses, archived_at)
+        StateStatus._get_collection().delete_many({'_id': {'$in': [status['_id'] for status in statuses]}})
+        StepResult._get_collection().delete_many({'run_id': {'$in': run_ids}})
+        self._runs_archived(run_ids)
+        return len(run_ids)
+
+    def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                   run_ids: Optional[Sequence[ObjectId]] = None) -> List[ObjectId]:
+        # Mongo can't join statuses with entries, nor update a sorted batch atomically: claimable statuses are
+        # read first, runs yielded and not due yet are filtered out with a lookup of their last entries, and the
+        # rest are claimed one `findOneAndUpdate` at a time. A status another worker claimed in between doesn't
+        # match anymore.
+        now = datetime.utcnow()
+        not_leased = {'$or': [{'lease_expires_at': None}, {'lease_expires_at': {'$lt': now}}]}
+        collection = StateStatus._get_collection()
+        query = dict(not_leased, active=True)
+        if run_ids is not None:
+            query['run_id'] = {'$in': list(run_ids)}
+        candidates = list(collection.find(query, {'last_state_id': True}).
+                          sort('update_time', ASCENDING).limit(limit))
+        yielded = set() if run_ids is not None else {entry['_id'] for entry in StateEntry._get_collection().find(
+            {'_id': {'$in': [status['last_state_id'] for status in candidates]}, 'yielded': True,
+             '$or': [{'due_at': None}, {'due_at': {'$gt': now}}]}, {'_id': True})}
+        claimed_run_ids = []
+        for status in candidates:
+            if status['last_state_id'] in yielded:
+                continue
+            claimed = collection.find_one_and_update(
+                dict(not_leased, _id=status['_id'], last_state_id=status['last_state_id']),
+                {'$set': {'lease_owner': owner, 'lease_expires_at': now + timedelta(seconds=lease_seconds)}},
+                projection={'run_id': True})
+            if claimed is not None:
+                claimed_run_ids.append(claimed['run_id'])
+        self._runs_claimed(claimed_run_ids)
+        return claimed_run_ids
+
+    def renew_lease(self, run_id: ObjectId, owner: str, lease_seconds: float) -> bool:
+        result = StateStatus._get_collection().update_one(
+            {'run_id': run_id, 'lease_owner': owner},
+            {'$set': {'lease_expires_at': datetime.utcnow() + timedelta(seconds=lease_seconds)}})
+        return result.matched_count == 1
+
+    def release_run(self, run_id: ObjectId, owner: str) -> None:
+        StateStatus._get_collection().update_one({'run_id': run_id, 'lease_owner': owner},
+                                                 {'$set': {'lease_owner': None, 'lease_expires_at': None}})
+
+    def find_step_result(self, run_id: ObjectId, state_name: str, visit_count: int,
+                         params_digest: str) -> Optional[JsonParams]:
+        recorded = StepResult.objects(run_id=run_id, state_name=state_name, visit_count=visit_count,
+                                      params_hash=params_digest).only('result').first()
+        return recorded.result if recorded is not None else None
+
+    def save_step_result(self, run_id: ObjectId, state_name: str, visit_count: int, params_digest: str,
+                         result: JsonParams) -> None:
+        # not coalesced into the step like status writes, the result has to outlive a crash of the step
+        StepResult.objects(run_id=run_id, state_name=state_name, visit_count=visit_count,
+                           params_hash=params_digest).update_one(upsert=True, set_on_insert__result=result,
+                                                                 set_on_insert__create_time=datetime.utcnow())
+
+    def _create_archive_indexes(self) -> None:
+        if self._archive_indexes_created:
+            return
+        database = StateEntry._get_db()
+        for collection in (ARCHIVE_ENTRY_COLLECTION, ARCHIVE_STATUS_COLLECTION):
+            database[collection].create_index('run_id')
+            if self.archive_ttl_seconds is not None:
+                database[collection].create_index('archived_at', expireAfterSeconds=self.archive_ttl_seconds)
+        self._archive_indexes_created = True
+
+    def _write_last_state(self, state: StateEntry) -> None:
+        StateStatus._get_collection().update_one({'run_id': state.run_id},
+                                                 _status_update(state, datetime.utcnow()), upsert=True)
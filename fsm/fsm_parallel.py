@@ -0,0 +1,139 @@
+import asyncio
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, Callable, Any, Optional, Mapping, Tuple, List
+
+from fsm import JsonParams, TransitionAction, TransitionActionResult
+from fsm.fsm import to_transition_result, exception_to_transition_result
+
+THREAD = "thread"
+PROCESS = "process"
+ASYNCIO = "asyncio"
+
+# params key under which a failed parallel state keeps the params of its successful branches for the retry
+BRANCH_RESULTS = "__branches__"
+
+# joins the state's params and the params of each branch by branch name into the params of the next state
+MergePolicy = Callable[[JsonParams, Dict[str, JsonParams]], JsonParams]
+
+
+def merge_by_branch(params: JsonParams, results: Dict[str, JsonParams]) -> JsonParams:
+    """Params of each branch under the branch name, next to the params the state was entered with."""
+    merged = dict(params)
+    merged.update(results)
+    return merged
+
+
+def merge_update(params: JsonParams, results: Dict[str, JsonParams]) -> JsonParams:
+    """Params of all branches in one dict, on a conflict the branch defined last wins."""
+    merged = dict(params)
+    for branch_params in results.values():
+        merged.update(branch_params)
+    return merged
+
+
+def _call_branch(action: TransitionAction, params: JsonParams) -> Tuple[bool, Optional[str], JsonParams]:
+    # module level so it can be pickled for a process pool, results are plain tuples for the same reason
+    try:
+        result = to_transition_result(action(params))
+    except Exception as e:
+        result = exception_to_transition_result(e)
+    return result[0], result[1], result[2] if result[2] is not None else {}
+
+
+class Parallel(object):
+    """
+    Transition action running independent branches of a state concurrently, use it as the action of a state
+    definition. The state succeeds once all branches succeed, the next state then gets the branch params joined
+    by `merge`. If a branch fails the state fails with the errors of the failed branches, params of the
+    successful ones are persisted with the failure state under `BRANCH_RESULTS`, so when the failure target
+    is the parallel state itself the retry only runs the branches that failed.
+    :param branches: transition actions by branch name, each gets a copy of the state's params.
+    :param merge: `merge_by_branch`, `merge_update` or any function with the same signature.
+    :param mode: `THREAD` or `PROCESS` to run branches on a pool, branches of a process pool have to be
+    picklable module level functions. `ASYNCIO` awaits coroutine branches on an event loop, regular functions
+    are run in the loop's default executor. Under `AsyncFiniteStateMachine` branches always run on its loop.
+    :param max_workers: size of the pool created on first use, defaults to the number of branches.
+    :param executor: pool to run branches on instead of creating one, e.g. shared by several parallel states.
+    """
+    def __init__(self, branches: Mapping[str, TransitionAction],
+                 merge: MergePolicy = merge_by_branch,
+                 mode: str = THREAD,
+                 max_workers: Optional[int] = None,
+                 executor: Optional[Executor] = None) -> None:
+        if not branches:
+            raise ValueError("Parallel state needs at least one branch.")
+        if mode not in (THREAD, PROCESS, ASYNCIO):
+            raise ValueError("Unknown parallel mode [{}], use one of: {}.".format(mode, (THREAD, PROCESS, ASYNCIO)))
+        self.branches = dict(branches)
+        self.merge = merge
+        self.mode = mode
+        self.max_workers = max_workers if max_workers is not None else len(self.branches)
+        self._executor = executor
+        self._owns_executor = executor is None
+        self._lock = threading.Lock()
+
+    def __call__(self, params: JsonParams) -> TransitionActionResult:
+        completed, pending = self._split(params)
+        if self.mode == ASYNCIO:
+            results = asyncio.run(self._gather(pending, params, None))
+        else:
+            executor = self._get_executor()
+            futures = {name: executor.submit(_call_branch, self.branches[name], dict(params)) for name in pending}
+            results = {name: future.result() for name, future in futures.items()}
+        return self._join(params, completed, results)
+
+    async def run_async(self, params: JsonParams) -> TransitionActionResult:
+        """Same as calling the action, with branches run on the running event loop."""
+        completed, pending = self._split(params)
+        executor = self._get_executor() if self.mode != ASYNCIO else None
+        return self._join(params, completed, await self._gather(pending, params, executor))
+
+    def close(self) -> None:
+        """Shuts down the pool created by this action, a pool given as `executor` is left running."""
+        with self._lock:
+            if self._owns_executor and self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.max_workers) if self.mode == PROCESS \
+                    else ThreadPoolExecutor(self.max_workers, thread_name_prefix='fsm-parallel')
+            return self._executor
+
+    def _split(self, params: JsonParams) -> Tuple[Dict[str, JsonParams], List[str]]:
+        completed = {name: branch_params for name, branch_params in (params.get(BRANCH_RESULTS) or {}).items()
+                     if name in self.branches}
+        return completed, [name for name in self.branches if name not in completed]
+
+    async def _gather(self, names: List[str], params: JsonParams,
+                      executor: Optional[Executor]) -> Dict[str, Tuple[bool, Optional[str], JsonParams]]:
+        loop = asyncio.get_running_loop()
+
+        async def call(action: TransitionAction) -> Tuple[bool, Optional[str], JsonParams]:
+            if not asyncio.iscoroutinefunction(action):
+                return await loop.run_in_executor(executor, _call_branch, action, dict(params))
+            try:
+                result = to_transition_result(await action(dict(params)))
+            except Exception as e:
+                result = exception_to_transition_result(e)
+            return result[0], result[1], result[2] if result[2] is not None else {}
+
+        results = await asyncio.gather(*(call(self.branches[name]) for name in names))
+        return dict(zip(names, results))
+
+    def _join(self, params: JsonParams, completed: Dict[str, JsonParams],
+              results: Dict[str, Tuple[bool, Optional[str], JsonParams]]) -> TransitionActionResult:
+        state_params = {key: value for key, value in params.items() if key != BRANCH_RESULTS}
+        completed = dict(completed)
+        completed.update((name, branch_params) for name, (ok, _, branch_params) in results.items() if ok)
+        failed = ["[{}]: {}".format(name, err) for name, (ok, err, _) in results.items() if not ok]
+        if failed:
+            state_params[BRANCH_RESULTS] = completed
+            return False, "Parallel branches failed: {}".format("; ".join(failed)), state_params
+        return True, None, self.merge(state_params, {name: completed[name] for name in self.branches})
+
+    def __repr__(self) -> str:
+        return "<Parallel(branches={}, mode='{}')>".format(list(self.branches), self.mode)
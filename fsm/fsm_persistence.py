@@ -1,7 +1,10 @@
+import threading
 from uuid import UUID
 
+from contextlib import contextmanager, asynccontextmanager
 from datetime import datetime
-from typing import Optional, List, TypeVar, Dict, Any, Generic
+from typing import Optional, List, TypeVar, Dict, Any, Generic, Iterator, AsyncIterator, Callable, Tuple, \
+    Sequence
 
 from fsm import JsonParams
 
@@ -14,23 +17,90 @@ class StateEntryT(Generic[RunId]):
     yielded: bool
     params: Dict[str, Any]
     visit_count: int
+    errors: List[Any]
+    start_time: datetime
+    # set while the entry is yielded until a due time, see `StateStorage.yield_state`
+    due_at: Optional[datetime]
 
     def is_terminal(self) -> bool:
         raise NotImplementedError
 
 
+StateListener = Callable[[RunId, Optional[StateEntryT[RunId]]], None]
+
+
 class StateStorage(Generic[RunId]):
+    # class level defaults, so storages that don't call `super().__init__()` work too: the list is never changed
+    # in place, adding a listener gives the storage its own copy
+    _state_listeners: List[StateListener[Any]] = []
+    _state_listeners_lock = threading.Lock()
+
+    def add_state_listener(self, listener: StateListener[RunId]) -> None:
+        """
+        Registers `listener(run_id, state)` called after an entry of a run is written through this storage.
+        `state` is the written entry, or None if the backend didn't materialize it and anything cached about
+        the run has to be dropped.
+        """
+        with self._state_listeners_lock:
+            self._state_listeners = self._state_listeners + [listener]
+
+    def remove_state_listener(self, listener: StateListener[RunId]) -> None:
+        with self._state_listeners_lock:
+            listeners = list(self._state_listeners)
+            listeners.remove(listener)
+            self._state_listeners = listeners
+
+    def invalidate(self, run_id: RunId) -> None:
+        """Tells listeners that entries of the run were changed behind their back, e.g. by another process."""
+        self._state_written(run_id, None)
 
-    def get_last_state(self, run_id: Optional[RunId]) -> Optional[StateEntryT[RunId]]:
+    def _state_written(self, run_id: RunId, state: Optional[StateEntryT[RunId]]) -> None:
+        for listener in self._state_listeners:
+            listener(run_id, state)
+
+    @contextmanager
+    def step(self) -> Iterator[None]:
+        """
+        Scope of storage calls of a single FSM step, entered once for the reads before the transition action and
+        once for the writes after it, never while the action runs. All storage calls made inside share one
+        session/connection and are committed together when the scope exits. Nested scopes join the outer one.
+        """
+        yield
+
+    @contextmanager
+    def run_scope(self) -> Iterator[None]:
+        """Scope of a single `FiniteStateMachine.run` call, from the first step until the run yields or stops."""
+        yield
+
+    def get_last_state(self, run_id: Optional[RunId] = None) -> Optional[StateEntryT[RunId]]:
+        """Last state of a run, or of the most recently updated run if `run_id` is None."""
         pass
 
-    def new_initial_state(self, params=None) -> StateEntryT[RunId]:
+    def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntryT[RunId]:
         pass
 
+    def start_runs(self, params_list: List[JsonParams]) -> List[RunId]:
+        """
+        Starts a run per params dict: writes its initial state and points its last state to it.
+        Backends override this with a bulk write, by default runs are started one by one.
+        :return: IDs of the started runs in the order of `params_list`.
+        """
+        run_ids = []
+        for params in params_list:
+            state = self.new_initial_state(params)
+            self.save_state(state)
+            run_ids.append(state.run_id)
+        return run_ids
+
     def save_state(self, state: StateEntryT[RunId]) -> None:
         pass
 
-    def yield_state(self, state: StateEntryT[RunId], is_yielded: bool) -> None:
+    def yield_state(self, state: StateEntryT[RunId], is_yielded: bool, due_at: Optional[datetime] = None) -> None:
+        """
+        Parks or resumes a run at `state`.
+        :param due_at: if set, the run is parked until this time and found with `get_due_runs` instead of
+        `iter_yielded_runs`. Resuming clears it.
+        """
         pass
 
     def find_state(self, state_name: str, run_id: RunId) -> Optional[StateEntryT[RunId]]:
@@ -43,8 +113,254 @@ class StateStorage(Generic[RunId]):
                           start_time: datetime, end_time: datetime) -> None:
         pass
 
+    def set_next_state(self, existing_state: Optional[StateEntryT[RunId]], state_name: str, run_id: RunId,
+                       err: Optional[str], params: JsonParams,
+                       start_time: datetime, end_time: datetime) -> None:
+        """
+        Same as `set_current_state` for callers that already know the entry `find_state` would return, so backends
+        can skip looking it up. `existing_state` may be updated in place.
+        """
+        self.set_current_state(state_name, run_id, err, params, start_time, end_time)
+        self._state_written(run_id, None)
+
+    def build_next_state(self, existing_state: Optional[StateEntryT[RunId]], state_name: str, run_id: RunId,
+                         err: Optional[str], params: JsonParams,
+                         start_time: datetime, end_time: datetime) -> StateEntryT[RunId]:
+        """
+        Builds the entry `set_current_state` would write without writing it: updates `existing_state` in place
+        for another visit or creates a new entry if it's None.
+        """
+        raise NotImplementedError
+
+    def build_terminal_state(self, run_id: RunId) -> StateEntryT[RunId]:
+        """Builds the entry `terminate` would write without writing it."""
+        raise NotImplementedError
+
+    def save_states(self, states: List[StateEntryT[RunId]]) -> None:
+        """
+        Writes many entries at once, new entries get their IDs assigned. Last state pointers are set separately
+        with `set_last_states`. Backends override this with a bulk write, by default entries are saved one by one.
+        """
+        for state in states:
+            self.save_state(state)
+
+    def set_last_states(self, states: List[StateEntryT[RunId]]) -> None:
+        """Points last state of every run to the given entry, entries have to be saved. Backends bulk write it."""
+        for state in states:
+            self.set_last_state(state)
+
+    def get_active_runs(self, limit: Optional[int] = None) -> List[RunId]:
+        """IDs of runs that haven't reached the terminal state, least recently updated first."""
+        raise NotImplementedError
+
     def get_db_history(self) -> List[StateEntryT[RunId]]:
         pass
 
+    def iter_history(self, run_id: Optional[RunId] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_size: int = 1000) -> Iterator[StateEntryT[RunId]]:
+        """
+        Streams entries in the order they were created, reading `batch_size` of them at a time, so exporting
+        a large history runs in constant memory. Backends override this with keyset pagination, by default
+        `get_db_history` is filtered.
+        :param run_id: only entries of this run.
+        :param since: only entries whose `start_time` is at or after it.
+        :param until: only entries whose `start_time` is before it.
+        """
+        for state in self.get_db_history():
+            if _history_matches(state, run_id, since, until):
+                yield state
+
+    def iter_yielded_runs(self, batch_size: int = 1000) -> Iterator[RunId]:
+        """
+        Streams IDs of runs parked in a yielded state without a due time, which the next `FiniteStateMachine.run`
+        call resumes, reading `batch_size` of them at a time. Backends override this with an indexed query,
+        by default the last state of every active run is looked up.
+        """
+        for run_id in self.get_active_runs():
+            last_state = self.get_last_state(run_id)
+            if last_state is not None and last_state.yielded and getattr(last_state, 'due_at', None) is None:
+                yield run_id
+
+    def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[RunId, datetime]]:
+        """
+        Runs parked until a due time at or before `until`, earliest first, with their due times. Backends override
+        this with an indexed query, by default the last state of every active run is looked up.
+        """
+        due_runs = []
+        for run_id in self.get_active_runs():
+            last_state = self.get_last_state(run_id)
+            due_at = getattr(last_state, 'due_at', None)
+            if last_state is not None and last_state.yielded and due_at is not None and due_at <= until:
+                due_runs.append((run_id, due_at))
+        return sorted(due_runs, key=lambda due_run: due_run[1])[:limit]
+
     def set_last_state(self, state: StateEntryT[RunId]) -> None:
         pass
+
+    def archive_runs(self, finished_before: datetime, stale_before: Optional[datetime] = None,
+                     limit: int = 1000) -> int:
+        """
+        Moves entries and the status of up to `limit` runs out of the hot tables into archive ones, so lookups of
+        active runs keep hitting small indexes. Listeners are told about every archived run.
+        :param finished_before: archive runs in the terminal state last updated before this time.
+        :param stale_before: also archive runs in any other state last updated before this time, None keeps
+        unfinished runs. A run archived this way can't be advanced anymore. Runs leased to a worker by `claim_runs`
+        are kept until their lease expires.
+        :return: number of archived runs, less than `limit` once nothing else is due.
+        """
+        raise NotImplementedError
+
+    def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                   run_ids: Optional[Sequence[RunId]] = None) -> List[RunId]:
+        """
+        Leases up to `limit` unfinished runs to `owner`, least recently updated first. Runs yielded without a due
+        time aren't claimed, runs parked until a due time are once it passed. A run leased to a worker isn't
+        handed out to another one until the lease is released or expires, so workers sharing the storage can pull
+        runs from it without advancing the same run twice.
+        :param owner: unique name of the worker, e.g. host, process and a random suffix.
+        :param limit: maximum number of claimed runs.
+        :param lease_seconds: the lease expires this long after the claim unless it's renewed, runs of a worker
+        that died are claimed again after that. Keep it well above the time a run takes and the clock skew of
+        the workers.
+        :param run_ids: claim only these runs, yielded ones included, e.g. runs a scheduler resumes.
+        :return: IDs of the claimed runs, empty when no run is available.
+        """
+        raise NotImplementedError
+
+    def renew_lease(self, run_id: RunId, owner: str, lease_seconds: float) -> bool:
+        """
+        Extends the lease of `owner` on a run to `lease_seconds` from now.
+        :return: False if the run isn't leased to `owner` anymore, e.g. the lease expired and another worker
+        claimed the run.
+        """
+        raise NotImplementedError
+
+    def release_run(self, run_id: RunId, owner: str) -> None:
+        """Ends the lease of `owner` on a run so any worker can claim it again, does nothing if it's not leased
+        to `owner`."""
+        raise NotImplementedError
+
+    def find_step_result(self, run_id: RunId, state_name: str, visit_count: int,
+                         params_digest: str) -> Optional[JsonParams]:
+        """
+        Result of an action recorded by `save_step_result`, None if the step wasn't recorded.
+        :param visit_count: visit of the state whose action produced the result.
+        :param params_digest: `fsm_memo.params_hash` of the params the action was called with.
+        """
+        raise NotImplementedError
+
+    def save_step_result(self, run_id: RunId, state_name: str, visit_count: int, params_digest: str,
+                         result: JsonParams) -> None:
+        """
+        Records the result of an action before the transition it leads to is written. It's written right away,
+        also within a step scope, so it survives a crash of the step. A result already recorded for the same
+        step is kept. Results are removed with their runs by `archive_runs`.
+        """
+        raise NotImplementedError
+
+    def _runs_archived(self, run_ids: List[RunId]) -> None:
+        for run_id in run_ids:
+            self._state_written(run_id, None)
+
+    def _runs_claimed(self, run_ids: List[RunId]) -> None:
+        # another worker may have advanced the runs since they were last read here
+        for run_id in run_ids:
+            self._state_written(run_id, None)
+
+
+def _history_matches(state: StateEntryT[RunId], run_id: Optional[RunId], since: Optional[datetime],
+                     until: Optional[datetime]) -> bool:
+    return (run_id is None or state.run_id == run_id) and (since is None or state.start_time >= since) and \
+        (until is None or state.start_time < until)
+
+
+class AsyncStateStorage(Generic[RunId]):
+    """Same contract as `StateStorage` for `AsyncFiniteStateMachine`, every call is awaited."""
+
+    @asynccontextmanager
+    async def step(self) -> AsyncIterator[None]:
+        yield
+
+    async def get_last_state(self, run_id: Optional[RunId] = None) -> Optional[StateEntryT[RunId]]:
+        raise NotImplementedError
+
+    async def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntryT[RunId]:
+        raise NotImplementedError
+
+    async def start_runs(self, params_list: List[JsonParams]) -> List[RunId]:
+        run_ids = []
+        for params in params_list:
+            state = await self.new_initial_state(params)
+            await self.save_state(state)
+            run_ids.append(state.run_id)
+        return run_ids
+
+    async def save_state(self, state: StateEntryT[RunId]) -> None:
+        pass
+
+    async def yield_state(self, state: StateEntryT[RunId], is_yielded: bool,
+                          due_at: Optional[datetime] = None) -> None:
+        pass
+
+    async def find_state(self, state_name: str, run_id: RunId) -> Optional[StateEntryT[RunId]]:
+        raise NotImplementedError
+
+    async def terminate(self, run_id: RunId) -> None:
+        pass
+
+    async def set_current_state(self, state_name: str, run_id: RunId, err: Optional[str], params: JsonParams,
+                                start_time: datetime, end_time: datetime) -> None:
+        pass
+
+    async def get_active_runs(self, limit: Optional[int] = None) -> List[RunId]:
+        raise NotImplementedError
+
+    async def get_db_history(self) -> List[StateEntryT[RunId]]:
+        raise NotImplementedError
+
+    async def iter_history(self, run_id: Optional[RunId] = None, since: Optional[datetime] = None,
+                           until: Optional[datetime] = None,
+                           batch_size: int = 1000) -> AsyncIterator[StateEntryT[RunId]]:
+        for state in await self.get_db_history():
+            if _history_matches(state, run_id, since, until):
+                yield state
+
+    async def iter_yielded_runs(self, batch_size: int = 1000) -> AsyncIterator[RunId]:
+        for run_id in await self.get_active_runs():
+            last_state = await self.get_last_state(run_id)
+            if last_state is not None and last_state.yielded and getattr(last_state, 'due_at', None) is None:
+                yield run_id
+
+    async def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[RunId, datetime]]:
+        due_runs = []
+        for run_id in await self.get_active_runs():
+            last_state = await self.get_last_state(run_id)
+            due_at = getattr(last_state, 'due_at', None)
+            if last_state is not None and last_state.yielded and due_at is not None and due_at <= until:
+                due_runs.append((run_id, due_at))
+        return sorted(due_runs, key=lambda due_run: due_run[1])[:limit]
+
+    async def set_last_state(self, state: StateEntryT[RunId]) -> None:
+        pass
+
+    async def archive_runs(self, finished_before: datetime, stale_before: Optional[datetime] = None,
+                           limit: int = 1000) -> int:
+        raise NotImplementedError
+
+    async def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                         run_ids: Optional[Sequence[RunId]] = None) -> List[RunId]:
+        raise NotImplementedError
+
+    async def renew_lease(self, run_id: RunId, owner: str, lease_seconds: float) -> bool:
+        raise NotImplementedError
+
+    async def release_run(self, run_id: RunId, owner: str) -> None:
+        raise NotImplementedError
+
+    async def find_step_result(self, run_id: RunId, state_name: str, visit_count: int,
+                               params_digest: str) -> Optional[JsonParams]:
+        raise NotImplementedError
+
+    async def save_step_result(self, run_id: RunId, state_name: str, visit_count: int, params_digest: str,
+                               result: JsonParams) -> None:
+        raise NotImplementedError
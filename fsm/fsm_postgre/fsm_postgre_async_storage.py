@@ -0,0 +1,253 @@
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Optional, List, AsyncIterator, AsyncContextManager, Tuple, Sequence, cast
+
+from sqlalchemy import asc, desc, select, update
+from sqlalchemy.dialects.postgresql import Insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, JsonParams
+from fsm.fsm_persistence import AsyncStateStorage, StateEntryT
+from fsm.fsm_postgre.fsm_postgre_models import StateEntry, StateStatus, params_compression
+from fsm.fsm_postgre.fsm_postgre_storage import _upsert_current_state_statement, _upsert_current_state_params, \
+    _start_runs_statement, _initial_state_values, _history_query, _archive_runs_statement, \
+    _claim_runs_statement, _lease_statement, _yielded_runs_query, _due_runs_query, _find_step_result_query, \
+    _save_step_result_statement
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def _acquire_async_db_session(DBSession: async_sessionmaker[AsyncSession],
+                                    compression: Optional[Tuple[int, int]] = None) -> AsyncIterator[AsyncSession]:
+    """used in 'async with' statement, params written until the session is committed are compressed with
+    `compression`"""
+    db_session = DBSession(expire_on_commit=False)
+    compression_token = params_compression.set(compression)
+    try:
+        yield db_session
+        await db_session.commit()
+        db_session.expunge_all()
+    except BaseException as ex:
+        logger.error('Error on commit - {}'.format(str(ex)))
+        await db_session.rollback()
+        raise
+    finally:
+        await db_session.close()
+        params_compression.reset(compression_token)
+
+
+@asynccontextmanager
+async def _join_async_db_session(db_session: AsyncSession) -> AsyncIterator[AsyncSession]:
+    """used in 'async with' statement when a session is already open for the current step"""
+    yield db_session
+    await db_session.flush()
+
+
+class AsyncPostgreStateStorage(AsyncStateStorage[str]):
+    """
+    `PostgreStateStorage` for `AsyncFiniteStateMachine` on top of SQLAlchemy asyncio extension, e.g. with an
+    `postgresql+asyncpg://` engine. Steps are committed with single `INSERT ... ON CONFLICT` round trips.
+    :param DBSession: async session factory bound to the database with FSM tables.
+    :param tenant_id: all states written and read by this storage are scoped by this tenant.
+    :param start_runs_batch_size: number of runs `start_runs` inserts with one statement.
+    :param compress_params_over: same as for `PostgreStateStorage`.
+    :param compression_level: same as for `PostgreStateStorage`.
+    """
+    def __init__(self, DBSession: async_sessionmaker[AsyncSession], tenant_id: str, start_runs_batch_size: int = 1000,
+                 compress_params_over: Optional[int] = None,
+                 compression_level: int = 6) -> None:
+        self.DBSession = DBSession
+        self.tenant_id = tenant_id
+        self.start_runs_batch_size = start_runs_batch_size
+        self._compression = (compress_params_over, compression_level) if compress_params_over is not None else None
+        self._step_session: ContextVar[Optional[AsyncSession]] = ContextVar('fsm_step_session', default=None)
+
+    @asynccontextmanager
+    async def step(self) -> AsyncIterator[None]:
+        if self._step_session.get() is not None:
+            yield
+            return
+        async with _acquire_async_db_session(self.DBSession, self._compression) as db_session:
+            token = self._step_session.set(db_session)
+            try:
+                yield
+            finally:
+                self._step_session.reset(token)
+
+    def _db_session(self) -> AsyncContextManager[AsyncSession]:
+        step_session = self._step_session.get()
+        if step_session is not None:
+            return _join_async_db_session(step_session)
+        return _acquire_async_db_session(self.DBSession, self._compression)
+
+    async def get_last_state(self, run_id: Optional[str] = None) -> Optional[StateEntry]:
+        last_state_query = select(StateEntry).\
+            join(StateStatus, StateStatus.last_state_id == StateEntry.id).\
+            where(StateStatus.tenant_id == self.tenant_id)
+        if run_id is not None:
+            last_state_query = last_state_query.where(StateStatus.run_id == run_id)
+        else:
+            last_state_query = last_state_query.order_by(desc(StateStatus.update_time))
+        async with self._db_session() as db_session:
+            return (await db_session.execute(last_state_query.limit(1))).scalars().first()
+
+    async def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntry:
+        return StateEntry(name=INITIAL_STATE,
+                          run_id=str(uuid.uuid4()),
+                          start_time=datetime.utcnow(),
+                          end_time=datetime.utcnow(),
+                          params=params if params is not None else {},
+                          visit_count=1,
+                          errors=[],
+                          yielded=False,
+                          tenant_id=self.tenant_id)
+
+    async def start_runs(self, params_list: List[JsonParams]) -> List[str]:
+        run_ids: List[str] = []
+        async with self._db_session() as db_session:
+            connection = await db_session.connection()
+            for chunk_start in range(0, len(params_list), self.start_runs_batch_size):
+                initial_states = _initial_state_values(
+                    self.tenant_id, params_list[chunk_start:chunk_start + self.start_runs_batch_size])
+                await connection.execute(_start_runs_statement(self.tenant_id, initial_states, datetime.utcnow()))
+                run_ids.extend(state['run_id'] for state in initial_states)
+        return run_ids
+
+    async def save_state(self, state: StateEntryT[str]) -> None:
+        entry = cast(StateEntry, state)
+        async with self._db_session() as db_session:
+            if entry.id is None:
+                db_session.add(entry)
+            else:
+                await db_session.merge(entry)
+        await self.set_last_state(entry)
+
+    async def yield_state(self, state: StateEntryT[str], is_yielded: bool, due_at: Optional[datetime] = None) -> None:
+        state.yielded = is_yielded
+        state.due_at = due_at if is_yielded else None
+        async with self._db_session() as db_session:
+            await db_session.execute(update(StateEntry).where(StateEntry.id == cast(StateEntry, state).id).
+                                     values(yielded=is_yielded, due_at=state.due_at))
+
+    async def find_state(self, state_name: str, run_id: str) -> Optional[StateEntry]:
+        async with self._db_session() as db_session:
+            return (await db_session.execute(select(StateEntry).
+                                             where(StateEntry.run_id == run_id).
+                                             where(StateEntry.tenant_id == self.tenant_id).
+                                             where(StateEntry.name == state_name))).scalars().first()
+
+    async def terminate(self, run_id: str) -> None:
+        # replaces an existing terminal entry like `PostgreStateStorage.terminate`, it isn't another visit
+        now = datetime.utcnow()
+        async with self._db_session() as db_session:
+            connection = await db_session.connection()
+            await connection.execute(_upsert_current_state_statement(True, replace=True),
+                                     _upsert_current_state_params(self.tenant_id, TERMINAL_STATE, run_id,
+                                                                  "Max retry count reached", {}, now, now))
+
+    async def set_current_state(self, state_name: str, run_id: str, err: Optional[str], params: JsonParams,
+                                start_time: datetime, end_time: datetime) -> None:
+        async with self._db_session() as db_session:
+            connection = await db_session.connection()
+            await connection.execute(_upsert_current_state_statement(bool(err)),
+                                     _upsert_current_state_params(self.tenant_id, state_name, run_id, err, params,
+                                                                  start_time, end_time))
+
+    async def get_active_runs(self, limit: Optional[int] = None) -> List[str]:
+        active_runs_query = select(StateStatus.run_id).\
+            where(StateStatus.tenant_id == self.tenant_id).\
+            where(StateStatus.ref_state_name != TERMINAL_STATE).\
+            order_by(asc(StateStatus.update_time)).\
+            limit(limit)
+        async with self._db_session() as db_session:
+            return list((await db_session.execute(active_runs_query)).scalars().all())
+
+    async def get_db_history(self) -> List[StateEntryT[str]]:
+        async with self._db_session() as db_session:
+            return list((await db_session.execute(_history_query(self.tenant_id))).scalars().all())
+
+    async def iter_history(self, run_id: Optional[str] = None, since: Optional[datetime] = None,
+                           until: Optional[datetime] = None, batch_size: int = 1000) -> AsyncIterator[StateEntry]:
+        last_id = None
+        while True:
+            async with self._db_session() as db_session:
+                batch = (await db_session.execute(_history_query(self.tenant_id, run_id, since, until, last_id,
+                                                                 batch_size))).scalars().all()
+            for state in batch:
+                yield state
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1].id
+
+    async def iter_yielded_runs(self, batch_size: int = 1000) -> AsyncIterator[str]:
+        last_id = None
+        while True:
+            async with self._db_session() as db_session:
+                batch = (await db_session.execute(_yielded_runs_query(self.tenant_id, last_id, batch_size))).all()
+            for _, run_id, is_last in batch:
+                if is_last:
+                    yield run_id
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1].id
+
+    async def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[str, datetime]]:
+        async with self._db_session() as db_session:
+            return [(run_id, due_at) for run_id, due_at in
+                    (await db_session.execute(_due_runs_query(self.tenant_id, until, limit))).all()]
+
+    async def set_last_state(self, state: StateEntryT[str]) -> None:
+        status_stmt = Insert(StateStatus).values(tenant_id=self.tenant_id,
+                                                 run_id=state.run_id,
+                                                 last_state_id=cast(StateEntry, state).id,
+                                                 ref_state_name=state.name,
+                                                 update_time=datetime.utcnow())
+        status_stmt = status_stmt.on_conflict_do_update(
+            index_elements=[StateStatus.tenant_id, StateStatus.run_id],
+            set_={StateStatus.last_state_id: status_stmt.excluded.last_state_id,
+                  StateStatus.ref_state_name: status_stmt.excluded.ref_state_name,
+                  StateStatus.update_time: status_stmt.excluded.update_time})
+        async with self._db_session() as db_session:
+            connection = await db_session.connection()
+            await connection.execute(status_stmt)
+
+    async def archive_runs(self, finished_before: datetime, stale_before: Optional[datetime] = None,
+                           limit: int = 1000) -> int:
+        async with self._db_session() as db_session:
+            result = await db_session.execute(_archive_runs_statement(self.tenant_id, finished_before,
+                                                                      stale_before, limit))
+            return len(result.scalars().all())
+
+    async def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                         run_ids: Optional[Sequence[str]] = None) -> List[str]:
+        async with self._db_session() as db_session:
+            result = await db_session.execute(_claim_runs_statement(self.tenant_id, owner, limit, lease_seconds,
+                                                                    run_ids))
+            return list(result.scalars().all())
+
+    async def renew_lease(self, run_id: str, owner: str, lease_seconds: float) -> bool:
+        lease_expires_at = datetime.utcnow() + timedelta(seconds=lease_seconds)
+        async with self._db_session() as db_session:
+            result = await db_session.execute(_lease_statement(self.tenant_id, run_id, owner, lease_expires_at))
+            return result.first() is not None
+
+    async def release_run(self, run_id: str, owner: str) -> None:
+        async with self._db_session() as db_session:
+            await db_session.execute(_lease_statement(self.tenant_id, run_id, owner, None))
+
+    async def find_step_result(self, run_id: str, state_name: str, visit_count: int,
+                               params_digest: str) -> Optional[JsonParams]:
+        async with self._db_session() as db_session:
+            return (await db_session.execute(_find_step_result_query(self.tenant_id, run_id, state_name,
+                                                                     visit_count, params_digest))).scalar()
+
+    async def save_step_result(self, run_id: str, state_name: str, visit_count: int, params_digest: str,
+                               result: JsonParams) -> None:
+        # a session of its own, committed before the step that produced the result
+        async with _acquire_async_db_session(self.DBSession, self._compression) as db_session:
+            await db_session.execute(_save_step_result_statement(self.tenant_id, run_id, state_name, visit_count,
+                                                                 params_digest, result))
@@ -0,0 +1,128 @@
+import logging
+from typing import List
+
+from sqlalchemy import Table, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateIndex
+
+from fsm.fsm_postgre.fsm_postgre_models import StateEntry, StateStatus, StateEntryArchive, StateStatusArchive, \
+    StepResult
+
+logger = logging.getLogger(__name__)
+
+FSM_TABLES: List[Table] = [StateEntry.__table__, StateStatus.__table__]
+
+
+def create_indexes(engine: Engine, concurrently: bool = True) -> None:
+    """
+    Creates indexes declared in the models on tables that were created by an older version of this package.
+    New deployments get them from `Base.metadata.create_all` and don't need this call. Indexes that already exist
+    are skipped, so it's safe to run on every deploy.
+    Unique indexes can't be created while `state_entry` holds duplicate (tenant_id, run_id, name) rows or
+    `state_status` holds duplicate (tenant_id, run_id) rows, remove duplicates first. Status tables of versions that
+    kept a row per tenant are upgraded by `migrate_status_per_run` instead.
+    :param engine: engine connected to the database with FSM tables.
+    :param concurrently: use `CREATE INDEX CONCURRENTLY`, which doesn't block writes on large tables. If it fails
+    Postgres leaves an INVALID index behind which has to be dropped before retrying.
+    """
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for table in FSM_TABLES:
+            for index in sorted(table.indexes, key=lambda i: str(i.name)):
+                create_index = CreateIndex(index, if_not_exists=True)  # type: ignore[no-untyped-call]
+                ddl = str(create_index.compile(dialect=engine.dialect))
+                if concurrently:
+                    ddl = ddl.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+                logger.info('Creating index [{}] on [{}].'.format(index.name, table.name))
+                connection.exec_driver_sql(ddl)
+
+
+def migrate_status_per_run(engine: Engine) -> None:
+    """
+    Upgrades `state_status` of older versions, which held a single row per tenant, to a row per run and creates
+    missing indexes. Status rows are rebuilt from the newest `state_entry` row of every run, which is what
+    `get_last_state` used to return. Runs that already have a status row are left as they are, so it's safe to
+    run more than once.
+    :param engine: engine connected to the database with FSM tables.
+    """
+    with engine.begin() as connection:
+        connection.exec_driver_sql("ALTER TABLE state_status ADD COLUMN IF NOT EXISTS run_id VARCHAR(255)")
+        connection.exec_driver_sql("DROP INDEX IF EXISTS ix_state_status_tenant")
+        connection.exec_driver_sql("DELETE FROM state_status WHERE run_id IS NULL")
+        connection.exec_driver_sql(
+            "INSERT INTO state_status (tenant_id, run_id, last_state_id, ref_state_name, update_time) "
+            "SELECT DISTINCT ON (e.tenant_id, e.run_id) e.tenant_id, e.run_id, e.id, e.name, "
+            "COALESCE(e.end_time, e.start_time) FROM state_entry e WHERE NOT EXISTS ("
+            "SELECT 1 FROM state_status s WHERE s.tenant_id = e.tenant_id AND s.run_id = e.run_id) "
+            "ORDER BY e.tenant_id, e.run_id, e.id DESC")
+        connection.exec_driver_sql("ALTER TABLE state_status ALTER COLUMN run_id SET NOT NULL")
+    create_indexes(engine)
+
+
+def migrate_json_to_jsonb(engine: Engine) -> None:
+    """
+    Converts `params` and `errors` of state entries from JSON, used by older versions, to JSONB. Columns that
+    are already JSONB are skipped, so it's safe to run more than once. Rewrites the tables under an exclusive
+    lock, run it in a maintenance window on large tables.
+    :param engine: engine connected to the database with FSM tables.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in (StateEntry.__table__, StateEntryArchive.__table__):
+            if not inspector.has_table(table.name):
+                continue
+            column_types = {column['name']: str(column['type']).upper() for column in inspector.get_columns(table.name)}
+            for column in ('params', 'errors'):
+                if column_types.get(column) == 'JSON':
+                    logger.info('Converting [{}.{}] to JSONB.'.format(table.name, column))
+                    connection.exec_driver_sql('ALTER TABLE {0} ALTER COLUMN {1} TYPE JSONB USING {1}::jsonb'.format(
+                        table.name, column))
+
+
+def add_run_leases(engine: Engine) -> None:
+    """
+    Adds lease columns used by `PostgreStateStorage.claim_runs` to `state_status` created by older versions.
+    Columns that already exist are skipped, so it's safe to run more than once. Adding nullable columns doesn't
+    rewrite the table.
+    :param engine: engine connected to the database with FSM tables.
+    """
+    with engine.begin() as connection:
+        connection.exec_driver_sql("ALTER TABLE state_status ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(255)")
+        connection.exec_driver_sql("ALTER TABLE state_status ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP "
+                                   "WITHOUT TIME ZONE")
+
+
+def add_due_times(engine: Engine) -> None:
+    """
+    Adds the `due_at` column of runs parked until a due time to `state_entry` and `state_entry_archive` created by
+    older versions and creates its index. Columns that already exist are skipped, so it's safe to run more than
+    once.
+    :param engine: engine connected to the database with FSM tables.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in (StateEntry.__table__, StateEntryArchive.__table__):
+            if inspector.has_table(table.name):
+                connection.exec_driver_sql("ALTER TABLE {} ADD COLUMN IF NOT EXISTS due_at TIMESTAMP WITHOUT TIME ZONE"
+                                           .format(table.name))
+    create_indexes(engine)
+
+
+def add_step_results(engine: Engine) -> None:
+    """
+    Creates the `step_result` table of results recorded for `StepMemo` states in databases created by older
+    versions. It's skipped if it already exists, so it's safe to run more than once. `archive_runs` deletes
+    results of archived runs from it, so run this before deploying this version.
+    :param engine: engine connected to the database with FSM tables.
+    """
+    StepResult.__table__.create(engine, checkfirst=True)
+
+
+def add_archive_tables(engine: Engine) -> None:
+    """
+    Creates the `state_entry_archive` and `state_status_archive` tables `PostgreStateStorage.archive_runs` moves
+    runs to in databases created by older versions. Tables that already exist are skipped, so it's safe to run more
+    than once.
+    :param engine: engine connected to the database with FSM tables.
+    """
+    for table in (StateEntryArchive.__table__, StateStatusArchive.__table__):
+        table.create(engine, checkfirst=True)
@@ -1,30 +1,79 @@
+import base64
+import json
+import zlib
+from contextvars import ContextVar
 from datetime import datetime
-from sqlalchemy import (Column, Integer, BigInteger, String, Boolean, DateTime)
-from sqlalchemy.dialects.postgresql import JSON
+from typing import Optional, Any, Tuple, Dict
+from sqlalchemy import (Column, Integer, BigInteger, String, Boolean, DateTime, Index, text)
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.engine import Dialect
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.types import TypeDecorator
 from fsm import TERMINAL_STATE, INITIAL_STATE
 
-Base = declarative_base()
+Base: Any = declarative_base()
 
+# threshold in bytes and zlib level of the storage whose session writes in the current context, set by the session
+# scopes of a storage created with `compress_params_over`
+params_compression: ContextVar[Optional[Tuple[int, int]]] = ContextVar('fsm_params_compression', default=None)
 
-class StateError(dict):
+
+class CompressedJSONB(TypeDecorator[Any]):
+    """
+    JSONB that stores values whose JSON is longer than the threshold of `params_compression` as a zlib compressed
+    envelope, so large params rewritten on every retry take less space and WAL. Compressed values are opaque to SQL,
+    but are always read back transparently.
+    """
+    impl = JSONB
+    cache_ok = True
+
+    ENVELOPE_KEY = '__fsm_zlib__'
+
+    def process_bind_param(self, value: Any, dialect: Dialect) -> Any:
+        compression = params_compression.get()
+        if value is None or compression is None:
+            return value
+        threshold_bytes, level = compression
+        encoded = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(encoded) <= threshold_bytes:
+            return value
+        return {self.ENVELOPE_KEY: base64.b64encode(zlib.compress(encoded, level)).decode('ascii')}
+
+    def process_result_value(self, value: Any, dialect: Dialect) -> Any:
+        if isinstance(value, dict) and len(value) == 1 and self.ENVELOPE_KEY in value:
+            return json.loads(zlib.decompress(base64.b64decode(value[self.ENVELOPE_KEY])))
+        return value
+
+
+class StateError(Dict[str, Any]):
     def __init__(self, error: str, visit_idx: int) -> None:
         dict.__init__(self, error=error, visit_idx=visit_idx)
 
 
 class StateEntry(Base):
     __tablename__ = 'state_entry'
+    __table_args__ = (
+        # find_state and upserts of a state
+        Index('ix_state_entry_tenant_run_name', 'tenant_id', 'run_id', 'name', unique=True),
+        # iter_history pages of a tenant
+        Index('ix_state_entry_tenant_id', 'tenant_id', 'id'),
+        # iter_yielded_runs, only the few parked entries are indexed
+        Index('ix_state_entry_yielded', 'tenant_id', 'id', postgresql_where=text('yielded')),
+        # get_due_runs, only entries parked until a due time are indexed
+        Index('ix_state_entry_due', 'tenant_id', 'due_at', postgresql_where=text('due_at IS NOT NULL')),
+    )
 
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     tenant_id = Column(String(255), nullable=False)  # TODO: define FK
     name = Column(String(255), nullable=False)
     start_time = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
     end_time = Column(DateTime, nullable=True)
-    params = Column(JSON, nullable=False, default=lambda: {})
+    params = Column(CompressedJSONB, nullable=False, default=lambda: {})
     run_id = Column(String(255), nullable=False)
     visit_count = Column(Integer, nullable=False, default=1)
-    errors = Column(JSON, nullable=False, default=lambda: [])
+    errors = Column(JSONB, nullable=False, default=lambda: [])
     yielded = Column(Boolean, nullable=False, default=False)
+    due_at = Column(DateTime, nullable=True)
 
     def __repr__(self) -> str:
         return "<StateEntry(id='%s', name='%s', run_id='%s')>" % (self.id, self.name, self.run_id)
@@ -43,13 +92,95 @@ class StateEntry(Base):
 
 class StateStatus(Base):
     __tablename__ = 'state_status'
+    __table_args__ = (
+        # get_last_state of a run and status upserts
+        Index('ix_state_status_tenant_run', 'tenant_id', 'run_id', unique=True, postgresql_include=['last_state_id']),
+        # get_last_state without a run, most recently updated run of a tenant
+        Index('ix_state_status_tenant_update_time', 'tenant_id', 'update_time'),
+        # get_active_runs
+        Index('ix_state_status_active', 'tenant_id', 'update_time',
+              postgresql_where=text("ref_state_name <> '{}'".format(TERMINAL_STATE))),
+        # archive_runs of finished runs
+        Index('ix_state_status_terminal', 'tenant_id', 'update_time',
+              postgresql_where=text("ref_state_name = '{}'".format(TERMINAL_STATE))),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     tenant_id = Column(String(255), nullable=False)  # TODO: define FK
+    run_id = Column(String(255), nullable=False)
+    last_state_id = Column(BigInteger, nullable=False)
+    update_time = Column(DateTime, nullable=False)
+    ref_state_name = Column(String(255), nullable=False)
+    # worker holding the run, see `PostgreStateStorage.claim_runs`
+    lease_owner = Column(String(255), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+
+    def __repr__(self) -> str:
+        return "<StateStatus(run_id='%s', last_state_id='%s', update_time='%s', ref_state_name='%s')>" % (
+            self.run_id, self.last_state_id, self.update_time, self.ref_state_name)
+
+
+class StepResult(Base):
+    """Action results recorded by `PostgreStateStorage.save_step_result`, deleted with their runs by `archive_runs`."""
+    __tablename__ = 'step_result'
+    __table_args__ = (
+        # find_step_result and inserts skipping recorded steps
+        Index('ix_step_result_step', 'tenant_id', 'run_id', 'state_name', 'visit_count', 'params_hash', unique=True),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    tenant_id = Column(String(255), nullable=False)
+    run_id = Column(String(255), nullable=False)
+    state_name = Column(String(255), nullable=False)
+    visit_count = Column(Integer, nullable=False)
+    params_hash = Column(String(64), nullable=False)
+    result = Column(CompressedJSONB, nullable=False)
+    create_time = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return "<StepResult(run_id='%s', state_name='%s', visit_count='%s')>" % (
+            self.run_id, self.state_name, self.visit_count)
+
+
+class StateEntryArchive(Base):
+    """`state_entry` rows of runs moved out of the hot table by `PostgreStateStorage.archive_runs`."""
+    __tablename__ = 'state_entry_archive'
+    __table_args__ = (
+        Index('ix_state_entry_archive_tenant_run', 'tenant_id', 'run_id'),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    tenant_id = Column(String(255), nullable=False)
+    name = Column(String(255), nullable=False)
+    start_time = Column(DateTime, nullable=False)
+    end_time = Column(DateTime, nullable=True)
+    params = Column(CompressedJSONB, nullable=False)
+    run_id = Column(String(255), nullable=False)
+    visit_count = Column(Integer, nullable=False)
+    errors = Column(JSONB, nullable=False)
+    yielded = Column(Boolean, nullable=False)
+    due_at = Column(DateTime, nullable=True)
+    archived_at = Column(DateTime, nullable=False, server_default=text("(now() at time zone 'utc')"))
+
+    def __repr__(self) -> str:
+        return "<StateEntryArchive(id='%s', name='%s', run_id='%s')>" % (self.id, self.name, self.run_id)
+
+
+class StateStatusArchive(Base):
+    """`state_status` rows of runs moved out of the hot table by `PostgreStateStorage.archive_runs`."""
+    __tablename__ = 'state_status_archive'
+    __table_args__ = (
+        Index('ix_state_status_archive_tenant_run', 'tenant_id', 'run_id'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    tenant_id = Column(String(255), nullable=False)
+    run_id = Column(String(255), nullable=False)
     last_state_id = Column(BigInteger, nullable=False)
     update_time = Column(DateTime, nullable=False)
     ref_state_name = Column(String(255), nullable=False)
+    archived_at = Column(DateTime, nullable=False, server_default=text("(now() at time zone 'utc')"))
 
     def __repr__(self) -> str:
-        return "<StateStatus(last_state_id='%s', update_time='%s', ref_state_name='%s')>" % (
-            self.last_state_id, self.update_time, self.ref_state_name)
+        return "<StateStatusArchive(run_id='%s', last_state_id='%s', ref_state_name='%s')>" % (
+            self.run_id, self.last_state_id, self.ref_state_name)
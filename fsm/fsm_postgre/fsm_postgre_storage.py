@@ -1,24 +1,31 @@
 import logging
+import threading
 import uuid
 from contextlib import contextmanager
-from datetime import datetime
-from typing import Optional, List
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Optional, List, Iterator, ContextManager, Tuple, Sequence
 from fsm import TERMINAL_STATE, INITIAL_STATE, JsonParams
 from fsm.fsm_persistence import StateStorage
-from sqlalchemy import asc, inspect, DateTime, desc
+from sqlalchemy import asc, inspect, DateTime, desc, func, select, bindparam, String, update, Select, \
+    delete, or_, and_, Update, Insert as StandardInsert
+from sqlalchemy.dialects.postgresql import Insert, JSONB
 from sqlalchemy.exc import OperationalError
 
-from fsm.fsm_postgre.fsm_postgre_models import StateEntry, StateStatus, StateError
+from fsm.fsm_postgre.fsm_postgre_models import StateEntry, StateStatus, StateError, StateEntryArchive, \
+    StateStatusArchive, StepResult, params_compression
 from sqlalchemy.orm.session import Session, sessionmaker
 
 logger = logging.getLogger(__name__)
 
 
 @contextmanager
-def _acquire_db_session(DBSession: sessionmaker) -> Session:
-    """used in 'with' statement"""
+def _acquire_db_session(DBSession: sessionmaker[Session],
+                        compression: Optional[Tuple[int, int]] = None) -> Iterator[Session]:
+    """used in 'with' statement, params written until the session is committed are compressed with `compression`"""
     db_session = DBSession(expire_on_commit=False)
     db_session.expire_on_commit = False
+    compression_token = params_compression.set(compression)
     try:
         yield db_session
         db_session.commit()
@@ -33,38 +40,345 @@ def _acquire_db_session(DBSession: sessionmaker) -> Session:
             raise ex
     finally:
         db_session.close()
+        params_compression.reset(compression_token)
+
+
+@contextmanager
+def _join_db_session(db_session: Session) -> Iterator[Session]:
+    """used in 'with' statement when a session is already open for the current step"""
+    yield db_session
+    db_session.flush()
+
+
+@lru_cache(maxsize=None)
+def _upsert_current_state_statement(with_error: bool, replace: bool = False) -> Insert:
+    """
+    Builds `INSERT ... ON CONFLICT DO UPDATE` of a state entry chained into the status upsert, so a step is committed
+    with one statement. Built once per variant and executed with bound parameters to hit SQLAlchemy compiled cache.
+    :param replace: an existing entry is replaced like a new one instead of counting another visit.
+    """
+    entry_stmt = Insert(StateEntry).values(tenant_id=bindparam('tenant_id'),
+                                           run_id=bindparam('run_id'),
+                                           name=bindparam('name'),
+                                           params=bindparam('params', type_=StateEntry.params.type),
+                                           start_time=bindparam('start_time', type_=DateTime),
+                                           end_time=bindparam('end_time', type_=DateTime),
+                                           errors=bindparam('errors', type_=JSONB),
+                                           visit_count=1,
+                                           yielded=False)
+    on_conflict = {
+        StateEntry.params: entry_stmt.excluded.params,
+        StateEntry.start_time: entry_stmt.excluded.start_time,
+        StateEntry.end_time: entry_stmt.excluded.end_time,
+        StateEntry.visit_count: StateEntry.visit_count + 1,
+    }
+    if replace:
+        on_conflict[StateEntry.visit_count] = 1
+        on_conflict[StateEntry.errors] = entry_stmt.excluded.errors
+        on_conflict[StateEntry.yielded] = False
+        on_conflict[StateEntry.due_at] = None
+    elif with_error:
+        new_error = func.jsonb_build_object('error', bindparam('error', type_=String),
+                                            'visit_idx', StateEntry.visit_count + 1)
+        on_conflict[StateEntry.errors] = StateEntry.errors.op('||')(func.jsonb_build_array(new_error))
+    upserted = entry_stmt.on_conflict_do_update(
+        index_elements=[StateEntry.tenant_id, StateEntry.run_id, StateEntry.name],
+        set_=on_conflict).returning(StateEntry.id, StateEntry.name).cte('upserted_state')
+    status_stmt = Insert(StateStatus).from_select(
+        [StateStatus.tenant_id, StateStatus.run_id, StateStatus.last_state_id, StateStatus.ref_state_name,
+         StateStatus.update_time],
+        select(bindparam('tenant_id', type_=String), bindparam('run_id', type_=String), upserted.c.id, upserted.c.name,
+               bindparam('update_time', type_=DateTime)))
+    return status_stmt.on_conflict_do_update(
+        index_elements=[StateStatus.tenant_id, StateStatus.run_id],
+        set_={StateStatus.last_state_id: status_stmt.excluded.last_state_id,
+              StateStatus.ref_state_name: status_stmt.excluded.ref_state_name,
+              StateStatus.update_time: status_stmt.excluded.update_time}).add_cte(upserted)
+
+
+def _start_runs_statement(tenant_id: str, initial_states: List[JsonParams], update_time: datetime) -> Insert:
+    """
+    Builds a multi-row insert of initial states chained into the insert of their status rows, so a batch of runs
+    is started with one statement.
+    """
+    started = Insert(StateEntry).values(initial_states).\
+        returning(StateEntry.id, StateEntry.run_id, StateEntry.name).cte('started_state')
+    return Insert(StateStatus).from_select(
+        [StateStatus.tenant_id, StateStatus.run_id, StateStatus.last_state_id, StateStatus.ref_state_name,
+         StateStatus.update_time],
+        select(bindparam('tenant_id', tenant_id, type_=String), started.c.run_id, started.c.id, started.c.name,
+               bindparam('update_time', update_time, type_=DateTime))).add_cte(started)
+
+
+def _initial_state_values(tenant_id: str, params_list: List[JsonParams]) -> List[JsonParams]:
+    now = datetime.utcnow()
+    return [{'tenant_id': tenant_id,
+             'run_id': str(uuid.uuid4()),
+             'name': INITIAL_STATE,
+             'params': params if params is not None else {},
+             'start_time': now,
+             'end_time': now,
+             'visit_count': 1,
+             'errors': [],
+             'yielded': False} for params in params_list]
+
+
+def _history_query(tenant_id: str, run_id: Optional[str] = None, since: Optional[datetime] = None,
+                   until: Optional[datetime] = None, after_id: Optional[int] = None,
+                   limit: Optional[int] = None) -> Select[Any]:
+    """Entries of a tenant in ID order, a page of them after `after_id` for keyset pagination."""
+    query = select(StateEntry).where(StateEntry.tenant_id == tenant_id)
+    if run_id is not None:
+        query = query.where(StateEntry.run_id == run_id)
+    if since is not None:
+        query = query.where(StateEntry.start_time >= since)
+    if until is not None:
+        query = query.where(StateEntry.start_time < until)
+    if after_id is not None:
+        query = query.where(StateEntry.id > after_id)
+    return query.order_by(asc(StateEntry.id)).limit(limit)
+
+
+def _yielded_runs_query(tenant_id: str, after_id: Optional[int], limit: int) -> Select[Any]:
+    """
+    A page of yielded entries of a tenant in ID order, served by the partial `ix_state_entry_yielded` index.
+    Every row tells whether the entry is still the last state of its run, pages are keyed on all yielded entries
+    so a short page means the end.
+    """
+    entry_table, status_table = StateEntry.__table__, StateStatus.__table__
+    query = select(entry_table.c.id, entry_table.c.run_id, status_table.c.id.isnot(None).label('is_last')).\
+        outerjoin(status_table, and_(status_table.c.tenant_id == entry_table.c.tenant_id,
+                                     status_table.c.run_id == entry_table.c.run_id,
+                                     status_table.c.last_state_id == entry_table.c.id)).\
+        where(entry_table.c.tenant_id == tenant_id).\
+        where(entry_table.c.yielded).\
+        where(entry_table.c.due_at.is_(None))
+    if after_id is not None:
+        query = query.where(entry_table.c.id > after_id)
+    return query.order_by(asc(entry_table.c.id)).limit(limit)
+
+
+def _due_runs_query(tenant_id: str, until: datetime, limit: int) -> Select[Any]:
+    """Runs parked until a due time at or before `until`, earliest first, served by the partial `ix_state_entry_due`
+    index."""
+    entry_table, status_table = StateEntry.__table__, StateStatus.__table__
+    return select(entry_table.c.run_id, entry_table.c.due_at).\
+        join(status_table, and_(status_table.c.tenant_id == entry_table.c.tenant_id,
+                                status_table.c.run_id == entry_table.c.run_id,
+                                status_table.c.last_state_id == entry_table.c.id)).\
+        where(entry_table.c.tenant_id == tenant_id).\
+        where(entry_table.c.due_at.isnot(None)).\
+        where(entry_table.c.due_at <= until).\
+        order_by(asc(entry_table.c.due_at)).\
+        limit(limit)
+
+
+def _archive_runs_statement(tenant_id: str, finished_before: datetime, stale_before: Optional[datetime],
+                            limit: int) -> StandardInsert:
+    """
+    Moves entries and statuses of due runs into the archive tables with one statement: the runs are picked in a CTE,
+    their rows are deleted with `DELETE ... RETURNING` and inserted into the archive with `INSERT ... SELECT`.
+    Recorded step results of the runs are deleted. Runs locked by a concurrent step are skipped. Returns IDs of the
+    archived runs.
+    """
+    entry_table, status_table = StateEntry.__table__, StateStatus.__table__
+    due = and_(status_table.c.ref_state_name == TERMINAL_STATE, status_table.c.update_time < finished_before)
+    if stale_before is not None:
+        # a leased run may be in the middle of a step, no lock is held while its action runs
+        not_leased = or_(status_table.c.lease_expires_at.is_(None), status_table.c.lease_expires_at < datetime.utcnow())
+        due = or_(due, and_(status_table.c.update_time < stale_before, not_leased))
+    runs = select(status_table.c.tenant_id, status_table.c.run_id).\
+        where(status_table.c.tenant_id == tenant_id).\
+        where(due).\
+        order_by(asc(status_table.c.update_time)).\
+        limit(limit).\
+        with_for_update(skip_locked=True).\
+        cte('archived_run')
+    entry_columns = [column.name for column in StateEntryArchive.__table__.c if column.name != 'archived_at']
+    moved_entries = delete(entry_table).\
+        where(entry_table.c.tenant_id == runs.c.tenant_id).\
+        where(entry_table.c.run_id == runs.c.run_id).\
+        returning(*[entry_table.c[name] for name in entry_columns]).\
+        cte('moved_entry')
+    archived_entries = Insert(StateEntryArchive.__table__).\
+        from_select(entry_columns, select(*[moved_entries.c[name] for name in entry_columns])).\
+        cte('archived_entry')
+    status_columns = [column.name for column in StateStatusArchive.__table__.c if column.name != 'archived_at']
+    moved_statuses = delete(status_table).\
+        where(status_table.c.tenant_id == runs.c.tenant_id).\
+        where(status_table.c.run_id == runs.c.run_id).\
+        returning(*[status_table.c[name] for name in status_columns]).\
+        cte('moved_status')
+    step_result_table = StepResult.__table__
+    deleted_step_results = delete(step_result_table).\
+        where(step_result_table.c.tenant_id == runs.c.tenant_id).\
+        where(step_result_table.c.run_id == runs.c.run_id).\
+        cte('deleted_step_result')
+    return Insert(StateStatusArchive.__table__).\
+        from_select(status_columns, select(*[moved_statuses.c[name] for name in status_columns])).\
+        returning(StateStatusArchive.__table__.c.run_id).\
+        add_cte(archived_entries, deleted_step_results)
+
+
+def _claim_runs_statement(tenant_id: str, owner: str, limit: int, lease_seconds: float,
+                          run_ids: Optional[Sequence[str]] = None) -> Update:
+    """
+    Leases unfinished runs that aren't leased or whose lease expired with one `UPDATE ... RETURNING`. Yielded runs
+    are claimed once their due time passed, or whenever they are among `run_ids`. Candidate status rows are locked
+    with `FOR UPDATE SKIP LOCKED`, so concurrent claims and steps don't wait for each other and a run is never
+    handed to two workers. Returns IDs of the claimed runs.
+    """
+    entry_table, status_table = StateEntry.__table__, StateStatus.__table__
+    now = datetime.utcnow()
+    if run_ids is None:
+        due = or_(entry_table.c.yielded.is_(False), entry_table.c.due_at <= now)
+    else:
+        due = status_table.c.run_id.in_(run_ids)
+    claimable = select(status_table.c.id).\
+        join(entry_table, entry_table.c.id == status_table.c.last_state_id).\
+        where(status_table.c.tenant_id == tenant_id).\
+        where(status_table.c.ref_state_name != TERMINAL_STATE).\
+        where(due).\
+        where(or_(status_table.c.lease_expires_at.is_(None), status_table.c.lease_expires_at < now)).\
+        order_by(asc(status_table.c.update_time)).\
+        limit(limit).\
+        with_for_update(skip_locked=True, of=status_table).\
+        scalar_subquery()
+    return update(status_table).\
+        where(status_table.c.id.in_(claimable)).\
+        values(lease_owner=owner, lease_expires_at=now + timedelta(seconds=lease_seconds)).\
+        returning(status_table.c.run_id)
+
+
+def _lease_statement(tenant_id: str, run_id: str, owner: str, lease_expires_at: Optional[datetime]) -> Update:
+    """Renews a lease held by `owner`, or releases it when `lease_expires_at` is None. Returns the run ID if the
+    lease was held."""
+    status_table = StateStatus.__table__
+    return update(status_table).\
+        where(status_table.c.tenant_id == tenant_id).\
+        where(status_table.c.run_id == run_id).\
+        where(status_table.c.lease_owner == owner).\
+        values(lease_owner=owner if lease_expires_at is not None else None, lease_expires_at=lease_expires_at).\
+        returning(status_table.c.run_id)
+
+
+def _find_step_result_query(tenant_id: str, run_id: str, state_name: str, visit_count: int,
+                            params_digest: str) -> Select[Any]:
+    return select(StepResult.result).\
+        where(StepResult.tenant_id == tenant_id).\
+        where(StepResult.run_id == run_id).\
+        where(StepResult.state_name == state_name).\
+        where(StepResult.visit_count == visit_count).\
+        where(StepResult.params_hash == params_digest)
+
+
+def _save_step_result_statement(tenant_id: str, run_id: str, state_name: str, visit_count: int,
+                                params_digest: str, result: JsonParams) -> Insert:
+    """Inserts a step result, a result already recorded for the step is kept."""
+    return Insert(StepResult).\
+        values(tenant_id=tenant_id, run_id=run_id, state_name=state_name, visit_count=visit_count,
+               params_hash=params_digest, result=result, create_time=datetime.utcnow()).\
+        on_conflict_do_nothing(index_elements=[StepResult.tenant_id, StepResult.run_id, StepResult.state_name,
+                                               StepResult.visit_count, StepResult.params_hash])
+
+
+def _upsert_current_state_params(tenant_id: str, state_name: str, run_id: str, err: Optional[str],
+                                 params: JsonParams, start_time: datetime, end_time: datetime) -> JsonParams:
+    return {
+        'tenant_id': tenant_id,
+        'run_id': run_id,
+        'name': state_name,
+        'params': params,
+        'start_time': start_time,
+        'end_time': end_time,
+        'errors': [StateError(error=err, visit_idx=1)] if err else [],
+        'error': err,
+        'update_time': datetime.utcnow(),
+    }
 
 
 class PostgreStateStorage(StateStorage):
-    def __init__(self, DBSession: sessionmaker, tenant_id: str) -> None:
+    """
+    Stores FSM states in Postgres.
+    :param DBSession: session factory bound to the database that holds `state_entry` and `state_status` tables.
+    :param tenant_id: all states written and read by this storage are scoped by this tenant.
+    :param single_round_trip: if set, `set_current_state` commits a step with a single
+    `INSERT ... ON CONFLICT DO UPDATE` statement that also upserts the status row, instead of
+    several find/merge/delete/insert calls. Requires unique constraints declared in the models.
+    :param start_runs_batch_size: number of runs `start_runs` inserts with one statement.
+    :param compress_params_over: params and step results whose JSON is longer than this many bytes are stored zlib
+    compressed, None stores them as they are. Entries written before keep their format, all are read back as usual.
+    :param compression_level: zlib compression level, from 1 (fastest) to 9 (smallest).
+    """
+    def __init__(self, DBSession: sessionmaker[Session], tenant_id: str, single_round_trip: bool = False,
+                 start_runs_batch_size: int = 1000,
+                 compress_params_over: Optional[int] = None,
+                 compression_level: int = 6) -> None:
         self.DBSession = DBSession
         self.tenant_id = tenant_id
+        self.single_round_trip = single_round_trip
+        self.start_runs_batch_size = start_runs_batch_size
+        self._compression = (compress_params_over, compression_level) if compress_params_over is not None else None
+        self._local = threading.local()
         super().__init__()
 
-    def get_last_state(self, run_id: Optional[str]) -> Optional[StateEntry]:
-        with _acquire_db_session(self.DBSession) as db_session:
-            last_state_query = db_session.query(StateEntry).filter(StateEntry.tenant_id == self.tenant_id)
+    @contextmanager
+    def step(self) -> Iterator[None]:
+        if getattr(self._local, 'db_session', None) is not None:
+            yield
+            return
+        with _acquire_db_session(self.DBSession, self._compression) as db_session:
+            self._local.db_session = db_session
+            try:
+                yield
+            finally:
+                self._local.db_session = None
+
+    def _db_session(self) -> ContextManager[Session]:
+        step_session = getattr(self._local, 'db_session', None)
+        if step_session is not None:
+            return _join_db_session(step_session)
+        return _acquire_db_session(self.DBSession, self._compression)
+
+    def get_last_state(self, run_id: Optional[str] = None) -> Optional[StateEntry]:
+        with self._db_session() as db_session:
+            last_state_query = db_session.query(StateEntry).\
+                join(StateStatus, StateStatus.last_state_id == StateEntry.id).\
+                filter(StateStatus.tenant_id == self.tenant_id)
             if run_id is not None:
-                last_state_query = last_state_query.filter(StateEntry.run_id == run_id)
-            last_state = last_state_query.order_by(desc(StateEntry.id)).first()
+                last_state_query = last_state_query.filter(StateStatus.run_id == run_id)
+            else:
+                last_state_query = last_state_query.order_by(desc(StateStatus.update_time))
+            last_state = last_state_query.first()
             if last_state is not None:
                 return last_state
             else:
                 return None
 
-    def new_initial_state(self, params=None) -> StateEntry:
-        entry: StateEntry = StateEntry(name=INITIAL_STATE,
-                                       run_id=str(uuid.uuid4()),
-                                       start_time=datetime.utcnow(),
-                                       end_time=datetime.utcnow(),
-                                       params=params,
-                                       tenant_id=self.tenant_id)
-        with _acquire_db_session(self.DBSession) as db_session:
-            db_session.add(entry)
-        return entry
+    def new_initial_state(self, params: Optional[JsonParams] = None) -> StateEntry:
+        return StateEntry(name=INITIAL_STATE,
+                          run_id=str(uuid.uuid4()),
+                          start_time=datetime.utcnow(),
+                          end_time=datetime.utcnow(),
+                          params=params if params is not None else {},
+                          visit_count=1,
+                          errors=[],
+                          yielded=False,
+                          tenant_id=self.tenant_id)
+
+    def start_runs(self, params_list: List[JsonParams]) -> List[str]:
+        run_ids: List[str] = []
+        with self._db_session() as db_session:
+            for chunk_start in range(0, len(params_list), self.start_runs_batch_size):
+                initial_states = _initial_state_values(
+                    self.tenant_id, params_list[chunk_start:chunk_start + self.start_runs_batch_size])
+                db_session.connection().execute(_start_runs_statement(self.tenant_id, initial_states,
+                                                                      datetime.utcnow()))
+                run_ids.extend(state['run_id'] for state in initial_states)
+        return run_ids
 
     def _upsert_state(self, state: StateEntry) -> None:
-        with _acquire_db_session(self.DBSession) as db_session:
+        with self._db_session() as db_session:
             existing_state: Optional[StateEntry] = db_session.query(StateEntry).\
                 filter(StateEntry.name == state.name).\
                 filter(StateEntry.tenant_id == self.tenant_id).\
@@ -76,71 +390,230 @@ class PostgreStateStorage(StateStorage):
                 state.id = existing_state.id
                 db_session.merge(state)
 
+        self._state_written(state.run_id, state)
         self.set_last_state(state)
 
-    def find_state(self, state_name: str, run_id: str) -> StateEntry:
-        with _acquire_db_session(self.DBSession) as db_session:
+    def find_state(self, state_name: str, run_id: str) -> Optional[StateEntry]:
+        with self._db_session() as db_session:
             return db_session.query(StateEntry).\
                 filter(StateEntry.run_id == run_id). \
                 filter(StateEntry.tenant_id == self.tenant_id).\
                 filter(StateEntry.name == state_name).\
                 first()
 
-    def yield_state(self, state: StateEntry, is_yielded: bool) -> None:
+    def yield_state(self, state: StateEntry, is_yielded: bool, due_at: Optional[datetime] = None) -> None:
         state.yielded = is_yielded
-        with _acquire_db_session(self.DBSession) as db_session:
-            db_session.merge(state)
+        state.due_at = due_at if is_yielded else None
+        with self._db_session() as db_session:
+            db_session.execute(update(StateEntry).where(StateEntry.id == state.id).
+                               values(yielded=is_yielded, due_at=state.due_at))
+        self._state_written(state.run_id, state)
 
     def save_state(self, state: StateEntry) -> None:
-        with _acquire_db_session(self.DBSession) as db_session:
-            db_session.merge(state)
+        with self._db_session() as db_session:
+            if state.id is None:
+                db_session.add(state)
+            else:
+                db_session.merge(state)
+        self._state_written(state.run_id, state)
         self.set_last_state(state)
 
     def terminate(self, run_id: str) -> None:
-        state = StateEntry(name=TERMINAL_STATE,
-                           start_time=datetime.utcnow(),
-                           end_time=datetime.utcnow(),
-                           errors=[StateError(error="Max retry count reached", visit_idx=1)],
-                           run_id=run_id,
-                           tenant_id=self.tenant_id)
-        self._upsert_state(state)
+        self._upsert_state(self.build_terminal_state(run_id))
 
     def set_current_state(self, state_name: str, run_id: str, err: Optional[str], params: JsonParams,
-                          start_time: DateTime, end_time: DateTime) -> None:
-        existing_state = self.find_state(state_name, run_id)
+                          start_time: datetime, end_time: datetime) -> None:
+        if self.single_round_trip:
+            self._upsert_current_state(state_name, run_id, err, params, start_time, end_time)
+            self._state_written(run_id, None)
+            return
+        self.set_next_state(self.find_state(state_name, run_id), state_name, run_id, err, params, start_time,
+                            end_time)
+
+    def set_next_state(self, existing_state: Optional[StateEntry], state_name: str, run_id: str,
+                       err: Optional[str], params: JsonParams, start_time: datetime, end_time: datetime) -> None:
+        if self.single_round_trip:
+            self._upsert_current_state(state_name, run_id, err, params, start_time, end_time)
+            # the upsert changes an existing row the same way, a new row's ID isn't returned
+            self._state_written(run_id, self.build_next_state(existing_state, state_name, run_id, err, params,
+                                                              start_time, end_time) if existing_state else None)
+            return
+        # a retry returning the same params doesn't rewrite them, unless they were changed in place
+        params_changed = existing_state is None or existing_state.params is params or existing_state.params != params
+        state = self.build_next_state(existing_state, state_name, run_id, err, params, start_time, end_time)
         if existing_state:
+            # update by primary key, merge would load the row first
+            values = {StateEntry.start_time: state.start_time,
+                      StateEntry.end_time: state.end_time,
+                      StateEntry.visit_count: state.visit_count}
+            if params_changed:
+                values[StateEntry.params] = state.params
             if err:
-                existing_state.errors.append(StateError(error=err, visit_idx=existing_state.visit_count + 1))
-            existing_state.params = params
-            existing_state.start_time = start_time
-            existing_state.end_time = end_time
-            existing_state.visit_count += 1
-            self.save_state(existing_state)
+                # append in place instead of rewriting all errors of the state
+                values[StateEntry.errors] = StateEntry.errors.op('||')(
+                    bindparam('new_errors', [state.errors[-1]], type_=JSONB))
+            with self._db_session() as db_session:
+                db_session.execute(update(StateEntry).where(StateEntry.id == state.id).values(values))
+            self._state_written(run_id, state)
+            self.set_last_state(state)
         else:
-            state = StateEntry(name=state_name,
-                               start_time=start_time,
-                               end_time=end_time,
-                               errors=[StateError(error=err, visit_idx=1)] if err else [],
-                               params=params,
-                               run_id=run_id,
-                               visit_count=1,
-                               tenant_id=self.tenant_id)
             self._upsert_state(state)
 
+    def build_next_state(self, existing_state: Optional[StateEntry], state_name: str, run_id: str,
+                         err: Optional[str], params: JsonParams,
+                         start_time: datetime, end_time: datetime) -> StateEntry:
+        if existing_state is None:
+            return StateEntry(name=state_name,
+                              start_time=start_time,
+                              end_time=end_time,
+                              errors=[StateError(error=err, visit_idx=1)] if err else [],
+                              params=params,
+                              run_id=run_id,
+                              visit_count=1,
+                              yielded=False,
+                              tenant_id=self.tenant_id)
+        if err:
+            existing_state.append_error(StateError(error=err, visit_idx=existing_state.visit_count + 1))
+        existing_state.params = params
+        existing_state.start_time = start_time
+        existing_state.end_time = end_time
+        existing_state.visit_count += 1
+        return existing_state
+
+    def build_terminal_state(self, run_id: str) -> StateEntry:
+        return StateEntry(name=TERMINAL_STATE,
+                          start_time=datetime.utcnow(),
+                          end_time=datetime.utcnow(),
+                          errors=[StateError(error="Max retry count reached", visit_idx=1)],
+                          params={},
+                          run_id=run_id,
+                          visit_count=1,
+                          yielded=False,
+                          tenant_id=self.tenant_id)
+
+    def save_states(self, states: List[StateEntry]) -> None:
+        new_states = [state for state in states if state.id is None]
+        existing_states = [state for state in states if state.id is not None]
+        with self._db_session() as db_session:
+            if existing_states:
+                db_session.execute(update(StateEntry), [{'id': state.id,
+                                                         'params': state.params,
+                                                         'start_time': state.start_time,
+                                                         'end_time': state.end_time,
+                                                         'visit_count': state.visit_count,
+                                                         'errors': state.errors,
+                                                         'yielded': state.yielded,
+                                                         'due_at': state.due_at} for state in existing_states])
+            if new_states:
+                db_session.add_all(new_states)
+                db_session.flush()
+        for state in states:
+            self._state_written(state.run_id, state)
+
+    def set_last_states(self, states: List[StateEntry]) -> None:
+        if not states:
+            return
+        update_time = datetime.utcnow()
+        status_stmt = Insert(StateStatus).values([{'tenant_id': self.tenant_id,
+                                                   'run_id': state.run_id,
+                                                   'last_state_id': state.id,
+                                                   'ref_state_name': state.name,
+                                                   'update_time': update_time} for state in states])
+        status_stmt = status_stmt.on_conflict_do_update(
+            index_elements=[StateStatus.tenant_id, StateStatus.run_id],
+            set_={StateStatus.last_state_id: status_stmt.excluded.last_state_id,
+                  StateStatus.ref_state_name: status_stmt.excluded.ref_state_name,
+                  StateStatus.update_time: status_stmt.excluded.update_time})
+        with self._db_session() as db_session:
+            db_session.execute(status_stmt)
+
+    def _upsert_current_state(self, state_name: str, run_id: str, err: Optional[str], params: JsonParams,
+                              start_time: datetime, end_time: datetime) -> None:
+        with self._db_session() as db_session:
+            db_session.connection().execute(_upsert_current_state_statement(bool(err)),
+                                            _upsert_current_state_params(self.tenant_id, state_name, run_id, err,
+                                                                         params, start_time, end_time))
+
+    def get_active_runs(self, limit: Optional[int] = None) -> List[str]:
+        with self._db_session() as db_session:
+            active_runs_query = db_session.query(StateStatus.run_id).\
+                filter(StateStatus.tenant_id == self.tenant_id).\
+                filter(StateStatus.ref_state_name != TERMINAL_STATE).\
+                order_by(asc(StateStatus.update_time))
+            if limit is not None:
+                active_runs_query = active_runs_query.limit(limit)
+            return [run_id for run_id, in active_runs_query.all()]
+
     def get_db_history(self) -> List[StateEntry]:
-        with _acquire_db_session(self.DBSession) as db_session:
-            return db_session.query(StateEntry).order_by(asc(StateEntry.id)).all()
+        with self._db_session() as db_session:
+            return list(db_session.execute(_history_query(self.tenant_id)).scalars().all())
+
+    def iter_history(self, run_id: Optional[str] = None, since: Optional[datetime] = None,
+                     until: Optional[datetime] = None, batch_size: int = 1000) -> Iterator[StateEntry]:
+        last_id = None
+        while True:
+            # a session per page, pages are committed and detached before they are handed out
+            with self._db_session() as db_session:
+                batch = db_session.execute(_history_query(self.tenant_id, run_id, since, until, last_id,
+                                                          batch_size)).scalars().all()
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1].id
+
+    def iter_yielded_runs(self, batch_size: int = 1000) -> Iterator[str]:
+        last_id = None
+        while True:
+            with self._db_session() as db_session:
+                batch = db_session.execute(_yielded_runs_query(self.tenant_id, last_id, batch_size)).all()
+            yield from [run_id for _, run_id, is_last in batch if is_last]
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1].id
+
+    def get_due_runs(self, until: datetime, limit: int = 1000) -> List[Tuple[str, datetime]]:
+        with self._db_session() as db_session:
+            return [(run_id, due_at) for run_id, due_at in
+                    db_session.execute(_due_runs_query(self.tenant_id, until, limit)).all()]
 
     def set_last_state(self, state: StateEntry) -> None:
-        inspect(state)
-        with _acquire_db_session(self.DBSession) as db_session:
-            status: StateStatus = db_session.query(StateStatus).\
-                filter(StateStatus.tenant_id == self.tenant_id).\
-                first()
-            if status is not None:
-                db_session.delete(status)
-            status = StateStatus(last_state_id=state.id,
-                                 ref_state_name=state.name,
-                                 update_time=datetime.utcnow(),
-                                 tenant_id=self.tenant_id)
-            db_session.add(status)
+        self.set_last_states([state])
+
+    def archive_runs(self, finished_before: datetime, stale_before: Optional[datetime] = None,
+                     limit: int = 1000) -> int:
+        with self._db_session() as db_session:
+            run_ids = list(db_session.execute(_archive_runs_statement(self.tenant_id, finished_before,
+                                                                      stale_before, limit)).scalars())
+        self._runs_archived(run_ids)
+        return len(run_ids)
+
+    def claim_runs(self, owner: str, limit: int, lease_seconds: float,
+                   run_ids: Optional[Sequence[str]] = None) -> List[str]:
+        with self._db_session() as db_session:
+            claimed_run_ids = list(db_session.execute(_claim_runs_statement(self.tenant_id, owner, limit,
+                                                                            lease_seconds, run_ids)).scalars())
+        self._runs_claimed(claimed_run_ids)
+        return claimed_run_ids
+
+    def renew_lease(self, run_id: str, owner: str, lease_seconds: float) -> bool:
+        lease_expires_at = datetime.utcnow() + timedelta(seconds=lease_seconds)
+        with self._db_session() as db_session:
+            return db_session.execute(_lease_statement(self.tenant_id, run_id, owner,
+                                                       lease_expires_at)).first() is not None
+
+    def release_run(self, run_id: str, owner: str) -> None:
+        with self._db_session() as db_session:
+            db_session.execute(_lease_statement(self.tenant_id, run_id, owner, None))
+
+    def find_step_result(self, run_id: str, state_name: str, visit_count: int,
+                         params_digest: str) -> Optional[JsonParams]:
+        with self._db_session() as db_session:
+            return db_session.execute(_find_step_result_query(self.tenant_id, run_id, state_name, visit_count,
+                                                              params_digest)).scalar()
+
+    def save_step_result(self, run_id: str, state_name: str, visit_count: int, params_digest: str,
+                         result: JsonParams) -> None:
+        # a session of its own, committed before the step that produced the result
+        with _acquire_db_session(self.DBSession, self._compression) as db_session:
+            db_session.execute(_save_step_result_statement(self.tenant_id, run_id, state_name, visit_count,
+                                                           params_digest, result))
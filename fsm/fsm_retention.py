@@ -0,0 +1,136 @@
+"""
+Moves finished runs out of the hot FSM tables with `StateStorage.archive_runs`, as a background thread or a CLI:
+
+    python -m fsm.fsm_retention --db-url postgresql://user@localhost/fsm --tenant-id 123 --finished-ttl-hours 24
+    python -m fsm.fsm_retention --mongo-url mongodb://localhost/fsm --finished-ttl-hours 24 --every-seconds 300
+"""
+import argparse
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Optional, Generic
+
+from fsm.fsm_persistence import StateStorage, RunId
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionJob(Generic[RunId]):
+    """
+    Archives runs in batches, pausing between batches so the job doesn't compete with FSM steps for the database.
+    :param storage: storage whose runs are archived, it has to implement `archive_runs`. Postgres databases created
+    by older versions need the archive tables from `fsm_postgre_migrations.add_archive_tables` first.
+    :param finished_ttl: runs in the terminal state are archived once they weren't updated for this long.
+    :param stale_ttl: runs in any state are archived once they weren't updated for this long, None keeps
+    unfinished runs forever.
+    :param batch_size: runs archived per `archive_runs` call, each call is one transaction in Postgres.
+    :param pause_seconds: sleep between batches of one pass.
+    :param interval_seconds: sleep between passes of the background thread started with `start`.
+    """
+    def __init__(self, storage: StateStorage[RunId],
+                 finished_ttl: timedelta = timedelta(days=1),
+                 stale_ttl: Optional[timedelta] = None,
+                 batch_size: int = 1000,
+                 pause_seconds: float = 0.1,
+                 interval_seconds: float = 60) -> None:
+        self.storage: StateStorage[RunId] = storage
+        self.finished_ttl = finished_ttl
+        self.stale_ttl = stale_ttl
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds
+        self.interval_seconds = interval_seconds
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> int:
+        """
+        Archives every run that is due, batch by batch. Cutoffs are computed once, so runs finishing during
+        the pass wait for the next one.
+        :return: number of archived runs.
+        """
+        now = datetime.utcnow()
+        finished_before = now - self.finished_ttl
+        stale_before = now - self.stale_ttl if self.stale_ttl is not None else None
+        archived = 0
+        while not self._stopped.is_set():
+            batch = self.storage.archive_runs(finished_before, stale_before, self.batch_size)
+            archived += batch
+            if batch < self.batch_size:
+                break
+            self._stopped.wait(self.pause_seconds)
+        logger.info("Archived {} runs.".format(archived))
+        return archived
+
+    def start(self) -> None:
+        """Runs a pass every `interval_seconds` on a daemon thread until `stop` is called."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run_periodically, name='fsm-retention', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the background thread, a batch in progress is finished first."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run_periodically(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception("Archiving runs failed, retrying in the next pass: {}".format(e))
+            self._stopped.wait(self.interval_seconds)
+
+
+def _storage_from_args(args: argparse.Namespace) -> StateStorage[Any]:
+    if args.db_url is not None:
+        import sqlalchemy
+        from sqlalchemy.orm import sessionmaker
+        from fsm.fsm_postgre.fsm_postgre_storage import PostgreStateStorage
+        return PostgreStateStorage(sessionmaker(bind=sqlalchemy.create_engine(args.db_url)), args.tenant_id)
+    from mongoengine import connect
+    from fsm.fsm_mongo.fsm_mongo_storage import MongoStateStorage
+    connect(host=args.mongo_url)
+    return MongoStateStorage(archive_ttl_seconds=int(args.archive_ttl_hours * 3600)
+                             if args.archive_ttl_hours is not None else None)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    backend = parser.add_mutually_exclusive_group(required=True)
+    backend.add_argument('--db-url', default=None, help='SQLAlchemy URL of the Postgres database with FSM tables')
+    backend.add_argument('--mongo-url', default=None, help='URL of the Mongo database with FSM collections')
+    parser.add_argument('--tenant-id', default=None, help='tenant whose runs are archived, required for Postgres')
+    parser.add_argument('--finished-ttl-hours', type=float, default=24,
+                        help='archive finished runs not updated for this long, default: 24')
+    parser.add_argument('--stale-ttl-hours', type=float, default=None,
+                        help='archive unfinished runs not updated for this long, default: never')
+    parser.add_argument('--archive-ttl-hours', type=float, default=None,
+                        help='Mongo only: delete archived documents this long after archiving, default: never')
+    parser.add_argument('--batch-size', type=int, default=1000, help='runs archived per transaction')
+    parser.add_argument('--pause-seconds', type=float, default=0.1, help='sleep between batches')
+    parser.add_argument('--every-seconds', type=float, default=None,
+                        help='keep running a pass this often instead of a single pass')
+    args = parser.parse_args()
+    if args.db_url is not None and args.tenant_id is None:
+        parser.error('--tenant-id is required with --db-url')
+    logging.basicConfig(level=logging.INFO)
+    job: RetentionJob[Any] = RetentionJob(
+        _storage_from_args(args),
+        finished_ttl=timedelta(hours=args.finished_ttl_hours),
+        stale_ttl=timedelta(hours=args.stale_ttl_hours) if args.stale_ttl_hours is not None else None,
+        batch_size=args.batch_size,
+        pause_seconds=args.pause_seconds,
+        interval_seconds=args.every_seconds or 0)
+    if args.every_seconds is None:
+        job.run_once()
+        return
+    try:
+        job._run_periodically()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Optional, Generic, Set, List, Tuple
+
+from fsm.fsm_executor import FsmExecutor, ExecutorReport
+from fsm.fsm_persistence import RunId
+
+logger = logging.getLogger(__name__)
+
+
+class ResumeScheduler(Generic[RunId]):
+    """
+    Resumes runs parked in a yielded state, once per call of `run_once` or periodically from a background thread.
+    Yielded runs are found with `StateStorage.iter_yielded_runs`, so a pass costs as much as there are yielded
+    runs, however many runs are stored. They are claimed and resumed a batch at a time by
+    `FsmExecutor.run_claimed`, whose `workers` and `max_in_flight` bound the concurrency. Runs leased by other
+    workers are skipped, so schedulers and executors can share a storage.
+    :param executor: executor of the FSM definition the yielded runs belong to.
+    :param batch_size: runs read from the storage and resumed per batch.
+    :param interval_seconds: sleep between passes of the background thread started with `start`.
+    :param lease_seconds: see `StateStorage.claim_runs`.
+    """
+    def __init__(self, executor: FsmExecutor[RunId],
+                 batch_size: int = 1000,
+                 interval_seconds: float = 60,
+                 lease_seconds: float = 300) -> None:
+        self.executor: FsmExecutor[RunId] = executor
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.lease_seconds = lease_seconds
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> ExecutorReport:
+        """
+        Resumes every run that is yielded when the pass reaches it. A resumed run that yields again is left for
+        the next pass.
+        :return: aggregate counts and duration of the pass.
+        """
+        yielded_runs = self.executor.fsm.store.iter_yielded_runs(self.batch_size)
+        resumed: Set[RunId] = set()
+        runs, failed, elapsed_seconds = 0, 0, 0.0
+        while not self._stopped.is_set():
+            batch = [run_id for run_id in islice(yielded_runs, self.batch_size) if run_id not in resumed]
+            if not batch:
+                break
+            resumed.update(batch)
+            report = self.executor.run_claimed(lease_seconds=self.lease_seconds, run_ids=batch)
+            runs, failed, elapsed_seconds = runs + report.runs, failed + report.failed, \
+                elapsed_seconds + report.elapsed_seconds
+        logger.info("Resumed {} yielded runs ({} failed).".format(runs, failed))
+        return ExecutorReport(runs, failed, elapsed_seconds)
+
+    def start(self) -> None:
+        """Runs a pass every `interval_seconds` on a daemon thread until `stop` is called."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run_periodically, name='fsm-resume-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the background thread, a batch in progress is finished first."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run_periodically(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception("Resuming yielded runs failed, retrying in the next pass: {}".format(e))
+            self._stopped.wait(self.interval_seconds)
+
+
+class DueRunPoller(Generic[RunId]):
+    """
+    Wakes runs parked until a due time by a `retry_backoff` policy or by an action returning a delay. Runs due
+    within the next `poll_seconds` are loaded into a heap with one indexed `StateStorage.get_due_runs` query,
+    the poller then sleeps until the earliest due time and resumes due runs with `FsmExecutor.run_claimed`. An idle
+    poller makes one query per `poll_seconds`, however many runs are parked further ahead. Due runs leased by
+    other pollers or executors are skipped, so a run is never resumed twice.
+    :param executor: executor of the FSM definition the parked runs belong to.
+    :param poll_seconds: period of storage queries, a run parked after a query is woken at most this late.
+    :param batch_size: maximum number of due runs loaded per query, the next query is made as soon as they
+    are all resumed.
+    :param lease_seconds: see `StateStorage.claim_runs`.
+    """
+    def __init__(self, executor: FsmExecutor[RunId],
+                 poll_seconds: float = 1.0,
+                 batch_size: int = 1000,
+                 lease_seconds: float = 300) -> None:
+        self.executor: FsmExecutor[RunId] = executor
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self._heap: List[Tuple[datetime, RunId]] = []
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def poll(self, now: Optional[datetime] = None) -> int:
+        """
+        Replaces the heap with runs due within `poll_seconds` from `now`.
+        :return: number of loaded runs.
+        """
+        until = (now if now is not None else datetime.utcnow()) + timedelta(seconds=self.poll_seconds)
+        self._heap = [(due_at, run_id) for run_id, due_at in
+                      self.executor.fsm.store.get_due_runs(until, self.batch_size)]
+        heapq.heapify(self._heap)
+        return len(self._heap)
+
+    def run_due(self, now: Optional[datetime] = None) -> ExecutorReport:
+        """
+        Resumes loaded runs that are due at `now`.
+        :return: aggregate counts and throughput of the resumed runs.
+        """
+        now = now if now is not None else datetime.utcnow()
+        due_run_ids: List[RunId] = []
+        while self._heap and self._heap[0][0] <= now:
+            due_run_ids.append(heapq.heappop(self._heap)[1])
+        if not due_run_ids:
+            return ExecutorReport(0, 0, 0.0)
+        return self.executor.run_claimed(lease_seconds=self.lease_seconds, run_ids=due_run_ids)
+
+    def run_once(self) -> ExecutorReport:
+        """Resumes every run due now with a single query, e.g. from cron."""
+        self.poll()
+        return self.run_due()
+
+    def start(self) -> None:
+        """Polls and resumes due runs on a daemon thread until `stop` is called."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run_periodically, name='fsm-due-run-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the background thread, runs being resumed are finished first."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run_periodically(self) -> None:
+        next_poll = time.monotonic()
+        batch_full = False
+        while not self._stopped.is_set():
+            try:
+                if time.monotonic() >= next_poll or (batch_full and not self._heap):
+                    batch_full = self.poll() >= self.batch_size
+                    next_poll = time.monotonic() + self.poll_seconds
+                self.run_due()
+            except Exception as e:
+                logger.exception("Resuming due runs failed, retrying in the next poll: {}".format(e))
+                next_poll = time.monotonic() + self.poll_seconds
+            wait_seconds = next_poll - time.monotonic()
+            if self._heap:
+                wait_seconds = min(wait_seconds, (self._heap[0][0] - datetime.utcnow()).total_seconds())
+            self._stopped.wait(max(0.0, wait_seconds))
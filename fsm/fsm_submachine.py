@@ -0,0 +1,126 @@
+from typing import Dict, Any, Optional, Callable, List, NamedTuple, Union, Tuple
+
+from fsm import DEFAULT, TERMINAL_STATE, StateDefinition, JsonParams
+from fsm.fsm_definition import CompiledDefinition, compile_definition
+from fsm.fsm_persistence import StateStorage, StateEntryT
+
+# parent params key holding IDs of the child runs started for the current visit of a sub-machine state
+SUB_RUN_IDS = "__sub_run_ids__"
+# child params key holding the ID of the parent run
+PARENT_RUN_ID = "__parent_run_id__"
+
+# joins the parent's params and the final params of each child run into the params of the next parent state
+ChildMerge = Callable[[JsonParams, List[JsonParams]], JsonParams]
+
+
+def merge_children(params: JsonParams, results: List[JsonParams]) -> JsonParams:
+    """Final params of a single child as they are, params of fanned out children as a list under `children`."""
+    if len(results) == 1:
+        return results[0]
+    merged = dict(params)
+    merged['children'] = results
+    return merged
+
+
+class PendingSubRuns(NamedTuple):
+    """
+    Returned by `SubMachine.advance` while child runs haven't finished. The FSM stores `params` with the parent's
+    current state and calls the sub-machine again within the same step if `delay_seconds` is 0, otherwise it parks
+    the parent until then. Waiting doesn't count as a visit of the state.
+    """
+    params: JsonParams
+    delay_seconds: float
+
+
+class SubMachine(object):
+    """
+    State action running another FSM definition as child runs of the parent run, so reusable sequences are
+    defined once and large pipelines are split into small definitions. Use it as the action of a state:
+    the state succeeds once all children reach the terminal state, and fails if a child is terminated after
+    running out of visits or stops in another state without a transition. The parent run waits in that state
+    without using up its visits until the children finish.
+    Child runs are started in `storage` with the parent's run ID under `PARENT_RUN_ID` in their params, their IDs
+    are kept in the parent's params under `SUB_RUN_IDS` until the state is left, so a resumed parent waits for the
+    same children instead of starting new ones. Use a storage of its own, e.g. `PostgreStateStorage` of another
+    tenant, so executors of the parent definition don't pick up child runs.
+    :param definition: definition of the child runs, compiled once.
+    :param storage: storage of the child runs.
+    :param max_state_visits: visit limits of the child definition, same as for `FiniteStateMachine`.
+    :param fan_out: returns params of each child to start from the parent's params, e.g. one child per item
+    of a list. Without it a single child is started with the parent's params.
+    :param merge: `merge_children` or any function with the same signature.
+    :param run_inline: advance children within the parent's step, concurrently on `workers` threads if there are
+    several. Without it children are only started and have to be advanced by workers of their own, e.g. an
+    `FsmExecutor.run_claimed` loop on `storage`.
+    :param workers: threads advancing fanned out children inline.
+    :param poll_seconds: while children haven't finished the parent is parked for this long before it checks
+    them again, it's woken by a `DueRunPoller`.
+    """
+    def __init__(self, definition: Union[StateDefinition, CompiledDefinition],
+                 storage: StateStorage[Any],
+                 max_state_visits: Dict[str, int] = {DEFAULT: 1},
+                 fan_out: Optional[Callable[[JsonParams], List[JsonParams]]] = None,
+                 merge: ChildMerge = merge_children,
+                 run_inline: bool = True,
+                 workers: int = 8,
+                 poll_seconds: float = 1.0) -> None:
+        # imported here, the FSM module itself imports this one
+        from fsm.fsm_executor import FsmExecutor
+        self.definition = compile_definition(definition, max_state_visits)
+        self.storage = storage
+        self.fan_out = fan_out
+        self.merge = merge
+        self.run_inline = run_inline
+        self.poll_seconds = poll_seconds
+        self.executor: FsmExecutor[Any] = FsmExecutor(storage, self.definition, workers=workers, quiet=True)
+
+    def advance(self, run_id: Any, params: JsonParams) -> Union[Tuple[bool, Optional[str], JsonParams],
+                                                                PendingSubRuns]:
+        """
+        Starts child runs of the parent run `run_id` on the first call, and advances and checks them on later ones.
+        :return: transition result once all children finished, `PendingSubRuns` before.
+        """
+        sub_run_ids = params.get(SUB_RUN_IDS)
+        if sub_run_ids is None:
+            children = self.fan_out(params) if self.fan_out is not None else [params]
+            sub_run_ids = self.storage.start_runs([dict(child, **{PARENT_RUN_ID: run_id}) for child in children])
+            # the parent keeps the IDs before the children are advanced, a crash in between doesn't start them twice
+            return PendingSubRuns(dict(params, **{SUB_RUN_IDS: sub_run_ids}), 0)
+        if self.run_inline:
+            if len(sub_run_ids) == 1:
+                self.executor.fsm.run(sub_run_ids[0])
+            else:
+                self.executor.run_many(sub_run_ids)
+        last_states = [self.storage.get_last_state(sub_run_id) for sub_run_id in sub_run_ids]
+        if not all(self._finished(last_state) for last_state in last_states):
+            return PendingSubRuns(params, self.poll_seconds)
+        parent_params = {key: value for key, value in params.items() if key != SUB_RUN_IDS}
+        failed = [self._failure(sub_run_id, last_state) for sub_run_id, last_state in zip(sub_run_ids, last_states)
+                  if not self._succeeded(last_state)]
+        if failed:
+            return False, "Sub-machine runs failed: {}".format("; ".join(failed)), parent_params
+        return True, None, self.merge(parent_params, [self._child_params(last_state) for last_state in last_states])
+
+    def _finished(self, last_state: Any) -> bool:
+        if last_state is None or last_state.is_terminal():
+            return True
+        return last_state.name in self.definition and self.definition[last_state.name].action is None
+
+    @staticmethod
+    def _succeeded(last_state: Any) -> bool:
+        # the terminal state of a run that ran out of visits carries the error
+        return last_state is not None and last_state.name == TERMINAL_STATE and not last_state.errors
+
+    @staticmethod
+    def _failure(sub_run_id: Any, last_state: Optional[StateEntryT[Any]]) -> str:
+        if last_state is None:
+            return "[{}] has no states".format(sub_run_id)
+        error = ": {}".format(last_state.errors[-1]['error']) if last_state.errors else ""
+        return "[{}] ended in [{}]{}".format(sub_run_id, last_state.name, error)
+
+    @staticmethod
+    def _child_params(last_state: Any) -> JsonParams:
+        return {key: value for key, value in last_state.params.items() if key != PARENT_RUN_ID}
+
+    def __repr__(self) -> str:
+        return "<SubMachine(states={}, run_inline={})>".format(len(self.definition), self.run_inline)
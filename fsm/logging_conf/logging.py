@@ -2,6 +2,7 @@ import collections
 import logging
 import sys
 from copy import copy
+from itertools import chain
 from typing import TypeVar, Dict, Callable
 
 # from colorlog import colorlog
@@ -30,8 +31,8 @@ class DynamicDict(collections.abc.Mapping):
         return opt if opt != '' else self.ddict[item]()
 
     def __iter__(self):
-        from itertools import chain
-        return chain(iter(self.sdict), iter({k: v() for k, v in self.ddict.items()}))
+        # keys only, dynamic values are evaluated once by the lookup that follows
+        return chain(iter(self.sdict), iter(self.ddict))
 
 
 default_format = '%(log_color)s[%(levelname)s]%(reset)s %(asctime)s - %(threadName)s - %(name)s - %(tenant)s - ' \
@@ -11,5 +11,6 @@ setup(name='fsm',
       packages=find_packages(),
       test_suite='nose.collector',
       install_requires=['colorlog==6.7.0', 'psycopg2-binary==2.9.9', 'sqlalchemy==2.0.9'],
+      extras_require={'async': ['asyncpg']},
       tests_require=['nose', 'pytest', 'mock', 'nosexcover', 'mypy', 'mongomock', 'mongoengine'],
       zip_safe=False)
@@ -10,7 +10,7 @@ from tests.fsm_persistence_mongo_models import StateEntry, StateStatus, StateErr
 
 class MongoStateStorage(StateStorage):
 
-    def get_last_state(self, run_id: Optional[str]) -> Optional[StateEntry]:
+    def get_last_state(self, run_id: Optional[str] = None) -> Optional[StateEntry]:
         last_state = StateStatus.objects().first()
         if last_state:
             return StateEntry.objects(id=last_state.last_state_id).first()
@@ -0,0 +1,139 @@
+import asyncio
+import unittest
+from unittest.mock import MagicMock, AsyncMock
+
+import mongomock as mongomock
+from mongoengine import connect
+from mongoengine.connection import get_connection
+
+from fsm import INITIAL_STATE, TERMINAL_STATE, DEFAULT
+from fsm.fsm_async import AsyncFiniteStateMachine as FSM
+from fsm.fsm_mongo.fsm_mongo_async_storage import AsyncMongoStateStorage
+
+
+class TestAsyncFiniteStateMachine(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        connect('mongoenginetest', mongo_client_class=mongomock.MongoClient)
+        conn = get_connection()
+        conn.drop_database('mongoenginetest')
+        self.db = AsyncMongoStateStorage()
+
+    async def assert_current_FSM_state(self, state, run_id=None):
+        last_state = await self.db.get_last_state(run_id)
+        self.assertEqual(state, last_state.name)
+
+    async def test_fsm_should_await_coroutine_actions_and_offload_regular_ones(self):
+        params = {"val": 1}
+        transition_action = AsyncMock(return_value=(True, "", params))
+        next_transition_action = MagicMock(return_value={"val": 2})
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (transition_action, "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        await fsm.run()
+
+        transition_action.assert_awaited_once_with({})
+        next_transition_action.assert_called_once_with(params)
+        await self.assert_current_FSM_state(TERMINAL_STATE)
+        history = await self.db.get_db_history()
+        self.assertListEqual([{}, params, {"val": 2}], [x.params for x in history])
+
+    async def test_fsm_should_yield_execution_but_be_able_to_proceed_next_time_we_run_it(self):
+        next_transition_action = AsyncMock(return_value=(True, "", {}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (AsyncMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        await fsm.run()
+        next_transition_action.assert_not_awaited()
+        await self.assert_current_FSM_state("NEXT")
+
+        await fsm.run()
+        next_transition_action.assert_awaited_once()
+        await self.assert_current_FSM_state(TERMINAL_STATE)
+
+    async def test_fsm_should_map_action_exceptions_to_failures_and_terminate_after_max_visits(self):
+        failing_action = AsyncMock(side_effect=Exception("total fail"))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (AsyncMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (failing_action, TERMINAL_STATE, "NEXT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 2})
+
+        await fsm.run()
+
+        self.assertEqual(2, failing_action.await_count)
+        await self.assert_current_FSM_state(TERMINAL_STATE)
+        history = await self.db.get_db_history()
+        self.assertIn("msg: [total fail]", history[1].errors[0].error)
+
+    async def test_run_many_should_advance_runs_concurrently(self):
+        running = 0
+        max_running = 0
+
+        async def slow_action(params):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return params
+
+        run_ids = []
+        for _ in range(10):
+            initial_state = await self.db.new_initial_state({})
+            await self.db.save_state(initial_state)
+            run_ids.append(initial_state.run_id)
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (slow_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        report = await fsm.run_many(run_ids, concurrency=5)
+
+        self.assertEqual(10, report.runs)
+        self.assertEqual(0, report.failed)
+        self.assertEqual(5, max_running)
+        for run_id in run_ids:
+            await self.assert_current_FSM_state(TERMINAL_STATE, run_id)
+
+    async def test_run_many_should_consume_run_ids_as_slots_free_up(self):
+        consumed = 0
+        finished = 0
+        ahead_when_acting = []
+
+        async def slow_action(params):
+            nonlocal finished
+            ahead_when_acting.append(consumed - finished)
+            await asyncio.sleep(0.01)
+            finished += 1
+            return params
+
+        run_ids = []
+        for _ in range(6):
+            initial_state = await self.db.new_initial_state({})
+            await self.db.save_state(initial_state)
+            run_ids.append(initial_state.run_id)
+
+        def lazy_run_ids():
+            nonlocal consumed
+            for run_id in run_ids:
+                consumed += 1
+                yield run_id
+
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (slow_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        report = await fsm.run_many(lazy_run_ids(), concurrency=2)
+
+        self.assertEqual(6, report.runs)
+        # run IDs taken but not finished: two in flight and the next one waiting for a slot
+        self.assertLessEqual(max(ahead_when_acting), 3)
+
@@ -0,0 +1,174 @@
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import mongomock as mongomock
+from mongoengine import connect
+from mongoengine.connection import get_connection
+from pymongo import UpdateOne
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_batching import BatchingStateStorage, FLUSH_PER_STEP, FLUSH_PER_RUN, FLUSH_INTERVAL
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+from fsm.fsm_mongo.fsm_mongo_storage import MongoStateStorage
+
+
+def _loop_pipeline(next_action=None):
+    return {
+        INITIAL_STATE: (MagicMock(return_value=(True, "", {"val": 1})), "LOOP-START", "NOT-EXISTENT", True),
+        "LOOP-START": (MagicMock(return_value=(True, "", {})), "LOOP-END", TERMINAL_STATE, True),
+        "LOOP-END": (next_action or MagicMock(return_value=(True, "", {})), "LOOP-START", TERMINAL_STATE, True),
+        TERMINAL_STATE: (None, None, None, False)
+    }
+
+
+class TestBatchingStateStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.inner = MemoryStateStorage()
+
+    def test_run_should_be_flushed_once_when_it_stops(self):
+        inner = MagicMock(wraps=self.inner)
+        db = BatchingStateStorage(inner, FLUSH_PER_RUN)
+        fsm = FSM(db, _loop_pipeline(), {DEFAULT: 3})
+
+        fsm.run()
+
+        inner.save_states.assert_called_once()
+        inner.set_last_states.assert_called_once()
+        inner.save_state.assert_not_called()
+        inner.set_current_state.assert_not_called()
+        self.assertEqual(TERMINAL_STATE, self.inner.get_last_state().name)
+        history = self.inner.get_db_history()
+        self.assertListEqual([INITIAL_STATE, "LOOP-START", "LOOP-END", TERMINAL_STATE], [x.name for x in history])
+        self.assertListEqual([1, 3, 3, 1], [x.visit_count for x in history])
+
+    def test_history_should_match_the_wrapped_storage_used_directly(self):
+        failing_action = MagicMock(return_value=(False, "failed", {}))
+        FSM(self.inner, _loop_pipeline(failing_action), {DEFAULT: 2}).run()
+        db = BatchingStateStorage(MemoryStateStorage(), FLUSH_PER_STEP)
+        FSM(db, _loop_pipeline(failing_action), {DEFAULT: 2}).run()
+
+        def summary(history):
+            return [(x.name, x.visit_count, x.params, list(x.errors), x.yielded) for x in history]
+
+        self.assertListEqual(summary(self.inner.get_db_history()), summary(db.get_db_history()))
+
+    def test_flush_per_step_should_flush_every_step(self):
+        inner = MagicMock(wraps=self.inner)
+        db = BatchingStateStorage(inner, FLUSH_PER_STEP)
+        fsm = FSM(db, _loop_pipeline(), {DEFAULT: 2})
+
+        fsm.run()
+
+        # the initial state written before the first action, then one flush per transition or termination
+        self.assertEqual(6, inner.save_states.call_count)
+        self.assertEqual(TERMINAL_STATE, self.inner.get_last_state().name)
+
+    def test_reads_of_a_run_should_be_served_from_cache(self):
+        inner = MagicMock(wraps=self.inner)
+        db = BatchingStateStorage(inner, FLUSH_PER_RUN)
+        fsm = FSM(db, _loop_pipeline(), {DEFAULT: 10})
+
+        fsm.run()
+
+        # one miss per state name, every other lookup hits the cache
+        self.assertEqual(3, inner.find_state.call_count)
+
+    def test_writes_should_be_flushed_when_batch_is_full(self):
+        inner = MagicMock(wraps=self.inner)
+        db = BatchingStateStorage(inner, FLUSH_PER_RUN, max_batch=4)
+        fsm = FSM(db, _loop_pipeline(), {DEFAULT: 3})
+
+        fsm.run()
+
+        self.assertGreater(inner.save_states.call_count, 1)
+        self.assertEqual(4, len(self.inner.get_db_history()))
+
+    def test_interval_durability_should_flush_in_background(self):
+        db = BatchingStateStorage(self.inner, FLUSH_INTERVAL, interval_ms=10)
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        fsm.run()
+        deadline = time.monotonic() + 5
+        while self.inner.get_last_state() is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        db.close()
+
+        last_state = self.inner.get_last_state()
+        self.assertEqual("NEXT", last_state.name)
+        self.assertTrue(last_state.yielded)
+
+    def test_cache_should_evict_flushed_runs(self):
+        db = BatchingStateStorage(self.inner, FLUSH_PER_RUN, max_cached_runs=1)
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", False),
+            "NEXT": (None, None, None, False)
+        })
+
+        fsm.run()
+        first_run_id = db.get_last_state().run_id
+        fsm.run()
+        second_run_id = db.get_last_state().run_id
+        fsm.run(first_run_id)
+        fsm.run(second_run_id)
+
+        self.assertEqual(1, len(db._runs))
+        self.assertEqual("NEXT", self.inner.get_last_state(first_run_id).name)
+        self.assertEqual("NEXT", self.inner.get_last_state(second_run_id).name)
+
+    def test_unknown_durability_should_be_rejected(self):
+        with self.assertRaises(ValueError):
+            BatchingStateStorage(self.inner, "sometimes")
+
+
+def _mongomock_supports_bulk_updates():
+    try:
+        mongomock.MongoClient().db.probe.bulk_write([UpdateOne({}, {'$set': {'a': 1}}, upsert=True)])
+        return True
+    except TypeError:
+        return False
+
+
+@unittest.skipUnless(_mongomock_supports_bulk_updates(), "installed mongomock can't run pymongo bulk updates")
+class TestBatchingMongoStateStorage(unittest.TestCase):
+
+    def setUp(self):
+        connect('mongoenginetest', mongo_client_class=mongomock.MongoClient)
+        conn = get_connection()
+        conn.drop_database('mongoenginetest')
+        self.inner = MongoStateStorage()
+
+    def test_run_should_be_bulk_written_to_mongo(self):
+        db = BatchingStateStorage(self.inner, FLUSH_PER_RUN)
+        fsm = FSM(db, _loop_pipeline(MagicMock(return_value=(False, "failed", {}))), {DEFAULT: 3})
+
+        fsm.run()
+
+        self.assertEqual(TERMINAL_STATE, self.inner.get_last_state().name)
+        history = self.inner.get_db_history()
+        self.assertListEqual([INITIAL_STATE, "LOOP-START", "LOOP-END", TERMINAL_STATE], [x.name for x in history])
+        self.assertListEqual([1, 1, 1, 1], [x.visit_count for x in history])
+        self.assertEqual({"val": 1}, history[1].params)
+
+    def test_yielded_run_should_resume_from_flushed_state(self):
+        next_action = MagicMock(return_value=(True, "", {}))
+        pipeline = {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_action, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+        FSM(BatchingStateStorage(self.inner, FLUSH_PER_RUN), pipeline).run()
+        self.assertTrue(self.inner.get_last_state().yielded)
+
+        # a fresh cache reads the run back from mongo
+        FSM(BatchingStateStorage(self.inner, FLUSH_PER_RUN), pipeline).run()
+
+        next_action.assert_called_once()
+        self.assertEqual(TERMINAL_STATE, self.inner.get_last_state().name)
+        self.assertEqual(3, len(self.inner.get_db_history()))
@@ -0,0 +1,96 @@
+import random
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_backoff import ExponentialBackoff
+from fsm.fsm_executor import FsmExecutor
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+from fsm.fsm_scheduler import DueRunPoller
+
+
+class TestBackoff(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStateStorage()
+
+    def test_exponential_backoff_should_grow_up_to_max_with_bounded_jitter(self):
+        backoff = ExponentialBackoff(base_seconds=1, factor=2, max_seconds=10, jitter=0)
+        self.assertListEqual([1, 2, 4, 8, 10, 10], [backoff.delay_seconds(attempt) for attempt in range(1, 7)])
+        self.assertEqual(10, backoff.delay_seconds(10000))
+
+        jittered = ExponentialBackoff(base_seconds=8, jitter=0.5, rng=random.Random(1))
+        delays = [jittered.delay_seconds(1) for _ in range(100)]
+        self.assertTrue(all(4 <= delay <= 8 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_failed_action_should_park_run_until_backoff_passes(self):
+        failing_action = MagicMock(return_value=(False, "failed", {}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "FLAKY", "NOT-EXISTENT", True),
+            "FLAKY": (failing_action, TERMINAL_STATE, "FLAKY", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 5}, retry_backoff={"FLAKY": ExponentialBackoff(base_seconds=60, jitter=0)})
+        run_id = fsm.start_runs([{}])[0]
+        started = datetime.utcnow()
+
+        fsm.run(run_id)
+        fsm.run(run_id)
+
+        self.assertEqual(1, failing_action.call_count)
+        last_state = self.db.get_last_state(run_id)
+        self.assertTrue(last_state.yielded)
+        self.assertAlmostEqual(60, (last_state.due_at - started).total_seconds(), delta=5)
+        self.assertFalse(self.db.get_due_runs(datetime.utcnow()))
+        self.assertFalse(list(self.db.iter_yielded_runs()))
+        self.assertListEqual([(run_id, last_state.due_at)], self.db.get_due_runs(started + timedelta(minutes=2)))
+        self.assertFalse(self.db.claim_runs("worker", 10, 60))
+
+    def test_poller_should_resume_runs_parked_by_their_actions(self):
+        attempts = []
+
+        def wait_for_downstream(params):
+            attempts.append(datetime.utcnow())
+            if len(attempts) < 3:
+                return False, "not ready", params, 0.05
+            return True, None, params
+
+        executor = FsmExecutor(self.db, {
+            INITIAL_STATE: (wait_for_downstream, TERMINAL_STATE, INITIAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 5}, workers=2)
+        run_ids = executor.fsm.start_runs([{}])
+        executor.run_many(run_ids)
+        poller = DueRunPoller(executor, poll_seconds=0.02)
+
+        poller.start()
+        deadline = time.monotonic() + 5
+        while self.db.get_last_state(run_ids[0]).name != TERMINAL_STATE and time.monotonic() < deadline:
+            time.sleep(0.01)
+        poller.stop()
+
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_ids[0]).name)
+        self.assertEqual(3, len(attempts))
+        self.assertGreaterEqual((attempts[1] - attempts[0]).total_seconds(), 0.05)
+
+    def test_poller_should_skip_due_runs_leased_by_other_workers(self):
+        action = MagicMock(side_effect=[(False, "not ready", {}, 0.01), (False, "not ready", {}, 0.01),
+                                        (True, None, {})])
+        executor = FsmExecutor(self.db, {
+            INITIAL_STATE: (action, TERMINAL_STATE, INITIAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 5}, workers=2)
+        run_ids = executor.fsm.start_runs([{}, {}])
+        executor.run_many(run_ids)
+        time.sleep(0.02)
+        self.assertListEqual([run_ids[0]], self.db.claim_runs("other-worker", 1, 60, run_ids))
+        poller = DueRunPoller(executor)
+
+        self.assertEqual(2, poller.poll())
+        self.assertEqual(1, poller.run_due().runs)
+
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_ids[1]).name)
+        self.assertTrue(self.db.get_last_state(run_ids[0]).yielded)
@@ -0,0 +1,76 @@
+import unittest
+from unittest.mock import MagicMock
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_definition import compile_definition, DefinitionError
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+
+
+class TestCompiledDefinition(unittest.TestCase):
+
+    def setUp(self):
+        self.action = MagicMock(return_value=(True, "", {}))
+        self.definition = {
+            INITIAL_STATE: (self.action, "NEXT", "FAILED", True),
+            "NEXT": (self.action, TERMINAL_STATE, "FAILED", False),
+            "FAILED": (self.action, TERMINAL_STATE, "FAILED", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+
+    def test_compiled_states_should_refer_to_targets_by_integer_ids(self):
+        compiled = compile_definition(self.definition, {DEFAULT: 2, "FAILED": 5})
+
+        self.assertEqual(4, len(compiled))
+        initial = compiled[INITIAL_STATE]
+        self.assertEqual(0, initial.id)
+        self.assertEqual("NEXT", compiled.states[initial.success_id].name)
+        self.assertEqual("FAILED", compiled.states[initial.failure_id].name)
+        self.assertFalse(compiled["NEXT"].continue_run)
+        self.assertListEqual([2, 2, 5, 2], [state.max_visits for state in compiled.states])
+        self.assertEqual(2, compiled.visit_limit("NOT-EXISTENT"))
+        self.assertEqual(5, compiled.visit_limit("FAILED", initial.failure_id))
+        self.assertTupleEqual((), compiled.unreachable_states)
+
+    def test_compiled_definition_should_be_immutable(self):
+        compiled = compile_definition(self.definition)
+
+        with self.assertRaises(AttributeError):
+            compiled.states = ()
+        with self.assertRaises(AttributeError):
+            compiled[INITIAL_STATE].success = TERMINAL_STATE
+
+    def test_validation_should_reject_missing_initial_and_target_states(self):
+        with self.assertRaises(DefinitionError):
+            compile_definition({})
+        with self.assertRaises(DefinitionError) as raised:
+            compile_definition({
+                INITIAL_STATE: (self.action, "NEXT", "NOT-EXISTENT", True),
+                "NEXT": (None, None, None, False)
+            })
+        self.assertIn("[INITIAL_STATE] -> [NOT-EXISTENT]", str(raised.exception))
+
+        compiled = compile_definition({INITIAL_STATE: (self.action, "NEXT", "NOT-EXISTENT", True)}, validate=False)
+        self.assertIsNone(compiled[INITIAL_STATE].failure_id)
+
+    def test_unreachable_states_should_be_reported(self):
+        self.definition["ORPHAN"] = (self.action, TERMINAL_STATE, TERMINAL_STATE, True)
+
+        compiled = compile_definition(self.definition)
+
+        self.assertTupleEqual(("ORPHAN",), compiled.unreachable_states)
+
+    def test_fsm_should_run_compiled_definition(self):
+        db = MemoryStateStorage()
+        failing_action = MagicMock(return_value=(False, "failed", {}))
+        compiled = compile_definition({
+            INITIAL_STATE: (self.action, "NEXT", TERMINAL_STATE, True),
+            "NEXT": (failing_action, TERMINAL_STATE, "NEXT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 3})
+
+        FSM(db, compiled).run()
+
+        self.assertEqual(3, failing_action.call_count)
+        self.assertListEqual([(INITIAL_STATE, 1), ("NEXT", 3), (TERMINAL_STATE, 1)],
+                             [(x.name, x.visit_count) for x in db.get_db_history()])
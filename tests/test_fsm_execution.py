@@ -0,0 +1,238 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_async import AsyncFiniteStateMachine, OffloadedStateStorage
+from fsm.fsm_definition import compile_definition
+from fsm.fsm_execution import ProcessExecution, ThreadExecution, InlineExecution
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+
+
+def worker_pid(params):
+    return {"pid": os.getpid(), "thread": threading.current_thread().name, "val": params["val"] + 1}
+
+
+def raise_error(params):
+    raise ValueError("bad input")
+
+
+def sleep_long(params):
+    time.sleep(1)
+    return params
+
+
+def report_pid_and_hang(params):
+    with open(params["pid_path"], 'w') as pid_file:
+        pid_file.write(str(os.getpid()))
+    time.sleep(30)
+    return params
+
+
+class TestExecutionPolicies(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStateStorage()
+
+    def _fsm(self, action, policy, max_visits=1):
+        return FSM(self.db, {
+            INITIAL_STATE: (action, TERMINAL_STATE, "FAILED", True),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: max_visits}, execution_policies={INITIAL_STATE: policy})
+
+    def test_compile_should_resolve_policies_per_state_with_default(self):
+        process, inline = ProcessExecution(max_workers=1), InlineExecution()
+        definition = compile_definition({
+            INITIAL_STATE: (worker_pid, "NEXT", TERMINAL_STATE, True),
+            "NEXT": (worker_pid, TERMINAL_STATE, TERMINAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, execution_policies={"NEXT": process, DEFAULT: inline})
+
+        self.assertIs(inline, definition[INITIAL_STATE].execution)
+        self.assertIs(process, definition["NEXT"].execution)
+
+    def test_process_execution_should_run_action_in_worker_process(self):
+        policy = ProcessExecution(max_workers=1)
+        self.addCleanup(policy.close)
+        fsm = self._fsm(worker_pid, policy)
+        run_id = fsm.start_runs([{"val": 1}])[0]
+
+        fsm.run(run_id)
+
+        last_state = self.db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertNotEqual(os.getpid(), last_state.params["pid"])
+        self.assertEqual(2, last_state.params["val"])
+
+    def test_action_exceptions_and_timeouts_should_map_to_failures(self):
+        for action, policy, error in ((raise_error, ProcessExecution(max_workers=1), "bad input"),
+                                      (sleep_long, ProcessExecution(max_workers=1, timeout_seconds=0.1),
+                                       "didn't finish in 0.1 seconds"),
+                                      (sleep_long, ThreadExecution(timeout_seconds=0.1),
+                                       "didn't finish in 0.1 seconds")):
+            self.addCleanup(policy.close)
+            fsm = self._fsm(action, policy)
+            run_id = fsm.start_runs([{}])[0]
+
+            started = time.perf_counter()
+            fsm.run(run_id)
+
+            self.assertLess(time.perf_counter() - started, 0.9)
+            self.assertEqual("FAILED", self.db.get_last_state(run_id).name)
+            self.assertIn(error, self.db.get_last_state(run_id).errors[0]['error'])
+
+    def test_state_timeout_should_fail_hung_inline_action_and_retry_it(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        def hangs_once(params):
+            calls.append(params)
+            if len(calls) == 1:
+                release.wait()
+            return params
+
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (hangs_once, TERMINAL_STATE, INITIAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 2}, state_timeouts={INITIAL_STATE: 0.1})
+        run_id = fsm.start_runs([{"val": 1}])[0]
+
+        started = time.perf_counter()
+        fsm.run(run_id)
+
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_id).name)
+        self.assertIn("didn't finish in 0.1 seconds",
+                      self.db.find_state(INITIAL_STATE, run_id).errors[0]['error'])
+
+    def test_thread_timeout_should_free_the_slot_of_the_abandoned_action(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        policy = ThreadExecution(max_workers=1, timeout_seconds=0.1)
+        self.addCleanup(policy.close)
+
+        with self.assertRaises(TimeoutError):
+            policy.call(lambda params: release.wait(), {})
+        started = time.perf_counter()
+        result = policy.call(worker_pid, {"val": 1})
+
+        self.assertLess(time.perf_counter() - started, 0.1)
+        self.assertEqual(2, result["val"])
+
+    def test_process_timeout_should_terminate_the_stuck_worker(self):
+        pid_path = os.path.join(tempfile.mkdtemp(), 'pid')
+        policy = ProcessExecution(max_workers=1, timeout_seconds=0.5)
+        self.addCleanup(policy.close)
+
+        with self.assertRaises(TimeoutError):
+            policy.call(report_pid_and_hang, {"pid_path": pid_path})
+        with open(pid_path) as pid_file:
+            pid = int(pid_file.read())
+        deadline = time.monotonic() + 5
+        while pid in [child.pid for child in multiprocessing.active_children()] and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self.assertNotIn(pid, [child.pid for child in multiprocessing.active_children()])
+        self.assertEqual(2, policy.call(worker_pid, {"val": 1})["val"])
+
+    def test_pools_should_be_recycled_after_max_tasks_per_worker(self):
+        process_policy = ProcessExecution(max_workers=1, max_tasks_per_worker=2)
+        thread_policy = ThreadExecution(max_workers=1, max_tasks_per_worker=2)
+        self.addCleanup(process_policy.close)
+        self.addCleanup(thread_policy.close)
+
+        pids = [process_policy.call(worker_pid, {"val": 0})["pid"] for _ in range(4)]
+        threads = [thread_policy.call(worker_pid, {"val": 0})["thread"] for _ in range(4)]
+
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(pids[2], pids[3])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertTrue(all(thread.startswith('fsm-action') for thread in threads))
+
+
+class TestAsyncExecutionPolicies(unittest.IsolatedAsyncioTestCase):
+
+    async def test_async_fsm_should_run_actions_with_their_policy(self):
+        policy = ProcessExecution(max_workers=1)
+        self.addCleanup(policy.close)
+        db = OffloadedStateStorage(MemoryStateStorage())
+        fsm = AsyncFiniteStateMachine(db, {
+            INITIAL_STATE: (worker_pid, "NEXT", TERMINAL_STATE, True),
+            "NEXT": (raise_error, TERMINAL_STATE, "FAILED", True),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }, execution_policies={DEFAULT: policy})
+        run_id = (await fsm.start_runs([{"val": 1}]))[0]
+
+        await fsm.run(run_id)
+
+        self.assertNotEqual(os.getpid(), (await db.find_state("NEXT", run_id)).params["pid"])
+        last_state = await db.get_last_state(run_id)
+        self.assertEqual("FAILED", last_state.name)
+        self.assertIn("bad input", last_state.errors[0]['error'])
+
+    async def test_async_fsm_should_cancel_coroutine_actions_on_state_timeout(self):
+        cancelled = asyncio.Event()
+
+        async def hangs(params):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+            return params
+
+        db = OffloadedStateStorage(MemoryStateStorage())
+        fsm = AsyncFiniteStateMachine(db, {
+            INITIAL_STATE: (hangs, TERMINAL_STATE, "FAILED", True),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }, state_timeouts={DEFAULT: 0.1})
+        run_id = (await fsm.start_runs([{}]))[0]
+
+        await fsm.run(run_id)
+
+        self.assertTrue(cancelled.is_set())
+        last_state = await db.get_last_state(run_id)
+        self.assertEqual("FAILED", last_state.name)
+        self.assertIn("didn't finish in 0.1 seconds", last_state.errors[0]['error'])
+
+    async def test_async_fsm_timeouts_should_not_pin_action_executor_threads(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        calls = []
+
+        def hangs_once(params):
+            calls.append(params)
+            if len(calls) == 1:
+                release.wait(5)
+            return params
+
+        action_executor = ThreadPoolExecutor(1)
+        self.addCleanup(action_executor.shutdown, wait=False)
+        db = OffloadedStateStorage(MemoryStateStorage())
+        fsm = AsyncFiniteStateMachine(db, {
+            INITIAL_STATE: (hangs_once, TERMINAL_STATE, INITIAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 2}, action_executor=action_executor, state_timeouts={DEFAULT: 0.1})
+        run_id = (await fsm.start_runs([{}]))[0]
+
+        started = time.perf_counter()
+        await fsm.run(run_id)
+
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(2, len(calls))
+        self.assertEqual(TERMINAL_STATE, (await db.get_last_state(run_id)).name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+import mongomock as mongomock
+from mongoengine import connect
+from mongoengine.connection import get_connection
+
+from fsm import INITIAL_STATE, TERMINAL_STATE
+from fsm.fsm_executor import FsmExecutor
+from fsm.fsm_mongo.fsm_mongo_storage import MongoStateStorage
+
+
+class TestFsmExecutor(unittest.TestCase):
+
+    def setUp(self):
+        connect('mongoenginetest', mongo_client_class=mongomock.MongoClient)
+        conn = get_connection()
+        conn.drop_database('mongoenginetest')
+        self.db = MongoStateStorage()
+
+    def start_runs(self, count):
+        run_ids = []
+        for _ in range(count):
+            initial_state = self.db.new_initial_state({})
+            self.db.save_state(initial_state)
+            run_ids.append(initial_state.run_id)
+        return run_ids
+
+    def test_executor_should_advance_every_run_to_terminal_state(self):
+        run_ids = self.start_runs(20)
+        transition_action = MagicMock(return_value=(True, "", {}))
+        executor = FsmExecutor(self.db, {
+            INITIAL_STATE: (transition_action, "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (transition_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, workers=4)
+
+        report = executor.run_many(run_ids)
+
+        self.assertEqual(20, report.runs)
+        self.assertEqual(0, report.failed)
+        self.assertEqual(40, transition_action.call_count)
+        for run_id in run_ids:
+            self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_id).name)
+
+    def test_executor_should_isolate_run_context_per_thread(self):
+        run_ids = self.start_runs(8)
+        seen = {}
+        seen_lock = threading.Lock()
+
+        def record_run_id(params):
+            with seen_lock:
+                seen[threading.get_ident()] = executor.fsm.run_id
+            return True, None, params
+
+        executor = FsmExecutor(self.db, {
+            INITIAL_STATE: (record_run_id, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, workers=4)
+
+        executor.run_many(run_ids)
+
+        self.assertTrue(set(seen.values()) <= set(run_ids))
+
+    def test_executor_should_count_failed_runs_and_keep_going(self):
+        run_ids = self.start_runs(3)
+        executor = FsmExecutor(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NOT-EXISTENT", "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, workers=2, max_in_flight=1)
+
+        report = executor.run_many(run_ids)
+
+        self.assertEqual(3, report.runs)
+        self.assertEqual(3, report.failed)
+
+    def test_executors_sharing_storage_should_advance_each_claimed_run_once(self):
+        run_ids = self.start_runs(10)
+        advanced = []
+        advanced_lock = threading.Lock()
+
+        def record_run_id(params):
+            with advanced_lock:
+                advanced.append(params)
+            return True, None, params
+
+        definition = {
+            INITIAL_STATE: (record_run_id, "PARKED", "NOT-EXISTENT", True),
+            "PARKED": (record_run_id, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+        executors = [FsmExecutor(self.db, definition, workers=2, owner=owner) for owner in ("a", "b")]
+
+        reports = [executor.run_claimed(limit=3) for executor in executors * 2]
+
+        self.assertListEqual([3, 3, 3, 1], [report.runs for report in reports])
+        self.assertEqual(10, len(advanced))
+        # runs yielded in PARKED aren't claimed again until they're resumed
+        self.assertEqual(0, executors[0].run_claimed().runs)
+        for run_id in run_ids:
+            self.assertTrue(self.db.get_last_state(run_id).yielded)
@@ -0,0 +1,107 @@
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_instrumentation import FsmInstrumentation, HistogramCollector, InstrumentedStateStorage
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStateStorage()
+
+    def test_hooks_should_be_called_for_steps_actions_and_storage_calls(self):
+        instrumentation = MagicMock(spec=FsmInstrumentation)
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (MagicMock(return_value=(False, "failed", {})), TERMINAL_STATE, "NEXT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 2}, instrumentation=instrumentation)
+
+        fsm.run()
+
+        self.assertEqual(3, instrumentation.on_step_start.call_count)
+        self.assertEqual(3, instrumentation.on_step_done.call_count)
+        self.assertListEqual([(INITIAL_STATE, True), ("NEXT", False), ("NEXT", False)],
+                             [call.args[1:3] for call in instrumentation.on_action_done.call_args_list])
+        methods = [call.args[0] for call in instrumentation.on_storage_call.call_args_list]
+        self.assertIn('save_state', methods)
+        self.assertIn('terminate', methods)
+        # reads before and writes after each action
+        self.assertEqual(6, methods.count('step'))
+        self.assertEqual(1, methods.count('run_scope'))
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state().name)
+
+    def test_paged_reads_should_be_timed_per_page(self):
+        instrumentation = MagicMock(spec=FsmInstrumentation)
+        db = InstrumentedStateStorage(self.db, instrumentation)
+        db.start_runs([{"val": i} for i in range(5)])
+        instrumentation.reset_mock()
+
+        history = list(db.iter_history(batch_size=2))
+
+        self.assertEqual(5, len(history))
+        self.assertListEqual(['iter_history'] * 3,
+                             [call.args[0] for call in instrumentation.on_storage_call.call_args_list])
+        self.assertListEqual([], list(db.iter_yielded_runs()))
+        self.assertEqual('iter_yielded_runs', instrumentation.on_storage_call.call_args.args[0])
+
+    def test_fsm_should_keep_its_run_cache_behind_instrumented_storage(self):
+        db = MagicMock(wraps=self.db)
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (MagicMock(return_value=(True, "", {})), "NEXT", TERMINAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 5}, instrumentation=HistogramCollector())
+
+        fsm.run()
+
+        # NEXT is looked up once, later visits are served from the FSM cache
+        db.find_state.assert_called_once()
+
+    def test_collector_should_report_percentiles_per_state(self):
+        collector = HistogramCollector()
+
+        def slow_action(params):
+            time.sleep(0.005)
+            return True, None, {}
+
+        FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "SLOW", "NOT-EXISTENT", True),
+            "SLOW": (slow_action, TERMINAL_STATE, TERMINAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, instrumentation=collector).run()
+
+        summary = collector.summary()
+        self.assertEqual(1, summary['action']['SLOW']['count'])
+        self.assertGreaterEqual(collector.percentile('action', 'SLOW', 0.5), 0.005)
+        self.assertLess(collector.percentile('action', INITIAL_STATE, 0.99), 0.005)
+        self.assertIn('save_state', summary['storage'])
+        self.assertEqual(3, summary['step']['']['count'])
+        self.assertIsNone(collector.percentile('action', 'NOT-EXISTENT', 0.5))
+
+    def test_percentiles_should_be_interpolated_within_observed_range(self):
+        collector = HistogramCollector()
+        for duration_ms in range(1, 101):
+            collector.on_storage_call('find_state', duration_ms * 1000000)
+
+        self.assertAlmostEqual(0.05, collector.percentile('storage', 'find_state', 0.5), delta=0.015)
+        self.assertAlmostEqual(0.1, collector.percentile('storage', 'find_state', 1.0))
+        self.assertAlmostEqual(0.001, collector.percentile('storage', 'find_state', 0.0))
+
+    def test_collector_should_export_prometheus_histograms(self):
+        collector = HistogramCollector()
+        collector.on_action_done(1, 'SAY "HI"', True, 1500)
+        collector.on_storage_call('save_state', 3000000)
+
+        text = collector.to_prometheus()
+
+        self.assertIn('# TYPE fsm_action_duration_seconds histogram', text)
+        self.assertIn('fsm_action_duration_seconds_bucket{state="SAY \\"HI\\"",le="2e-06"} 1', text)
+        self.assertIn('fsm_action_duration_seconds_count{state="SAY \\"HI\\""} 1', text)
+        self.assertIn('fsm_storage_call_duration_seconds_bucket{method="save_state",le="+Inf"} 1', text)
+        self.assertIn('fsm_storage_call_duration_seconds_sum{method="save_state"} 0.003', text)
+        self.assertTrue(text.endswith('\n'))
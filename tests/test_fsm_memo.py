@@ -0,0 +1,120 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from fsm import TERMINAL_STATE, INITIAL_STATE
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_async import AsyncFiniteStateMachine, OffloadedStateStorage
+from fsm.fsm_memo import StepMemo, params_hash
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+
+
+class TestStepMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStateStorage()
+
+    def _definition(self, action):
+        return {
+            INITIAL_STATE: (action, TERMINAL_STATE, "FAILED", True),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+
+    def test_step_repeated_after_crash_should_reuse_recorded_result(self):
+        action = MagicMock(return_value=(True, None, {"charged": 1}))
+        fsm = FSM(self.db, self._definition(action), memoize={INITIAL_STATE: StepMemo()})
+        run_id = fsm.start_runs([{"amount": 10}])[0]
+
+        with patch.object(self.db, 'set_current_state', side_effect=RuntimeError("crash")), \
+                patch.object(self.db, 'set_next_state', side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                fsm.run(run_id)
+        self.assertEqual(INITIAL_STATE, self.db.get_last_state(run_id).name)
+        fsm.run(run_id)
+
+        action.assert_called_once_with({"amount": 10})
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_id).name)
+        self.assertDictEqual({"charged": 1}, self.db.get_last_state(run_id).params)
+        self.assertDictEqual({'success': True, 'error': None, 'params': {"charged": 1}, 'delay': None},
+                             self.db.find_step_result(run_id, INITIAL_STATE, 1, params_hash({"amount": 10})))
+
+    def test_pure_states_should_share_results_between_runs_with_lru_and_ttl_eviction(self):
+        action = MagicMock(side_effect=lambda params: {"double": params["val"] * 2})
+        memo = StepMemo(pure=True, max_size=2, ttl_seconds=0.2)
+        fsm = FSM(self.db, self._definition(action), memoize={INITIAL_STATE: memo})
+
+        for val in (1, 1, 2, 3, 1):
+            fsm.run(fsm.start_runs([{"val": val}])[0])
+
+        # the second run of 1 is memoized, the third one ran after 1 was evicted by 2 and 3
+        self.assertEqual(4, action.call_count)
+        self.assertEqual(2, len(memo))
+        time.sleep(0.25)
+        self.assertIsNone(memo.get(INITIAL_STATE, params_hash({"val": 3})))
+
+    def test_reused_results_should_not_be_changed_by_later_actions(self):
+        def bump(params):
+            params["score"] += 1000
+            return params
+
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (lambda params: {"score": params["val"] + 1}, "BUMP", "FAILED", True),
+            "BUMP": (bump, TERMINAL_STATE, "FAILED", True),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }, memoize={INITIAL_STATE: StepMemo(pure=True)})
+
+        run_ids = fsm.start_runs([{"val": 1}] * 3)
+        for run_id in run_ids:
+            fsm.run(run_id)
+
+        self.assertListEqual([1002] * 3, [self.db.get_last_state(run_id).params["score"] for run_id in run_ids])
+        self.assertEqual(2, self.db.find_step_result(run_ids[0], INITIAL_STATE, 1, params_hash({"val": 1}))
+                         ['params']['score'])
+
+    def test_failed_results_should_not_be_shared_between_runs(self):
+        action = MagicMock(return_value=(False, "unavailable", {}))
+        fsm = FSM(self.db, self._definition(action), memoize={INITIAL_STATE: StepMemo(pure=True)})
+
+        fsm.run(fsm.start_runs([{}])[0])
+        fsm.run(fsm.start_runs([{}])[0])
+
+        self.assertEqual(2, action.call_count)
+
+    def test_recorded_results_should_survive_restart_from_write_ahead_log(self):
+        wal_path = os.path.join(tempfile.mkdtemp(), 'fsm.wal')
+        db = MemoryStateStorage(wal_path=wal_path)
+        db.save_step_result("run", INITIAL_STATE, 1, "digest", {'success': True, 'error': None, 'params': {}})
+        db.close()
+
+        recovered = MemoryStateStorage(wal_path=wal_path)
+        self.addCleanup(recovered.close)
+
+        self.assertDictEqual({'success': True, 'error': None, 'params': {}},
+                             recovered.find_step_result("run", INITIAL_STATE, 1, "digest"))
+
+
+class TestAsyncStepMemo(unittest.IsolatedAsyncioTestCase):
+
+    async def test_async_fsm_should_reuse_recorded_results(self):
+        action = MagicMock(return_value={"val": 2})
+        db = OffloadedStateStorage(MemoryStateStorage())
+        fsm = AsyncFiniteStateMachine(db, {
+            INITIAL_STATE: (action, TERMINAL_STATE, TERMINAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, memoize={INITIAL_STATE: StepMemo()})
+        run_id = (await fsm.start_runs([{"val": 1}]))[0]
+        await db.save_step_result(run_id, INITIAL_STATE, 1, params_hash({"val": 1}),
+                                  {'success': True, 'error': None, 'params': {"val": 3}, 'delay': None})
+
+        await fsm.run(run_id)
+
+        action.assert_not_called()
+        self.assertDictEqual({"val": 3}, (await db.get_last_state(run_id)).params)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_async import AsyncFiniteStateMachine, OffloadedStateStorage
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+from fsm.fsm_parallel import Parallel, merge_update, BRANCH_RESULTS, PROCESS, ASYNCIO
+
+
+def slow_branch(params):
+    time.sleep(0.2)
+    return {"slow": params["val"] + 1}
+
+
+def square_branch(params):
+    return {"square": params["val"] ** 2}
+
+
+async def async_branch(params):
+    await asyncio.sleep(0.2)
+    return {"async": params["val"]}
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStateStorage()
+
+    def _definition(self, action):
+        return {
+            INITIAL_STATE: (action, "NEXT", INITIAL_STATE, True),
+            "NEXT": (MagicMock(return_value=True), TERMINAL_STATE, TERMINAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+
+    def test_branches_should_run_concurrently_and_join_into_next_state_params(self):
+        parallel = Parallel({"a": slow_branch, "b": slow_branch, "c": slow_branch})
+        self.addCleanup(parallel.close)
+        fsm = FSM(self.db, self._definition(parallel))
+        run_id = fsm.start_runs([{"val": 1}])[0]
+
+        started = time.perf_counter()
+        fsm.run(run_id)
+
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertDictEqual({"val": 1, "a": {"slow": 2}, "b": {"slow": 2}, "c": {"slow": 2}},
+                             self.db.find_state("NEXT", run_id).params)
+
+    def test_retry_should_only_run_failed_branches(self):
+        flaky_branch = MagicMock(side_effect=[(False, "not ready", {}), {"flaky": True}])
+        stable_branch = MagicMock(return_value={"stable": True})
+        parallel = Parallel({"stable": stable_branch, "flaky": flaky_branch}, merge=merge_update)
+        self.addCleanup(parallel.close)
+        fsm = FSM(self.db, self._definition(parallel), {DEFAULT: 2})
+
+        fsm.run()
+
+        stable_branch.assert_called_once_with({})
+        self.assertEqual(2, flaky_branch.call_count)
+        initial_state = self.db.find_state(INITIAL_STATE, fsm.run_id)
+        self.assertEqual(["Parallel branches failed: [flaky]: not ready"],
+                         [error['error'] for error in initial_state.errors])
+        self.assertDictEqual({"stable": True, "flaky": True}, self.db.find_state("NEXT", fsm.run_id).params)
+
+    def test_failed_branches_should_keep_successful_results_in_failure_params(self):
+        parallel = Parallel({"ok": square_branch, "broken": MagicMock(side_effect=ValueError("boom"))})
+        self.addCleanup(parallel.close)
+
+        is_successful, err, params = parallel({"val": 3})
+
+        self.assertFalse(is_successful)
+        self.assertIn("[broken]", err)
+        self.assertDictEqual({"val": 3, BRANCH_RESULTS: {"ok": {"square": 9}}}, params)
+
+    def test_process_and_asyncio_modes_should_produce_same_results(self):
+        process_parallel = Parallel({"slow": slow_branch, "square": square_branch}, merge_update, mode=PROCESS)
+        self.addCleanup(process_parallel.close)
+        asyncio_parallel = Parallel({"slow": slow_branch, "async": async_branch}, merge_update, mode=ASYNCIO)
+
+        self.assertEqual((True, None, {"val": 2, "slow": 3, "square": 4}), process_parallel({"val": 2}))
+        started = time.perf_counter()
+        self.assertEqual((True, None, {"val": 2, "slow": 3, "async": 2}), asyncio_parallel({"val": 2}))
+        self.assertLess(time.perf_counter() - started, 0.35)
+
+
+class TestAsyncParallel(unittest.IsolatedAsyncioTestCase):
+
+    async def test_async_fsm_should_run_branches_on_its_event_loop(self):
+        parallel = Parallel({"first": async_branch, "second": async_branch, "square": square_branch})
+        self.addCleanup(parallel.close)
+        db = OffloadedStateStorage(MemoryStateStorage())
+        fsm = AsyncFiniteStateMachine(db, {
+            INITIAL_STATE: (parallel, TERMINAL_STATE, INITIAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_id = (await fsm.start_runs([{"val": 4}]))[0]
+
+        started = time.perf_counter()
+        await fsm.run(run_id)
+
+        self.assertLess(time.perf_counter() - started, 0.35)
+        last_state = await db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 4, "first": {"async": 4}, "second": {"async": 4}, "square": {"square": 16}},
+                             last_state.params)
+
+
+if __name__ == '__main__':
+    unittest.main()
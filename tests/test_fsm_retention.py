@@ -0,0 +1,36 @@
+import threading
+import unittest
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+from fsm.fsm_retention import RetentionJob
+
+
+class TestRetentionJob(unittest.TestCase):
+
+    def test_run_once_should_archive_batches_until_nothing_is_due(self):
+        storage = MagicMock()
+        storage.archive_runs.side_effect = [2, 2, 1]
+        job = RetentionJob(storage, finished_ttl=timedelta(hours=1), batch_size=2, pause_seconds=0)
+
+        self.assertEqual(5, job.run_once())
+
+        self.assertEqual(3, storage.archive_runs.call_count)
+        finished_before, stale_before, limit = storage.archive_runs.call_args.args
+        self.assertIsNone(stale_before)
+        self.assertEqual(2, limit)
+        # cutoffs are computed once per pass
+        self.assertEqual(1, len({call.args[0] for call in storage.archive_runs.call_args_list}))
+
+    def test_background_job_should_stop(self):
+        passed = threading.Event()
+        storage = MagicMock()
+        storage.archive_runs.side_effect = lambda *args: passed.set() or 0
+        job = RetentionJob(storage, stale_ttl=timedelta(days=7), interval_seconds=60)
+
+        job.start()
+        self.assertTrue(passed.wait(5))
+        job.stop()
+
+        storage.archive_runs.assert_called()
+        self.assertIsNotNone(storage.archive_runs.call_args.args[1])
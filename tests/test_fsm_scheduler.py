@@ -0,0 +1,54 @@
+import unittest
+from unittest.mock import MagicMock
+
+from fsm import INITIAL_STATE, TERMINAL_STATE
+from fsm.fsm_executor import FsmExecutor
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+from fsm.fsm_scheduler import ResumeScheduler
+
+
+class TestResumeScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStateStorage()
+
+    def test_run_once_should_resume_yielded_runs_in_batches(self):
+        transition_action = MagicMock(return_value=(True, "", {}))
+        executor = FsmExecutor(self.db, {
+            INITIAL_STATE: (transition_action, "FIRST-WAIT", "NOT-EXISTENT", True),
+            "FIRST-WAIT": (transition_action, "SECOND-WAIT", "NOT-EXISTENT", False),
+            "SECOND-WAIT": (transition_action, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        }, workers=2)
+        run_ids = executor.fsm.start_runs([{} for _ in range(5)])
+        executor.run_many(run_ids[:4])
+        scheduler = ResumeScheduler(executor, batch_size=2)
+
+        self.assertCountEqual(run_ids[:4], self.db.iter_yielded_runs())
+        # runs yielding again in SECOND-WAIT are left for the next pass
+        self.assertEqual(4, scheduler.run_once().runs)
+        self.assertEqual(4, scheduler.run_once().runs)
+        self.assertEqual(0, scheduler.run_once().runs)
+
+        for run_id in run_ids[:4]:
+            self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_id).name)
+        self.assertEqual(INITIAL_STATE, self.db.get_last_state(run_ids[4]).name)
+        self.assertEqual(12, transition_action.call_count)
+
+    def test_run_once_should_skip_runs_leased_by_other_workers(self):
+        transition_action = MagicMock(return_value=(True, "", {}))
+        executor = FsmExecutor(self.db, {
+            INITIAL_STATE: (transition_action, "WAIT", "NOT-EXISTENT", True),
+            "WAIT": (transition_action, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        }, workers=2)
+        run_ids = executor.fsm.start_runs([{} for _ in range(2)])
+        executor.run_many(run_ids)
+        self.assertListEqual([run_ids[0]], self.db.claim_runs("other-worker", 1, 60, run_ids))
+
+        self.assertEqual(1, ResumeScheduler(executor).run_once().runs)
+
+        self.assertEqual("WAIT", self.db.get_last_state(run_ids[0]).name)
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_ids[1]).name)
+        # the resumed run was released
+        self.assertFalse(self.db.renew_lease(run_ids[1], executor.owner, 60))
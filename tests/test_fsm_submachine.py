@@ -0,0 +1,176 @@
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_async import AsyncFiniteStateMachine, OffloadedStateStorage
+from fsm.fsm_executor import FsmExecutor
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+from fsm.fsm_submachine import SubMachine, SUB_RUN_IDS, PARENT_RUN_ID
+
+
+def slow_child(params):
+    time.sleep(0.2)
+    return {"val": params["val"] * 2}
+
+
+class TestSubMachine(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MemoryStateStorage()
+        self.child_db = MemoryStateStorage()
+        self.child_definition = {
+            INITIAL_STATE: (lambda params: dict(params, val=params["val"] + 1), "DOUBLE", "FAILED", True),
+            "DOUBLE": (lambda params: {"val": params["val"] * 2}, TERMINAL_STATE, "FAILED", True),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+
+    def _definition(self, sub_machine):
+        return {
+            INITIAL_STATE: (sub_machine, "NEXT", "FAILED", True),
+            "NEXT": (MagicMock(return_value=True), TERMINAL_STATE, TERMINAL_STATE, True),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+
+    def test_child_run_should_be_linked_to_parent_and_pass_its_params_on(self):
+        fsm = FSM(self.db, self._definition(SubMachine(self.child_definition, self.child_db)))
+        run_id = fsm.start_runs([{"val": 1}])[0]
+
+        fsm.run(run_id)
+
+        self.assertDictEqual({"val": 4}, self.db.find_state("NEXT", run_id).params)
+        child_run_id = self.db.find_state(INITIAL_STATE, run_id).params[SUB_RUN_IDS][0]
+        self.assertEqual(run_id, self.child_db.find_state(INITIAL_STATE, child_run_id).params[PARENT_RUN_ID])
+        self.assertEqual(1, self.db.find_state(INITIAL_STATE, run_id).visit_count)
+
+    def test_fanned_out_children_should_run_concurrently(self):
+        sub_machine = SubMachine({INITIAL_STATE: (slow_child, TERMINAL_STATE, TERMINAL_STATE, True),
+                                  TERMINAL_STATE: (None, None, None, False)}, self.child_db,
+                                 fan_out=lambda params: [{"val": val} for val in params["vals"]])
+        fsm = FSM(self.db, self._definition(sub_machine))
+        run_id = fsm.start_runs([{"vals": [1, 2, 3]}])[0]
+
+        started = time.perf_counter()
+        fsm.run(run_id)
+
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertDictEqual({"vals": [1, 2, 3], "children": [{"val": 2}, {"val": 4}, {"val": 6}]},
+                             self.db.find_state("NEXT", run_id).params)
+
+    def test_failed_child_should_fail_parent_and_retry_should_start_new_child(self):
+        flaky = MagicMock(side_effect=[(False, "not ready", {}), {"val": 5}])
+        sub_machine = SubMachine({INITIAL_STATE: (flaky, TERMINAL_STATE, "FAILED", True),
+                                  "FAILED": (None, None, None, False),
+                                  TERMINAL_STATE: (None, None, None, False)}, self.child_db)
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (sub_machine, TERMINAL_STATE, INITIAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 2})
+        run_id = fsm.start_runs([{"val": 0}])[0]
+
+        fsm.run(run_id)
+
+        last_state = self.db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 5}, last_state.params)
+        error = self.db.find_state(INITIAL_STATE, run_id).errors[0]['error']
+        self.assertIn("ended in [FAILED]: not ready", error)
+        self.assertEqual(2, flaky.call_count)
+        # the failed child stays in its dead end state
+        self.assertEqual(1, len(self.child_db.get_active_runs()))
+
+    def test_yielding_sub_machine_state_should_run_children_once_resumed(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (lambda params: params, "SUB", "FAILED", True),
+            "SUB": (SubMachine(self.child_definition, self.child_db), TERMINAL_STATE, "FAILED", False),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_id = fsm.start_runs([{"val": 1}])[0]
+
+        fsm.run(run_id)
+        self.assertTrue(self.db.get_last_state(run_id).yielded)
+        fsm.run(run_id)
+
+        last_state = self.db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 4}, last_state.params)
+        self.assertEqual(1, self.db.find_state("SUB", run_id).visit_count)
+
+    def test_parent_should_wait_for_children_advanced_by_other_workers(self):
+        sub_machine = SubMachine(dict(self.child_definition, **{
+            INITIAL_STATE: (self.child_definition[INITIAL_STATE][0], "DOUBLE", "FAILED", False)}),
+            self.child_db, run_inline=False, poll_seconds=0.1)
+        fsm = FSM(self.db, self._definition(sub_machine))
+        run_id = fsm.start_runs([{"val": 1}])[0]
+
+        fsm.run(run_id)
+        parked = self.db.get_last_state(run_id)
+        self.assertEqual(INITIAL_STATE, parked.name)
+        self.assertTrue(parked.yielded)
+        self.assertIsNotNone(parked.due_at)
+        child_run_id = parked.params[SUB_RUN_IDS][0]
+
+        child_executor = FsmExecutor(self.child_db, self.child_definition)
+        child_executor.run_many([child_run_id])
+        child_executor.run_many([child_run_id])
+        time.sleep(0.15)
+        fsm.run(run_id)
+
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_id).name)
+        self.assertDictEqual({"val": 4}, self.db.find_state("NEXT", run_id).params)
+        self.assertListEqual([child_run_id], self.db.find_state(INITIAL_STATE, run_id).params[SUB_RUN_IDS])
+        self.assertListEqual([], self.child_db.get_active_runs())
+
+    def test_child_run_without_states_should_fail_parent(self):
+        sub_machine = SubMachine(self.child_definition, self.child_db, run_inline=False)
+
+        result = sub_machine.advance("parent", {"val": 1, SUB_RUN_IDS: ["missing"]})
+
+        self.assertEqual((False, "Sub-machine runs failed: [missing] has no states", {"val": 1}), result)
+
+
+class TestAsyncSubMachine(unittest.IsolatedAsyncioTestCase):
+
+    async def test_async_fsm_should_run_child_runs(self):
+        child_db = MemoryStateStorage()
+        db = OffloadedStateStorage(MemoryStateStorage())
+        fsm = AsyncFiniteStateMachine(db, {
+            INITIAL_STATE: (SubMachine({INITIAL_STATE: (slow_child, TERMINAL_STATE, TERMINAL_STATE, True),
+                                        TERMINAL_STATE: (None, None, None, False)}, child_db),
+                            TERMINAL_STATE, TERMINAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_id = (await fsm.start_runs([{"val": 2}]))[0]
+
+        await fsm.run(run_id)
+
+        last_state = await db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 4}, last_state.params)
+
+    async def test_async_yielding_sub_machine_state_should_run_children_once_resumed(self):
+        db = OffloadedStateStorage(MemoryStateStorage())
+        fsm = AsyncFiniteStateMachine(db, {
+            INITIAL_STATE: (lambda params: params, "SUB", TERMINAL_STATE, True),
+            "SUB": (SubMachine({INITIAL_STATE: (slow_child, TERMINAL_STATE, TERMINAL_STATE, True),
+                                TERMINAL_STATE: (None, None, None, False)}, MemoryStateStorage()),
+                    TERMINAL_STATE, TERMINAL_STATE, False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_id = (await fsm.start_runs([{"val": 2}]))[0]
+
+        await fsm.run(run_id)
+        self.assertTrue((await db.get_last_state(run_id)).yielded)
+        await fsm.run(run_id)
+
+        last_state = await db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 4}, last_state.params)
+
+
+if __name__ == '__main__':
+    unittest.main()
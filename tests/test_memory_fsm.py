@@ -0,0 +1,280 @@
+import logging
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_memory.fsm_memory_storage import MemoryStateStorage
+
+
+class TestFiniteStateMachine(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.wal_path = os.path.join(self.tmp_dir.name, 'fsm.wal')
+        self.db = MemoryStateStorage()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_current_FSM_state(self, state, db=None):
+        last_state = (db or self.db).get_last_state()
+        self.assertEqual(state, last_state.name)
+
+    def test_fsm_with_no_states_should_raise_exception_because_init_state_is_missing(self):
+        fsm = FSM(self.db, {})
+
+        with self.assertRaises(KeyError):
+            fsm.run()
+
+    def test_fsm_should_transition_to_failed_state_if_action_failed(self):
+        params = {"val": 1}
+        transition_action = MagicMock(return_value=(False, "", params))
+        failure_transition_action = MagicMock(return_value=(True, "", {}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (transition_action, TERMINAL_STATE, "ABORT", True),
+            "ABORT": (failure_transition_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        self.assertIsNone(self.db.get_last_state())
+        fsm.run()
+        transition_action.assert_called_once_with({})
+        failure_transition_action.assert_called_once_with(params)
+        self.assert_current_FSM_state(TERMINAL_STATE)
+
+    def test_multiple_fsm_runs_should_return_correct_current_state(self):
+        params = {"val": 1}
+        transition_action = MagicMock(return_value=(True, "", params))
+        next_transition_action = MagicMock(return_value=(True, "", {}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (transition_action, "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        fsm.run()
+        self.assert_current_FSM_state("NEXT")
+        fsm.run()
+        next_transition_action.assert_called_once_with(params)
+        self.assert_current_FSM_state(TERMINAL_STATE)
+        fsm.run()
+        self.assert_current_FSM_state("NEXT")
+
+        history_after_run = self.db.get_db_history()
+        self.assertEqual(5, len(history_after_run))
+        self.assertEqual(1, len(self.db.get_active_runs()))
+
+    def test_fsm_should_terminate_if_transition_fails_continuously(self):
+        next_transition_action = MagicMock(return_value=(False, "failed", {}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NEXT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 3})
+
+        fsm.run()
+
+        self.assert_current_FSM_state(TERMINAL_STATE)
+        history_after_run = self.db.get_db_history()
+        self.assertListEqual([1, 3, 1], [x.visit_count for x in history_after_run])
+        self.assertListEqual([2, 3], [x['visit_idx'] for x in history_after_run[1].errors])
+
+    def test_returned_states_should_not_change_storage_until_saved(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {"val": 1})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (None, None, None, False)
+        })
+        fsm.run()
+
+        last_state = self.db.get_last_state()
+        last_state.params["val"] = 2
+
+        self.assertEqual({"val": 1}, self.db.get_last_state().params)
+
+    def test_storage_should_recover_states_from_write_ahead_log(self):
+        db = MemoryStateStorage(self.wal_path)
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {"val": 1})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        fsm.run()
+        db.close()
+
+        recovered_db = MemoryStateStorage(self.wal_path)
+
+        self.assert_current_FSM_state("NEXT", recovered_db)
+        self.assertListEqual([(x.id, x.name, x.params) for x in db.get_db_history()],
+                             [(x.id, x.name, x.params) for x in recovered_db.get_db_history()])
+        FSM(recovered_db, fsm.state_transitions).run()
+        self.assert_current_FSM_state(TERMINAL_STATE, recovered_db)
+
+    def test_storage_should_compact_log_into_snapshot_and_ignore_torn_records(self):
+        db = MemoryStateStorage(self.wal_path, snapshot_every=3)
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        fsm.run()
+        db.close()
+        with open(self.wal_path, 'a') as wal:
+            wal.write('{"op": "put", "sta')
+
+        recovered_db = MemoryStateStorage(self.wal_path)
+
+        self.assertTrue(os.path.exists(self.wal_path + '.snapshot'))
+        self.assert_current_FSM_state(TERMINAL_STATE, recovered_db)
+        self.assertEqual(3, len(recovered_db.get_db_history()))
+
+    def test_fsm_should_read_each_state_of_a_run_only_once(self):
+        db = MagicMock(wraps=self.db)
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "LOOP-START", "NOT-EXISTENT", True),
+            "LOOP-START": (MagicMock(return_value=(True, "", {})), "LOOP-END", TERMINAL_STATE, True),
+            "LOOP-END": (MagicMock(return_value=(True, "", {})), "LOOP-START", TERMINAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 10})
+
+        fsm.run()
+
+        self.assert_current_FSM_state(TERMINAL_STATE)
+        self.assertListEqual([1, 10, 10, 1], [x.visit_count for x in self.db.get_db_history()])
+        self.assertEqual(1, db.get_last_state.call_count)
+        self.assertEqual(2, db.find_state.call_count)
+
+    def test_fsm_should_run_on_storages_not_calling_base_init(self):
+        class LegacyStorage(MemoryStateStorage):
+            def __init__(self):
+                # storages written before state listeners existed don't call `StateStorage.__init__`
+                vars(self).update({name: value for name, value in vars(MemoryStateStorage()).items()
+                                   if not name.startswith('_state_listeners')})
+
+        db = LegacyStorage()
+        other_db = LegacyStorage()
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        fsm.run()
+        db.add_state_listener(MagicMock())
+
+        self.assertEqual(TERMINAL_STATE, db.get_last_state().name)
+        self.assertListEqual([], other_db._state_listeners)
+
+    def test_fsm_should_see_states_written_through_storage_during_run(self):
+        resets = []
+
+        def reset_visits_once(params):
+            if not resets:
+                state = self.db.find_state("NEXT", fsm.run_id)
+                state.visit_count = 0
+                self.db.yield_state(state, False)
+                resets.append(state.run_id)
+            return True, "", {}
+
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (reset_visits_once, "NEXT", TERMINAL_STATE, True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 3})
+
+        fsm.run()
+
+        # the reset made by the action is seen, so NEXT is entered 3 more times before the run terminates
+        self.assertListEqual([1, 3, 1], [x.visit_count for x in self.db.get_db_history()])
+        self.assertEqual(1, len(resets))
+
+    def test_storage_should_notify_listeners_about_written_and_invalidated_runs(self):
+        listener = MagicMock()
+        self.db.add_state_listener(listener)
+        state = self.db.new_initial_state()
+        self.db.save_state(state)
+        self.db.invalidate(state.run_id)
+        self.db.remove_state_listener(listener)
+        self.db.save_state(state)
+
+        self.assertListEqual([((state.run_id, state),), ((state.run_id, None),)], listener.call_args_list)
+
+    def test_quiet_fsm_should_log_single_record_per_transition(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (MagicMock(return_value=(False, "failed", {})), TERMINAL_STATE, "NEXT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 2}, quiet=True)
+
+        with self.assertLogs('.fsm', level='INFO') as logs:
+            fsm.run()
+
+        transitions = [(record.args['from_state'], record.args['to_state'], record.args['outcome'])
+                       for record in logs.records if record.levelname == 'INFO']
+        self.assertListEqual([(INITIAL_STATE, "NEXT", 'success'),
+                              ("NEXT", "NEXT", 'failure'),
+                              ("NEXT", TERMINAL_STATE, 'terminated')], transitions)
+
+    def test_fsm_should_not_format_log_arguments_of_disabled_levels(self):
+        class CountingRepr(object):
+            calls = 0
+
+            def __repr__(self):
+                CountingRepr.calls += 1
+                return 'counted'
+
+        fsm_logger = logging.getLogger('.fsm')
+        level = fsm_logger.level
+        fsm_logger.setLevel(logging.WARNING)
+        try:
+            FSM(self.db, {
+                INITIAL_STATE: (MagicMock(return_value=(True, "", {"val": CountingRepr()})), "NEXT", "NOT-EXISTENT",
+                                True),
+                "NEXT": (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", True),
+                TERMINAL_STATE: (None, None, None, False)
+            }).run()
+        finally:
+            fsm_logger.setLevel(level)
+
+        self.assertEqual(0, CountingRepr.calls)
+
+    def test_iter_history_should_stream_copies_in_creation_order(self):
+        run_ids = self.db.start_runs([{"val": i} for i in range(5)])
+
+        history = list(self.db.iter_history(batch_size=2))
+        history[0].params["val"] = 100
+
+        self.assertListEqual([{"val": i} for i in range(5)], [x.params for x in self.db.iter_history()])
+        self.assertListEqual([{"val": 3}], [x.params for x in self.db.iter_history(run_ids[3])])
+        self.assertFalse(list(self.db.iter_history(since=datetime(2100, 1, 1))))
+
+    def test_claim_runs_should_claim_parked_runs_once_due_and_listed_runs_whenever(self):
+        run_ids = self.db.start_runs([{"val": i} for i in range(4)])
+        self.db.yield_state(self.db.get_last_state(run_ids[0]), True, datetime.utcnow() - timedelta(seconds=1))
+        self.db.yield_state(self.db.get_last_state(run_ids[1]), True, datetime.utcnow() + timedelta(minutes=1))
+        self.db.yield_state(self.db.get_last_state(run_ids[2]), True)
+        self.db.terminate(run_ids[3])
+
+        self.assertListEqual([run_ids[0]], self.db.claim_runs("a", 10, 60))
+        self.assertCountEqual(run_ids[1:3], self.db.claim_runs("b", 10, 60, run_ids))
+        self.assertFalse(self.db.claim_runs("c", 10, 60, run_ids))
+
+    def test_claim_runs_should_lease_runs_to_a_single_owner(self):
+        run_ids = self.db.start_runs([{"val": i} for i in range(4)])
+        self.db.terminate(run_ids[3])
+
+        self.assertListEqual(run_ids[:2], self.db.claim_runs("a", 2, 60))
+        self.assertListEqual([run_ids[2]], self.db.claim_runs("b", 10, 60))
+        self.assertFalse(self.db.claim_runs("b", 10, 60))
+
+        self.assertFalse(self.db.renew_lease(run_ids[0], "b", 60))
+        self.db.release_run(run_ids[0], "b")
+        self.assertFalse(self.db.claim_runs("b", 10, 60))
+        self.db.release_run(run_ids[0], "a")
+        self.assertListEqual([run_ids[0]], self.db.claim_runs("b", 10, 60))
+        # an expired lease can be claimed by anyone, its former owner can't renew it anymore
+        self.assertTrue(self.db.renew_lease(run_ids[1], "a", -1))
+        self.assertListEqual([run_ids[1]], self.db.claim_runs("c", 10, 60))
+        self.assertFalse(self.db.renew_lease(run_ids[1], "a", 60))
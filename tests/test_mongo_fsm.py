@@ -1,16 +1,23 @@
+import time
 import unittest
-from unittest.mock import MagicMock
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
 
 import mongomock as mongomock
 from mongoengine.connection import get_connection
 
 from mongoengine import connect
 
+from fsm.fsm_mongo.fsm_mongo_models import ARCHIVE_ENTRY_COLLECTION, ARCHIVE_STATUS_COLLECTION, StateStatus
+from fsm.fsm_mongo import fsm_mongo_storage
 from fsm.fsm_mongo.fsm_mongo_storage import MongoStateStorage
 
 from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
 
 from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_memo import StepMemo, params_hash
+from fsm.fsm_parallel import Parallel, BRANCH_RESULTS
+from fsm.fsm_submachine import SubMachine, SUB_RUN_IDS, PARENT_RUN_ID
 
 
 class TestFiniteStateMachine(unittest.TestCase):
@@ -229,3 +236,251 @@ class TestFiniteStateMachine(unittest.TestCase):
 
         self.assertIsNone(self.db.get_last_state())
         self.assertRaises(KeyError, fsm.run)
+
+    def test_last_state_should_be_tracked_per_run(self):
+        transition_action = MagicMock(return_value=(True, "", {}))
+        next_transition_action = MagicMock(return_value=(True, "", {}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (transition_action, "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        fsm.run()
+        first_run_id = self.db.get_last_state().run_id
+        fsm.run()
+        fsm.run()
+        second_run_id = self.db.get_last_state().run_id
+
+        self.assertNotEqual(first_run_id, second_run_id)
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(first_run_id).name)
+        self.assertEqual("NEXT", self.db.get_last_state(second_run_id).name)
+        self.assertListEqual([second_run_id], self.db.get_active_runs())
+
+    def test_active_runs_index_should_only_use_partial_filter_operators_mongo_supports(self):
+        # mongomock ignores partial filters, a real server rejects `$ne` and other operators in them
+        partial_specs = [spec for spec in StateStatus._meta['index_specs'] if 'partialFilterExpression' in spec]
+
+        self.assertListEqual([{'fields': [('update_time', 1)], 'partialFilterExpression': {'active': True}}],
+                             partial_specs)
+
+    def test_status_should_be_flagged_active_until_run_is_terminated(self):
+        run_ids = self.db.start_runs([{}, {}, {}])
+        self.db.terminate(run_ids[0])
+        statuses = StateStatus._get_collection()
+        statuses.update_one({'run_id': run_ids[1]}, {'$unset': {'active': ''}})
+
+        self.assertListEqual([run_ids[2]], self.db.get_active_runs())
+        fsm_mongo_storage.migrate_active_flag()
+
+        self.assertListEqual(run_ids[1:], self.db.get_active_runs())
+        self.assertNotIn('active', statuses.find_one({'run_id': run_ids[0]}))
+        self.assertCountEqual(run_ids[1:], self.db.claim_runs("worker-1", 10, 60))
+
+    def test_started_runs_should_be_advanced_from_their_initial_state(self):
+        transition_action = MagicMock(side_effect=lambda params: (True, "", {"val": params["val"] + 1}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (transition_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        run_ids = fsm.start_runs([{"val": 1}, {"val": 2}, {"val": 3}])
+
+        self.assertEqual(3, len(set(run_ids)))
+        self.assertListEqual(run_ids, self.db.get_active_runs())
+        fsm.run(run_ids[1])
+        transition_action.assert_called_once_with({"val": 2})
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(run_ids[1]).name)
+        self.assertEqual({"val": 3}, self.db.get_last_state(run_ids[1]).params)
+        self.assertListEqual([run_ids[0], run_ids[2]], self.db.get_active_runs())
+
+    def test_iter_history_should_page_through_entries_in_creation_order(self):
+        run_ids = self.db.start_runs([{"val": i} for i in range(5)])
+
+        history = list(self.db.iter_history(batch_size=2))
+
+        self.assertListEqual([{"val": i} for i in range(5)], [x.params for x in history])
+        self.assertListEqual([{"val": 3}], [x.params for x in self.db.iter_history(run_ids[3])])
+        self.assertFalse(list(self.db.iter_history(since=datetime(2100, 1, 1))))
+        self.assertEqual(5, len(list(self.db.iter_history(until=datetime(2100, 1, 1)))))
+
+    def test_archive_runs_should_move_finished_runs_to_archive_collections(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_ids = self.db.start_runs([{"val": i} for i in range(3)])
+        fsm.run(run_ids[0])
+        fsm.run(run_ids[1])
+        # mongo keeps milliseconds only
+        later = datetime.utcnow() + timedelta(seconds=1)
+
+        self.assertEqual(2, self.db.archive_runs(later))
+        self.assertEqual(0, self.db.archive_runs(later))
+
+        self.assertListEqual([run_ids[2]], [x.run_id for x in self.db.get_db_history()])
+        self.assertListEqual([run_ids[2]], self.db.get_active_runs())
+        database = get_connection()['mongoenginetest']
+        self.assertEqual(4, database[ARCHIVE_ENTRY_COLLECTION].count_documents({}))
+        self.assertEqual(2, database[ARCHIVE_STATUS_COLLECTION].count_documents({'ref_state_name': TERMINAL_STATE}))
+        self.assertEqual(1, self.db.archive_runs(later, stale_before=later))
+
+    def test_archive_runs_should_keep_stale_runs_leased_to_a_worker(self):
+        run_ids = self.db.start_runs([{"val": 1}, {"val": 2}])
+        self.assertListEqual(run_ids[:1], self.db.claim_runs("worker-1", 10, 60, run_ids[:1]))
+        later = datetime.utcnow() + timedelta(seconds=1)
+
+        self.assertEqual(1, self.db.archive_runs(later, stale_before=later))
+
+        self.assertListEqual([run_ids[0]], self.db.get_active_runs())
+        self.db.release_run(run_ids[0], "worker-1")
+        self.assertEqual(1, self.db.archive_runs(later, stale_before=later))
+
+    def test_archive_runs_should_keep_entries_written_after_they_were_copied(self):
+        run_id = self.db.start_runs([{"val": 1}])[0]
+        late_entry = self.db.new_initial_state({"val": 2})
+        late_entry.run_id, late_entry.name = run_id, "LATE"
+        archive_documents = fsm_mongo_storage._archive_documents
+
+        def archive_and_write(collection, documents, archived_at):
+            archive_documents(collection, documents, archived_at)
+            if collection.name == ARCHIVE_ENTRY_COLLECTION:
+                late_entry.save()
+
+        with patch.object(fsm_mongo_storage, '_archive_documents', side_effect=archive_and_write):
+            self.assertEqual(1, self.db.archive_runs(datetime.utcnow(), stale_before=datetime.utcnow()))
+
+        self.assertListEqual(["LATE"], [x.name for x in self.db.get_db_history()])
+        database = get_connection()['mongoenginetest']
+        self.assertListEqual([INITIAL_STATE], [x['name'] for x in database[ARCHIVE_ENTRY_COLLECTION].find()])
+
+    def test_claim_runs_should_skip_leased_finished_and_yielded_runs(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "PARKED", "NOT-EXISTENT", True),
+            "PARKED": (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_ids = self.db.start_runs([{"val": i} for i in range(5)])
+        fsm.run(run_ids[0])
+        self.db.terminate(run_ids[1])
+
+        self.assertCountEqual(run_ids[2:], self.db.claim_runs("a", 3, 60))
+        self.assertFalse(self.db.claim_runs("b", 10, 60))
+
+        self.assertTrue(self.db.renew_lease(run_ids[2], "a", 60))
+        self.assertFalse(self.db.renew_lease(run_ids[2], "b", 60))
+        self.db.release_run(run_ids[2], "a")
+        self.assertListEqual([run_ids[2]], self.db.claim_runs("b", 10, 60))
+        self.assertTrue(self.db.renew_lease(run_ids[3], "a", -1))
+        self.assertListEqual([run_ids[3]], self.db.claim_runs("c", 10, 60))
+
+    def test_claim_runs_should_claim_parked_runs_once_due_and_listed_runs_whenever(self):
+        run_ids = self.db.start_runs([{"val": i} for i in range(4)])
+        self.db.yield_state(self.db.get_last_state(run_ids[0]), True, datetime.utcnow() - timedelta(seconds=1))
+        self.db.yield_state(self.db.get_last_state(run_ids[1]), True, datetime.utcnow() + timedelta(minutes=1))
+        self.db.yield_state(self.db.get_last_state(run_ids[2]), True)
+        self.db.terminate(run_ids[3])
+
+        self.assertListEqual([run_ids[0]], self.db.claim_runs("a", 10, 60))
+        self.assertCountEqual(run_ids[1:3], self.db.claim_runs("b", 10, 60, run_ids))
+        self.assertFalse(self.db.claim_runs("c", 10, 60, run_ids))
+
+    def test_iter_yielded_runs_should_page_parked_runs(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "PARKED", "NOT-EXISTENT", True),
+            "PARKED": (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_ids = self.db.start_runs([{} for _ in range(5)])
+        for run_id in run_ids[:4]:
+            fsm.run(run_id)
+        fsm.run(run_ids[0])
+
+        self.assertListEqual(run_ids[1:4], list(self.db.iter_yielded_runs(batch_size=2)))
+
+    def test_get_due_runs_should_return_parked_runs(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(False, "not ready", {}, 60)), TERMINAL_STATE, INITIAL_STATE,
+                            True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 5})
+        run_ids = self.db.start_runs([{} for _ in range(3)])
+        for run_id in run_ids[:2]:
+            fsm.run(run_id)
+
+        due_runs = self.db.get_due_runs(datetime.utcnow() + timedelta(minutes=2))
+        self.assertListEqual(run_ids[:2], [run_id for run_id, _ in due_runs])
+        self.assertFalse(self.db.get_due_runs(datetime.utcnow()))
+        self.assertFalse(list(self.db.iter_yielded_runs()))
+
+    def test_parallel_state_should_persist_branch_results_between_runs(self):
+        flaky_branch = MagicMock(side_effect=[(False, "not ready", {}), {"flaky": 2}])
+        stable_branch = MagicMock(return_value={"stable": 1})
+        definition = {
+            INITIAL_STATE: (Parallel({"stable": stable_branch, "flaky": flaky_branch}), TERMINAL_STATE,
+                            INITIAL_STATE, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+        run_id = self.db.start_runs([{"val": 0}])[0]
+        FSM(self.db, definition, {DEFAULT: 3}).run(run_id)
+        FSM(self.db, definition, {DEFAULT: 3}).run(run_id)
+        self.assertDictEqual({"val": 0, BRANCH_RESULTS: {"stable": {"stable": 1}}},
+                             self.db.get_last_state(run_id).params)
+
+        FSM(self.db, definition, {DEFAULT: 3}).run(run_id)
+
+        stable_branch.assert_called_once_with({"val": 0})
+        self.assertEqual(2, flaky_branch.call_count)
+        last_state = self.db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 0, "stable": {"stable": 1}, "flaky": {"flaky": 2}}, last_state.params)
+
+    def test_recorded_step_results_should_be_reused_after_crash_and_archived_with_runs(self):
+        action = MagicMock(return_value=(True, None, {"charged": 1}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, memoize={INITIAL_STATE: StepMemo()})
+        run_id = self.db.start_runs([{"amount": 10}])[0]
+
+        with patch.object(self.db, 'set_current_state', side_effect=RuntimeError("crash")), \
+                patch.object(self.db, 'set_next_state', side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                fsm.run(run_id)
+        fsm.run(run_id)
+
+        action.assert_called_once_with({"amount": 10})
+        self.assertDictEqual({"charged": 1}, self.db.get_last_state(run_id).params)
+        digest = params_hash({"amount": 10})
+        self.db.save_step_result(run_id, INITIAL_STATE, 1, digest, {'success': False})
+        self.assertTrue(self.db.find_step_result(run_id, INITIAL_STATE, 1, digest)['success'])
+        self.assertIsNone(self.db.find_step_result(run_id, INITIAL_STATE, 2, digest))
+        self.assertEqual(1, self.db.archive_runs(datetime.utcnow() + timedelta(seconds=1)))
+        self.assertIsNone(self.db.find_step_result(run_id, INITIAL_STATE, 1, digest))
+
+    def test_sub_machine_state_should_wait_for_its_child_run_across_runs(self):
+        child_db = MongoStateStorage()
+        sub_machine = SubMachine({
+            INITIAL_STATE: (lambda params: {"val": params["val"] + 1}, TERMINAL_STATE, "FAILED", False),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }, child_db, poll_seconds=0.1)
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (sub_machine, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_id = self.db.start_runs([{"val": 1}])[0]
+
+        fsm.run(run_id)
+        parked = self.db.get_last_state(run_id)
+        self.assertTrue(parked.yielded)
+        self.assertIsNotNone(parked.due_at)
+        child_run_id = parked.params[SUB_RUN_IDS][0]
+        self.assertEqual(run_id, child_db.find_state(INITIAL_STATE, child_run_id).params[PARENT_RUN_ID])
+        time.sleep(0.15)
+        fsm.run(run_id)
+
+        last_state = self.db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 2}, last_state.params)
+        self.assertEqual(1, self.db.find_state(INITIAL_STATE, run_id).visit_count)
@@ -0,0 +1,150 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+from glob import glob
+from unittest.mock import AsyncMock, MagicMock
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
+from fsm.fsm_async import AsyncFiniteStateMachine as FSM
+from fsm.fsm_postgre.fsm_postgre_async_storage import AsyncPostgreStateStorage
+from fsm.fsm_postgre.fsm_postgre_models import Base, CompressedJSONB
+from fsm.fsm_postgre.fsm_postgre_storage import PostgreStateStorage
+
+import testing.postgresql
+
+testing.postgresql.SEARCH_PATHS.extend(glob('/opt/local/lib/postgresql*') + glob('/usr/local/opt/postgresql*'))
+
+
+class TestAsyncPostgreStateStorage(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.pg = testing.postgresql.Postgresql()
+        engine = sqlalchemy.create_engine(self.pg.url())
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        engine.dispose()
+        self.tenant_id = "123"
+
+    async def asyncSetUp(self):
+        # a small pool, runs must not hold a connection while their action runs
+        self.engine = create_async_engine(self.pg.url().replace('postgresql://', 'postgresql+asyncpg://'),
+                                          pool_size=2, max_overflow=0, pool_timeout=5)
+        self.db = AsyncPostgreStateStorage(async_sessionmaker(self.engine), self.tenant_id)
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    def tearDown(self):
+        self.pg.stop()
+
+    async def test_fsm_should_count_visits_append_errors_and_terminate(self):
+        flaky_action = MagicMock(return_value=(False, "failed", {"val": 1}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (AsyncMock(return_value=(True, "", {"val": 0})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (flaky_action, TERMINAL_STATE, "NEXT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 3})
+        run_id = (await fsm.start_runs([{}]))[0]
+
+        await fsm.run(run_id)
+
+        history = await self.db.get_db_history()
+        self.assertListEqual([INITIAL_STATE, "NEXT", TERMINAL_STATE], [x.name for x in history])
+        self.assertListEqual([1, 3, 1], [x.visit_count for x in history])
+        self.assertListEqual([{"error": "failed", "visit_idx": 2}, {"error": "failed", "visit_idx": 3}],
+                             history[1].errors)
+        self.assertEqual(3, flaky_action.call_count)
+        self.assertEqual(TERMINAL_STATE, (await self.db.get_last_state(run_id)).name)
+
+    async def test_terminate_should_replace_terminal_state_like_sync_storage(self):
+        sync_engine = sqlalchemy.create_engine(self.pg.url())
+        self.addCleanup(sync_engine.dispose)
+        sync_db = PostgreStateStorage(sessionmaker(bind=sync_engine), "sync")
+        run_id = (await self.db.start_runs([{}]))[0]
+        sync_run_id = sync_db.start_runs([{}])[0]
+
+        for _ in range(2):
+            await self.db.terminate(run_id)
+            sync_db.terminate(sync_run_id)
+
+        terminal = await self.db.find_state(TERMINAL_STATE, run_id)
+        sync_terminal = sync_db.find_state(TERMINAL_STATE, sync_run_id)
+        self.assertEqual(sync_terminal.visit_count, terminal.visit_count)
+        self.assertListEqual(sync_terminal.errors, terminal.errors)
+        self.assertListEqual([{"error": "Max retry count reached", "visit_idx": 1}], terminal.errors)
+
+    async def test_run_many_should_not_hold_connections_during_actions(self):
+        sessions_during_actions = []
+
+        async def slow_action(params):
+            sessions_during_actions.append(self.db._step_session.get())
+            await asyncio.sleep(0.1)
+            return params
+
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (slow_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_ids = await fsm.start_runs([{"val": val} for val in range(20)])
+
+        report = await fsm.run_many(run_ids, concurrency=20)
+
+        self.assertEqual(0, report.failed)
+        self.assertEqual(20, len(sessions_during_actions))
+        self.assertTrue(all(session is None for session in sessions_during_actions))
+        self.assertListEqual([], await self.db.get_active_runs())
+
+    async def test_parked_runs_should_be_due_and_leased_runs_claimable_once_released(self):
+        run_ids = await self.db.start_runs([{"val": 1}, {"val": 2}])
+        parked = await self.db.get_last_state(run_ids[0])
+        await self.db.yield_state(parked, True, datetime.utcnow() - timedelta(seconds=1))
+
+        due_runs = await self.db.get_due_runs(datetime.utcnow())
+        claimed = await self.db.claim_runs("worker-1", 10, 60)
+
+        self.assertListEqual([run_ids[0]], [run_id for run_id, _ in due_runs])
+        self.assertCountEqual(run_ids, claimed)
+        self.assertListEqual([], await self.db.claim_runs("worker-2", 10, 60, run_ids))
+        self.assertTrue(await self.db.renew_lease(run_ids[1], "worker-1", 60))
+        self.assertFalse(await self.db.renew_lease(run_ids[1], "worker-2", 60))
+        await self.db.release_run(run_ids[1], "worker-1")
+        self.assertListEqual([run_ids[1]], await self.db.claim_runs("worker-2", 10, 60))
+
+    async def test_history_should_page_through_entries_and_archive_finished_runs(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=True), TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_ids = await fsm.start_runs([{"val": val} for val in range(3)])
+        await fsm.run_many(run_ids)
+        await self.db.save_step_result(run_ids[0], INITIAL_STATE, 1, "digest", {'success': True})
+
+        history = [state async for state in self.db.iter_history(batch_size=2)]
+        archived = await self.db.archive_runs(datetime.utcnow() + timedelta(seconds=1))
+
+        self.assertEqual(6, len(history))
+        self.assertEqual(3, archived)
+        self.assertListEqual([], await self.db.get_db_history())
+        self.assertIsNone(await self.db.find_step_result(run_ids[0], INITIAL_STATE, 1, "digest"))
+
+    async def test_large_params_should_be_stored_compressed_by_storages_asking_for_it(self):
+        large_params = {"payload": ["item-{}".format(i) for i in range(1000)]}
+        db = AsyncPostgreStateStorage(async_sessionmaker(self.engine), self.tenant_id, compress_params_over=1024)
+
+        run_id = (await db.start_runs([large_params]))[0]
+        await self.db.start_runs([large_params])
+
+        async with self.engine.connect() as connection:
+            stored = [row[0] for row in await connection.exec_driver_sql(
+                "SELECT params::text FROM state_entry ORDER BY id")]
+        self.assertIn(CompressedJSONB.ENVELOPE_KEY, stored[0])
+        self.assertNotIn(CompressedJSONB.ENVELOPE_KEY, stored[1])
+        self.assertEqual(large_params, (await self.db.get_last_state(run_id)).params)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,22 @@
+import threading
+import time
 import unittest
+from datetime import datetime, timedelta
 from glob import glob
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from fsm import TERMINAL_STATE, INITIAL_STATE, DEFAULT
 from fsm.fsm import FiniteStateMachine as FSM
+from fsm.fsm_memo import StepMemo, params_hash
+from fsm.fsm_parallel import Parallel, BRANCH_RESULTS
+from fsm.fsm_submachine import SubMachine, SUB_RUN_IDS, PARENT_RUN_ID
+from fsm.fsm_batching import BatchingStateStorage, FLUSH_PER_RUN
 import sqlalchemy
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 
-from fsm.fsm_postgre.fsm_postgre_models import Base
+from fsm.fsm_postgre.fsm_postgre_models import Base, StateStatus, StateEntryArchive, StateStatusArchive, \
+    CompressedJSONB
+from fsm.fsm_postgre.fsm_postgre_migrations import create_indexes, migrate_status_per_run, migrate_json_to_jsonb
 from fsm.fsm_postgre.fsm_postgre_storage import PostgreStateStorage
 
 import testing.postgresql
@@ -22,10 +32,10 @@ class TestFiniteStateMachine(unittest.TestCase):
         assert self.engine is not None
         Base.metadata.drop_all(self.engine)
         Base.metadata.create_all(self.engine)
-        DBSession = sessionmaker(bind=self.engine)
+        self.DBSession = sessionmaker(bind=self.engine)
         self.tenant_id = "123"
         self.match_id = 0
-        self.db = PostgreStateStorage(DBSession, self.tenant_id)
+        self.db = PostgreStateStorage(self.DBSession, self.tenant_id)
 
     def tearDown(self):
         self.pg.stop()
@@ -254,3 +264,521 @@ class TestFiniteStateMachine(unittest.TestCase):
 
         fsm.run()
         self.assertTrue(True)
+
+    def test_single_round_trip_storage_should_count_visits_and_append_errors(self):
+        db = PostgreStateStorage(self.DBSession, self.tenant_id, single_round_trip=True)
+        transition_action = MagicMock(return_value=(True, "", {}))
+        next_transition_action = MagicMock(return_value=(False, "failed", {"val": 1}))
+
+        fsm = FSM(db, {
+            INITIAL_STATE: (transition_action, "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NEXT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 3})
+
+        fsm.run()
+
+        history_after_run = db.get_db_history()
+        self.assertListEqual([INITIAL_STATE, "NEXT", TERMINAL_STATE], [x.name for x in history_after_run])
+        self.assertListEqual([1, 3, 1], [x.visit_count for x in history_after_run])
+        self.assertListEqual([{"error": "failed", "visit_idx": 2}, {"error": "failed", "visit_idx": 3}],
+                             history_after_run[1].errors)
+        self.assertEqual({"val": 1}, history_after_run[1].params)
+
+    def test_single_round_trip_storage_should_not_record_empty_errors_on_revisit(self):
+        db = PostgreStateStorage(self.DBSession, self.tenant_id, single_round_trip=True)
+        flaky_action = MagicMock(side_effect=[(False, "failed", {}), (True, "", {"val": 1})])
+
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (flaky_action, "LOOP", "NEXT", True),
+            "LOOP": (MagicMock(return_value=(True, "", {})), "NEXT", "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 3})
+        run_id = db.start_runs([{}])[0]
+
+        fsm.run(run_id)
+
+        loop_state = db.find_state("LOOP", run_id)
+        next_state = db.find_state("NEXT", run_id)
+        self.assertListEqual([], loop_state.errors)
+        self.assertListEqual([{"error": "failed", "visit_idx": 2}], next_state.errors)
+        self.assertEqual(3, next_state.visit_count)
+
+    def test_single_round_trip_storage_should_point_status_to_last_written_state(self):
+        db = PostgreStateStorage(self.DBSession, self.tenant_id, single_round_trip=True)
+        transition_action = MagicMock(return_value=(True, "", {}))
+        next_transition_action = MagicMock(return_value=(True, "", {}))
+
+        fsm = FSM(db, {
+            INITIAL_STATE: (transition_action, "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        fsm.run()
+
+        with self.DBSession() as db_session:
+            statuses = db_session.query(StateStatus).all()
+        self.assertEqual(1, len(statuses))
+        self.assertEqual("NEXT", statuses[0].ref_state_name)
+
+    def test_fsm_should_use_one_db_session_per_step_phase_and_none_during_actions(self):
+        counting_session = MagicMock(side_effect=self.DBSession)
+        db = PostgreStateStorage(counting_session, self.tenant_id)
+        sessions_during_actions = []
+
+        def transition_action(params):
+            sessions_during_actions.append(getattr(db._local, 'db_session', None))
+            return True, "", {}
+        next_transition_action = transition_action
+
+        fsm = FSM(db, {
+            INITIAL_STATE: (transition_action, "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        fsm.run()
+
+        # reads and writes of both transitions, and the read of the terminal state
+        self.assertEqual(5, counting_session.call_count)
+        self.assertListEqual([None, None], sessions_during_actions)
+        self.assertListEqual([INITIAL_STATE, "NEXT", TERMINAL_STATE], [x.name for x in db.get_db_history()])
+
+    def test_step_scope_should_roll_back_all_writes_of_a_failed_step(self):
+        with self.assertRaises(KeyError):
+            with self.db.step():
+                self.db.save_state(self.db.new_initial_state({}))
+                raise KeyError("NEXT")
+
+        self.assertFalse(self.db.get_db_history())
+
+    def test_create_indexes_should_add_missing_indexes_to_existing_tables(self):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql("DROP INDEX ix_state_entry_tenant_run_name")
+            connection.exec_driver_sql("DROP INDEX ix_state_status_tenant_run")
+
+        create_indexes(self.engine)
+        create_indexes(self.engine)
+
+        entry_indexes = {i['name'] for i in sqlalchemy.inspect(self.engine).get_indexes('state_entry')}
+        status_indexes = {i['name'] for i in sqlalchemy.inspect(self.engine).get_indexes('state_status')}
+        self.assertIn('ix_state_entry_tenant_run_name', entry_indexes)
+        self.assertTrue({'ix_state_status_tenant_run', 'ix_state_status_tenant_update_time',
+                         'ix_state_status_active'} <= status_indexes)
+
+    def test_last_state_should_be_tracked_per_run(self):
+        transition_action = MagicMock(return_value=(True, "", {}))
+        next_transition_action = MagicMock(return_value=(True, "", {}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (transition_action, "NEXT", "NOT-EXISTENT", True),
+            "NEXT": (next_transition_action, TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+
+        fsm.run()
+        first_run_id = self.db.get_last_state().run_id
+        fsm.run()
+        fsm.run()
+        second_run_id = self.db.get_last_state().run_id
+
+        self.assertNotEqual(first_run_id, second_run_id)
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state(first_run_id).name)
+        self.assertEqual("NEXT", self.db.get_last_state(second_run_id).name)
+        self.assertListEqual([second_run_id], self.db.get_active_runs())
+
+    def test_migrate_status_per_run_should_rebuild_status_of_every_run(self):
+        for run_id, state_name in [("1", INITIAL_STATE), ("2", INITIAL_STATE), ("1", "NEXT")]:
+            self.db.set_current_state(state_name, run_id, None, {}, datetime.utcnow(), datetime.utcnow())
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql("DROP INDEX ix_state_status_tenant_run")
+            connection.exec_driver_sql("ALTER TABLE state_status DROP COLUMN run_id")
+            connection.exec_driver_sql("DELETE FROM state_status WHERE ref_state_name <> 'NEXT'")
+
+        migrate_status_per_run(self.engine)
+        migrate_status_per_run(self.engine)
+
+        self.assertEqual("NEXT", self.db.get_last_state("1").name)
+        self.assertEqual(INITIAL_STATE, self.db.get_last_state("2").name)
+
+    def test_batching_storage_should_bulk_write_run_into_postgres(self):
+        failing_action = MagicMock(return_value=(False, "failed", {}))
+        db = BatchingStateStorage(self.db, FLUSH_PER_RUN)
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {"val": 1})), "LOOP-START", "NOT-EXISTENT", True),
+            "LOOP-START": (MagicMock(return_value=(True, "", {})), "LOOP-END", TERMINAL_STATE, True),
+            "LOOP-END": (failing_action, "LOOP-START", "LOOP-END", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 3})
+
+        fsm.run()
+
+        self.assertEqual(TERMINAL_STATE, self.db.get_last_state().name)
+        history = self.db.get_db_history()
+        self.assertListEqual([INITIAL_STATE, "LOOP-START", "LOOP-END", TERMINAL_STATE], [x.name for x in history])
+        self.assertListEqual([1, 1, 3, 1], [x.visit_count for x in history])
+        self.assertListEqual([2, 3], [x['visit_idx'] for x in history[2].errors])
+        self.assertEqual({"val": 1}, history[1].params)
+
+    def test_fsm_should_not_reload_states_of_a_run_on_every_step(self):
+        for single_round_trip in (False, True):
+            Base.metadata.drop_all(self.engine)
+            Base.metadata.create_all(self.engine)
+            db = PostgreStateStorage(self.DBSession, self.tenant_id, single_round_trip=single_round_trip)
+            fsm = FSM(db, {
+                INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "LOOP-START", "NOT-EXISTENT", True),
+                "LOOP-START": (MagicMock(return_value=(True, "", {})), "LOOP-END", TERMINAL_STATE, True),
+                "LOOP-END": (MagicMock(return_value=(True, "", {})), "LOOP-START", TERMINAL_STATE, True),
+                TERMINAL_STATE: (None, None, None, False)
+            }, {DEFAULT: 10})
+            selects = []
+
+            def count_selects(conn, cursor, statement, parameters, context, executemany):
+                if statement.lstrip().upper().startswith('SELECT'):
+                    selects.append(statement)
+
+            event.listen(self.engine, 'before_cursor_execute', count_selects)
+            try:
+                fsm.run()
+            finally:
+                event.remove(self.engine, 'before_cursor_execute', count_selects)
+
+            self.assertListEqual([1, 10, 10, 1], [x.visit_count for x in db.get_db_history()])
+            # lookups of the first visits only, not a few per each of the 20 steps
+            self.assertLessEqual(len(selects), 10, single_round_trip)
+
+    def test_start_runs_should_insert_initial_states_and_statuses_in_batches(self):
+        db = PostgreStateStorage(self.DBSession, self.tenant_id, start_runs_batch_size=1000)
+        statements = []
+
+        def count_statements(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute', count_statements)
+        try:
+            run_ids = db.start_runs([{"val": i} for i in range(2500)])
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', count_statements)
+
+        self.assertEqual(3, len(statements))
+        self.assertEqual(2500, len(set(run_ids)))
+        self.assertEqual(2500, len(db.get_active_runs()))
+        last_state = db.get_last_state(run_ids[1234])
+        self.assertEqual(INITIAL_STATE, last_state.name)
+        self.assertEqual({"val": 1234}, last_state.params)
+
+        transition_action = MagicMock(return_value=(True, "", {}))
+        FSM(db, {
+            INITIAL_STATE: (transition_action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }).run(run_ids[0])
+        transition_action.assert_called_once_with({"val": 0})
+        self.assertEqual(TERMINAL_STATE, db.get_last_state(run_ids[0]).name)
+
+    def test_iter_history_should_page_through_entries_of_its_tenant(self):
+        PostgreStateStorage(self.DBSession, "another-tenant").start_runs([{"val": -1}])
+        run_ids = self.db.start_runs([{"val": i} for i in range(5)])
+        statements = []
+
+        def count_statements(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute', count_statements)
+        try:
+            history = list(self.db.iter_history(batch_size=2))
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', count_statements)
+
+        self.assertListEqual([{"val": i} for i in range(5)], [x.params for x in history])
+        self.assertEqual(3, len(statements))
+        self.assertEqual(5, len(self.db.get_db_history()))
+        self.assertListEqual([{"val": 3}], [x.params for x in self.db.iter_history(run_ids[3])])
+        self.assertFalse(list(self.db.iter_history(since=datetime(2100, 1, 1))))
+        self.assertEqual(5, len(list(self.db.iter_history(until=datetime(2100, 1, 1), batch_size=5))))
+
+    def test_archive_runs_should_move_finished_runs_to_archive_tables(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_ids = self.db.start_runs([{"val": i} for i in range(3)])
+        fsm.run(run_ids[0])
+        fsm.run(run_ids[1])
+        archived_run_ids = []
+        self.db.add_state_listener(lambda run_id, state: archived_run_ids.append(run_id))
+
+        self.assertEqual(1, self.db.archive_runs(datetime.utcnow(), limit=1))
+        self.assertEqual(1, self.db.archive_runs(datetime.utcnow()))
+        self.assertEqual(0, self.db.archive_runs(datetime.utcnow()))
+
+        self.assertCountEqual(run_ids[:2], archived_run_ids)
+        self.assertListEqual([run_ids[2]], [x.run_id for x in self.db.get_db_history()])
+        self.assertListEqual([run_ids[2]], self.db.get_active_runs())
+        self.assertIsNone(self.db.get_last_state(run_ids[0]))
+        with self.DBSession() as db_session:
+            archived_entries = db_session.query(StateEntryArchive).order_by(StateEntryArchive.id).all()
+            archived_statuses = db_session.query(StateStatusArchive).all()
+        self.assertListEqual([(run_ids[0], INITIAL_STATE), (run_ids[1], INITIAL_STATE),
+                              (run_ids[0], TERMINAL_STATE), (run_ids[1], TERMINAL_STATE)],
+                             [(x.run_id, x.name) for x in archived_entries])
+        self.assertCountEqual([(run_id, TERMINAL_STATE) for run_id in run_ids[:2]],
+                              [(x.run_id, x.ref_state_name) for x in archived_statuses])
+        self.assertIsNotNone(archived_entries[0].archived_at)
+
+        self.assertEqual(1, self.db.archive_runs(datetime.utcnow(), stale_before=datetime.utcnow()))
+        self.assertFalse(self.db.get_db_history())
+
+    def test_archive_runs_should_keep_stale_runs_leased_to_a_worker(self):
+        run_ids = self.db.start_runs([{"val": 1}, {"val": 2}])
+        self.assertListEqual(run_ids[:1], self.db.claim_runs("worker-1", 10, 60, run_ids[:1]))
+
+        self.assertEqual(1, self.db.archive_runs(datetime.utcnow(), stale_before=datetime.utcnow()))
+
+        self.assertListEqual([run_ids[0]], self.db.get_active_runs())
+        self.db.release_run(run_ids[0], "worker-1")
+        self.assertEqual(1, self.db.archive_runs(datetime.utcnow(), stale_before=datetime.utcnow()))
+
+    def test_retries_should_append_errors_in_place_and_skip_unchanged_params(self):
+        params = {"payload": "x" * 100}
+        failing_action = MagicMock(side_effect=lambda p: (False, "failed", dict(params)))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", params)), "FLAKY", "NOT-EXISTENT", True),
+            "FLAKY": (failing_action, TERMINAL_STATE, "FLAKY", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 4})
+        updates = []
+
+        def capture_updates(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("UPDATE state_entry"):
+                updates.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute', capture_updates)
+        try:
+            fsm.run()
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', capture_updates)
+
+        flaky = self.db.find_state("FLAKY", self.db.get_last_state().run_id)
+        self.assertEqual(4, flaky.visit_count)
+        self.assertListEqual([{"error": "failed", "visit_idx": i} for i in (2, 3, 4)], flaky.errors)
+        self.assertEqual(params, flaky.params)
+        self.assertEqual(3, len(updates))
+        for statement in updates:
+            self.assertIn("errors || ", statement)
+            self.assertNotIn("params=", statement)
+
+    def test_large_params_should_be_stored_compressed(self):
+        large_params = {"payload": ["item-{}".format(i) for i in range(1000)]}
+        db = PostgreStateStorage(self.DBSession, self.tenant_id, compress_params_over=1024)
+        run_id = db.start_runs([large_params, {"val": 1}])[0]
+        fsm = FSM(db, {
+            INITIAL_STATE: (MagicMock(side_effect=lambda p: (True, "", p)), TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        fsm.run(run_id)
+        # the threshold belongs to the storage, others in the same process keep writing plain params
+        self.db.start_runs([large_params])
+
+        with self.engine.connect() as connection:
+            stored = [row[0] for row in connection.exec_driver_sql(
+                "SELECT params FROM state_entry ORDER BY id")]
+        self.assertListEqual([CompressedJSONB.ENVELOPE_KEY], list(stored[0]))
+        self.assertEqual({"val": 1}, stored[1])
+        self.assertListEqual([CompressedJSONB.ENVELOPE_KEY], list(stored[2]))
+        self.assertEqual(large_params, stored[3])
+        self.assertEqual(large_params, self.db.get_last_state(run_id).params)
+        self.assertEqual(large_params, self.db.find_state(INITIAL_STATE, run_id).params)
+
+    def test_migrate_json_to_jsonb_should_convert_entry_columns(self):
+        self.db.set_current_state(INITIAL_STATE, "1", "failed", {"val": 1}, datetime.utcnow(), datetime.utcnow())
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql("ALTER TABLE state_entry ALTER COLUMN params TYPE JSON USING params::json")
+            connection.exec_driver_sql("ALTER TABLE state_entry ALTER COLUMN errors TYPE JSON USING errors::json")
+
+        migrate_json_to_jsonb(self.engine)
+        migrate_json_to_jsonb(self.engine)
+
+        column_types = {c['name']: str(c['type']) for c in sqlalchemy.inspect(self.engine).get_columns('state_entry')}
+        self.assertEqual('JSONB', column_types['params'])
+        self.assertEqual('JSONB', column_types['errors'])
+        self.assertEqual({"val": 1}, self.db.get_last_state("1").params)
+
+    def test_claim_runs_should_skip_leased_finished_and_yielded_runs(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "PARKED", "NOT-EXISTENT", True),
+            "PARKED": (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_ids = self.db.start_runs([{"val": i} for i in range(5)])
+        fsm.run(run_ids[0])
+        self.db.terminate(run_ids[1])
+        other_tenant = PostgreStateStorage(self.DBSession, "other")
+        other_tenant.start_runs([{}])
+
+        claimed_by_a = self.db.claim_runs("a", 2, 60)
+        claimed_by_b = self.db.claim_runs("b", 10, 60)
+        self.assertEqual(2, len(claimed_by_a))
+        self.assertCountEqual(run_ids[2:], claimed_by_a + claimed_by_b)
+        self.assertFalse(self.db.claim_runs("b", 10, 60))
+        with self.DBSession() as db_session:
+            self.assertCountEqual([("a", run_id) for run_id in claimed_by_a] + [("b", claimed_by_b[0])],
+                                  db_session.query(StateStatus.lease_owner, StateStatus.run_id).
+                                  filter(StateStatus.tenant_id == self.tenant_id).
+                                  filter(StateStatus.lease_owner.isnot(None)).all())
+
+        self.assertTrue(self.db.renew_lease(claimed_by_a[0], "a", 60))
+        self.assertFalse(self.db.renew_lease(claimed_by_a[0], "b", 60))
+        self.db.release_run(claimed_by_a[0], "b")
+        self.assertFalse(self.db.claim_runs("b", 10, 60))
+        self.db.release_run(claimed_by_a[0], "a")
+        self.assertListEqual([claimed_by_a[0]], self.db.claim_runs("b", 10, 60))
+        self.assertTrue(self.db.renew_lease(claimed_by_a[1], "a", -1))
+        self.assertListEqual([claimed_by_a[1]], self.db.claim_runs("c", 10, 60))
+
+    def test_claim_runs_should_claim_parked_runs_once_due_and_listed_runs_whenever(self):
+        run_ids = self.db.start_runs([{"val": i} for i in range(4)])
+        self.db.yield_state(self.db.get_last_state(run_ids[0]), True, datetime.utcnow() - timedelta(seconds=1))
+        self.db.yield_state(self.db.get_last_state(run_ids[1]), True, datetime.utcnow() + timedelta(minutes=1))
+        self.db.yield_state(self.db.get_last_state(run_ids[2]), True)
+        self.db.terminate(run_ids[3])
+
+        self.assertListEqual([run_ids[0]], self.db.claim_runs("a", 10, 60))
+        self.assertCountEqual(run_ids[1:3], self.db.claim_runs("b", 10, 60, run_ids))
+        self.assertFalse(self.db.claim_runs("c", 10, 60, run_ids))
+
+    def test_concurrent_claims_should_not_hand_out_a_run_twice(self):
+        self.db.start_runs([{} for _ in range(20)])
+        claimed = []
+
+        def claim(owner):
+            storage = PostgreStateStorage(self.DBSession, self.tenant_id)
+            while True:
+                run_ids = storage.claim_runs(owner, 3, 60)
+                if not run_ids:
+                    return
+                claimed.extend(run_ids)
+
+        threads = [threading.Thread(target=claim, args=("worker-{}".format(i),)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(20, len(claimed))
+        self.assertEqual(20, len(set(claimed)))
+
+    def test_iter_yielded_runs_should_page_parked_runs_through_partial_index(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(True, "", {})), "PARKED", "NOT-EXISTENT", True),
+            "PARKED": (MagicMock(return_value=(True, "", {})), TERMINAL_STATE, "NOT-EXISTENT", False),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_ids = self.db.start_runs([{} for _ in range(5)])
+        for run_id in run_ids[:4]:
+            fsm.run(run_id)
+        fsm.run(run_ids[0])
+        PostgreStateStorage(self.DBSession, "other").start_runs([{}])
+
+        self.assertListEqual(run_ids[1:4], list(self.db.iter_yielded_runs(batch_size=2)))
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("SET enable_seqscan = off")
+            plan = "\n".join(row[0] for row in connection.exec_driver_sql(
+                "EXPLAIN SELECT id FROM state_entry WHERE tenant_id = '123' AND yielded ORDER BY id"))
+        self.assertIn("ix_state_entry_yielded", plan)
+
+    def test_get_due_runs_should_return_parked_runs_through_partial_index(self):
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (MagicMock(return_value=(False, "not ready", {}, 60)), TERMINAL_STATE, INITIAL_STATE,
+                            True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, {DEFAULT: 5})
+        run_ids = self.db.start_runs([{} for _ in range(3)])
+        for run_id in run_ids[:2]:
+            fsm.run(run_id)
+        fsm.run(run_ids[0])
+
+        due_runs = self.db.get_due_runs(datetime.utcnow() + timedelta(minutes=2))
+        self.assertListEqual(run_ids[:2], [run_id for run_id, _ in due_runs])
+        self.assertEqual(due_runs[0][1], self.db.get_last_state(run_ids[0]).due_at)
+        self.assertFalse(self.db.get_due_runs(datetime.utcnow()))
+        self.assertFalse(list(self.db.iter_yielded_runs()))
+        self.assertEqual(2, self.db.find_state(INITIAL_STATE, run_ids[0]).visit_count)
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("SET enable_seqscan = off")
+            plan = "\n".join(row[0] for row in connection.exec_driver_sql(
+                "EXPLAIN SELECT run_id FROM state_entry WHERE tenant_id = '123' AND due_at <= now() "
+                "ORDER BY due_at"))
+        self.assertIn("ix_state_entry_due", plan)
+
+    def test_parallel_state_should_persist_branch_results_between_runs(self):
+        flaky_branch = MagicMock(side_effect=[(False, "not ready", {}), {"flaky": 2}])
+        stable_branch = MagicMock(return_value={"stable": 1})
+        definition = {
+            INITIAL_STATE: (Parallel({"stable": stable_branch, "flaky": flaky_branch}), TERMINAL_STATE,
+                            INITIAL_STATE, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }
+        run_id = self.db.start_runs([{"val": 0}])[0]
+        FSM(self.db, definition, {DEFAULT: 3}).run(run_id)
+        FSM(self.db, definition, {DEFAULT: 3}).run(run_id)
+        self.assertDictEqual({"val": 0, BRANCH_RESULTS: {"stable": {"stable": 1}}},
+                             self.db.get_last_state(run_id).params)
+
+        FSM(self.db, definition, {DEFAULT: 3}).run(run_id)
+
+        stable_branch.assert_called_once_with({"val": 0})
+        self.assertEqual(2, flaky_branch.call_count)
+        last_state = self.db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 0, "stable": {"stable": 1}, "flaky": {"flaky": 2}}, last_state.params)
+
+    def test_recorded_step_results_should_be_reused_after_crash_and_archived_with_runs(self):
+        action = MagicMock(return_value=(True, None, {"charged": 1}))
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (action, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        }, memoize={INITIAL_STATE: StepMemo()})
+        run_id = self.db.start_runs([{"amount": 10}])[0]
+
+        with patch.object(self.db, 'set_current_state', side_effect=RuntimeError("crash")), \
+                patch.object(self.db, 'set_next_state', side_effect=RuntimeError("crash")):
+            with self.assertRaises(RuntimeError):
+                fsm.run(run_id)
+        fsm.run(run_id)
+
+        action.assert_called_once_with({"amount": 10})
+        self.assertDictEqual({"charged": 1}, self.db.get_last_state(run_id).params)
+        digest = params_hash({"amount": 10})
+        self.db.save_step_result(run_id, INITIAL_STATE, 1, digest, {'success': False})
+        self.assertTrue(self.db.find_step_result(run_id, INITIAL_STATE, 1, digest)['success'])
+        self.assertIsNone(self.db.find_step_result(run_id, INITIAL_STATE, 2, digest))
+        self.assertEqual(1, self.db.archive_runs(datetime.utcnow() + timedelta(seconds=1)))
+        self.assertIsNone(self.db.find_step_result(run_id, INITIAL_STATE, 1, digest))
+
+    def test_sub_machine_state_should_wait_for_its_child_run_across_runs(self):
+        child_db = PostgreStateStorage(self.DBSession, "child")
+        sub_machine = SubMachine({
+            INITIAL_STATE: (lambda params: {"val": params["val"] + 1}, TERMINAL_STATE, "FAILED", False),
+            "FAILED": (None, None, None, False),
+            TERMINAL_STATE: (None, None, None, False)
+        }, child_db, poll_seconds=0.1)
+        fsm = FSM(self.db, {
+            INITIAL_STATE: (sub_machine, TERMINAL_STATE, "NOT-EXISTENT", True),
+            TERMINAL_STATE: (None, None, None, False)
+        })
+        run_id = self.db.start_runs([{"val": 1}])[0]
+
+        fsm.run(run_id)
+        parked = self.db.get_last_state(run_id)
+        self.assertTrue(parked.yielded)
+        self.assertIsNotNone(parked.due_at)
+        child_run_id = parked.params[SUB_RUN_IDS][0]
+        self.assertEqual(run_id, child_db.find_state(INITIAL_STATE, child_run_id).params[PARENT_RUN_ID])
+        time.sleep(0.15)
+        fsm.run(run_id)
+
+        last_state = self.db.get_last_state(run_id)
+        self.assertEqual(TERMINAL_STATE, last_state.name)
+        self.assertDictEqual({"val": 2}, last_state.params)
+        self.assertEqual(1, self.db.find_state(INITIAL_STATE, run_id).visit_count)